@@ -0,0 +1,327 @@
+import asyncio
+import inspect
+import os
+import ssl
+from collections import deque
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, CookieJar, ClientError
+
+import wire
+from key_manager import get_key_manager
+from client import SendResult, SEND_WORKERS, batch_send_results
+
+# Асинхронный вариант SecureClient: вход, MFA и отправка данных через aiohttp.
+# Один цикл событий обслуживает много клиентов (сессий пользователей) сразу: запрос
+# не занимает поток на время ожидания ответа. Клиенты могут делить один пул соединений
+# (create_connector), у каждого при этом свои cookie — своя сессия Flask на сервере.
+#
+# Вход и MFA проходят на сервере (server_url), данные можно отправлять через координатор
+# (data_url): cookie-сессия подписана общим ключом и принимается любой репликой.
+
+# Соединений в общем пуле по умолчанию
+CLIENT_POOL_LIMIT = int(os.environ.get('CLIENT_POOL_LIMIT', 100))
+
+
+def create_ssl_context(cert_dir='certs'):
+    """mTLS-контекст клиента: сертификат клиента и CA для проверки сервера"""
+    context = ssl.create_default_context(cafile=os.path.join(cert_dir, 'ca_cert.pem'))
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(os.path.join(cert_dir, 'client_cert.pem'), os.path.join(cert_dir, 'client_key.pem'))
+    return context
+
+
+def create_connector(limit=CLIENT_POOL_LIMIT, cert_dir='certs', ssl_context=None):
+    """Общий пул соединений для нескольких AsyncSecureClient (вызывать внутри цикла событий).
+    Закрывается вызывающим кодом: await connector.close()"""
+    if ssl_context is None and os.path.exists(os.path.join(cert_dir, 'client_cert.pem')):
+        ssl_context = create_ssl_context(cert_dir)
+    return TCPConnector(limit=limit, ssl=ssl_context or True)
+
+
+class AsyncSecureClient:
+    """Asynchronous counterpart of SecureClient for scripts.
+
+    The TOTP code comes from totp — a base32 secret or a function totp(username) returning
+    the code (or an awaitable). Use as `async with AsyncSecureClient(...) as client:`."""
+
+    def __init__(self, server_url='https://localhost:5000', data_url=None, wire_format=None, totp=None,
+                 verbose=False, connector=None, pool_size=SEND_WORKERS, cert_dir='certs'):
+        self.server_url = server_url
+        # Адрес для /api/data (например, координатор); по умолчанию тот же сервер
+        self.data_url = data_url or server_url
+        self.totp = totp
+        self.verbose = verbose
+        self.pool_size = pool_size
+        self.totp_secret = None
+        self.wire_format = wire_format or ('msgpack' if wire.BINARY_AVAILABLE else 'json')
+        self.cert_dir = cert_dir
+        self.cert_file = os.path.join(cert_dir, 'client_cert.pem')
+        self.keys = get_key_manager('encryption_key.txt')
+        self.connector = connector
+        self.http = None
+        self.session_token = None
+        self.username = None
+        self.send_certificate = False
+        self._certificate_pem = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def start(self):
+        """Create the HTTP session; the connector is shared if one was passed in"""
+        if self.http is not None:
+            return
+        owner = self.connector is None
+        connector = self.connector or TCPConnector(limit=self.pool_size, ssl=self._ssl_context() or True)
+        # unsafe=True — cookie принимаются и от серверов, заданных IP-адресом (127.0.0.1)
+        self.http = ClientSession(connector=connector, connector_owner=owner, cookie_jar=CookieJar(unsafe=True))
+
+    async def close(self):
+        if self.http is not None:
+            await self.http.close()
+            self.http = None
+
+    def _ssl_context(self):
+        if not any(url.startswith('https://') for url in (self.server_url, self.data_url)):
+            return None
+        return create_ssl_context(self.cert_dir)
+
+    def log(self, *args):
+        if self.verbose:
+            print(*args)
+
+    async def totp_code(self, username):
+        """Текущий код TOTP из секрета или функции, переданных в totp"""
+        if callable(self.totp):
+            code = self.totp(username)
+            return await code if inspect.isawaitable(code) else code
+        from pyotp import TOTP
+        return TOTP(self.totp).now()
+
+    async def _post_json(self, path, payload, timeout=10):
+        await self.start()
+        async with self.http.post(f'{self.server_url}{path}', json=payload,
+                                  timeout=ClientTimeout(total=timeout)) as response:
+            try:
+                result = await response.json(content_type=None)
+            except ValueError:
+                result = None
+            return response.status, result if isinstance(result, dict) else {}
+
+    async def check_server_health(self):
+        """Check if server is healthy"""
+        await self.start()
+        try:
+            async with self.http.get(f'{self.server_url}/api/health', timeout=ClientTimeout(total=5)) as response:
+                return response.status == 200
+        except (ClientError, asyncio.TimeoutError) as e:
+            self.log(f"✗ Не могу подключиться к серверу: {e}")
+            return False
+
+    async def login(self, username, password):
+        """Password, then MFA setup (first login) or verification; True when the session is authenticated"""
+        self.username = username
+        try:
+            status_code, result = await self._post_json('/api/login', {'username': username, 'password': password})
+            if status_code != 200:
+                self.log(f"✗ Ошибка аутентификации: {result.get('error', 'Unknown error')}")
+                return False
+
+            if result.get('mfa_setup_required'):
+                if not await self.setup_mfa(username, result['totp_secret']):
+                    return False
+                # Настройка MFA не открывает сессию — входим еще раз уже со вторым фактором
+                return await self.login(username, password)
+            elif result.get('mfa_required'):
+                return await self.verify_mfa(username)
+            return True
+        except (ClientError, asyncio.TimeoutError) as e:
+            self.log(f"Ошибка соединения: {e}")
+            return False
+
+    async def setup_mfa(self, username, totp_secret):
+        """Завершить настройку MFA кодом из выданного сервером секрета (сохраняется в self.totp_secret)"""
+        from pyotp import TOTP
+        status_code, result = await self._post_json('/api/mfa/setup', {
+            'username': username, 'token': TOTP(totp_secret).now()
+        })
+        if status_code != 200:
+            self.log(f"✗ Настройка MFA не удалась: {result.get('error', status_code)}")
+            return False
+        self.totp_secret = totp_secret
+        if not callable(self.totp):
+            self.totp = totp_secret
+        return True
+
+    async def verify_mfa(self, username):
+        """Second factor: TOTP verification"""
+        if self.totp is None:
+            self.log("✗ Не задан источник кодов TOTP (totp)")
+            return False
+        status_code, result = await self._post_json('/api/mfa/verify', {
+            'username': username, 'token': await self.totp_code(username)
+        })
+        if status_code != 200:
+            self.log(f"✗ Неверный токен: {result.get('error', 'Unknown error')}")
+            return False
+        self.session_token = result.get('session_token')
+        self.log(f"✓ {username}: сессия активна {result.get('expires_in', 3600)} секунд")
+        return True
+
+    def encrypt_data(self, data):
+        """Encrypt data before sending"""
+        return self.keys.encrypt(data.encode()).decode('utf-8')
+
+    def certificate_pem(self):
+        """Client certificate PEM, read from disk once (only needed without mTLS)"""
+        if self._certificate_pem is None:
+            try:
+                with open(self.cert_file, 'r') as f:
+                    self._certificate_pem = f.read()
+            except FileNotFoundError:
+                self.log("Ошибка: Клиентский сертификат не найден.")
+        return self._certificate_pem
+
+    async def post_data(self, path, build_payload, timeout=10):
+        """POST to a data endpoint of data_url, same negotiation as SecureClient.post_data.
+        Returns (status_code, decoded response)."""
+        await self.start()
+        while True:
+            content_type = wire.MSGPACK_CONTENT_TYPE if self.wire_format == 'msgpack' else wire.JSON_CONTENT_TYPE
+            payload = build_payload(content_type)
+            if self.send_certificate:
+                payload['certificate'] = self.certificate_pem()
+            async with self.http.post(
+                f'{self.data_url}{path}',
+                data=wire.encode(payload, content_type),
+                headers={'Content-Type': content_type, 'Accept': content_type},
+                timeout=ClientTimeout(total=timeout)
+            ) as response:
+                status_code = response.status
+                raw = await response.read()
+                response_type = response.headers.get('Content-Type')
+            if status_code == 415 and self.wire_format != 'json':
+                self.log("⚠️  Сервер не поддерживает msgpack, переключаюсь на JSON")
+                self.wire_format = 'json'
+                continue
+            try:
+                result = wire.decode(response_type, raw)
+            except Exception:
+                result = None
+            result = result if isinstance(result, dict) else {}
+            if (status_code == 401 and result.get('error') == 'Certificate required'
+                    and not self.send_certificate and self.certificate_pem() is not None):
+                # Сервер не видит сертификат в TLS-соединении (HTTP, координатор) — передаем его в теле
+                self.send_certificate = True
+                continue
+            return status_code, result
+
+    async def send_secure_data(self, data):
+        """Send one encrypted message; returns the server response or None"""
+        if not self.session_token:
+            self.log("Ошибка: Не авторизован. Пожалуйста, сначала войдите в систему.")
+            return None
+        encrypted_data = self.encrypt_data(data)
+        try:
+            status_code, result = await self.post_data('/api/data', lambda content_type: {
+                'data': wire.token_to_wire(encrypted_data, content_type)
+            })
+        except (ClientError, asyncio.TimeoutError) as e:
+            self.log(f"Ошибка соединения: {e}")
+            return None
+        if status_code != 200:
+            self.log(f"✗ Ошибка: {status_code} {result.get('error', 'Unknown error')}")
+            return None
+        return result
+
+    async def send_secure_data_batch(self, messages):
+        """Send many encrypted messages in one request; returns per-message results in order"""
+        if not self.session_token:
+            self.log("Ошибка: Не авторизован. Пожалуйста, сначала войдите в систему.")
+            return None
+        items = [self.encrypt_data(message) for message in messages]
+        try:
+            status_code, result = await self.post_data('/api/data/batch', lambda content_type: {
+                'items': [wire.token_to_wire(item, content_type) for item in items]
+            }, timeout=30)
+        except (ClientError, asyncio.TimeoutError) as e:
+            self.log(f"Ошибка соединения: {e}")
+            return None
+        if status_code != 200:
+            self.log(f"✗ Ошибка: {status_code} {result.get('error', 'Unknown error')}")
+            return None
+        return result.get('results')
+
+    async def send_many(self, messages, concurrency=None, batch_size=1, ordered=True):
+        """Async generator of SendResult, like SecureClient.send_many: up to `concurrency`
+        requests in flight, the next messages are encrypted while they wait.
+        messages may be a regular or an async iterable.
+        Raises RuntimeError on the first iteration if the client is not logged in."""
+        if not self.session_token:
+            raise RuntimeError("Не авторизован: сначала войдите в систему (login/verify_mfa)")
+        concurrency = concurrency or self.pool_size
+        batch_size = max(1, batch_size)
+        source = messages.__aiter__() if hasattr(messages, '__aiter__') else _aiter(messages)
+        pending = deque()
+        index = 0
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(pending) < concurrency:
+                    chunk = []
+                    for _ in range(batch_size):
+                        try:
+                            chunk.append(await source.__anext__())
+                        except StopAsyncIteration:
+                            break
+                    if not chunk:
+                        exhausted = True
+                        break
+                    items = [self.encrypt_data(message) for message in chunk]
+                    pending.append(asyncio.ensure_future(self._send_job(index, items, batch_size > 1)))
+                    index += len(chunk)
+                if not pending:
+                    return
+                if ordered:
+                    done = [pending.popleft()]
+                else:
+                    finished, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    done = [task for task in pending if task in finished]
+                    for task in done:
+                        pending.remove(task)
+                for task in done:
+                    for result in await task:
+                        yield result
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _send_job(self, index, items, batch):
+        try:
+            if batch:
+                status_code, result = await self.post_data('/api/data/batch', lambda content_type: {
+                    'items': [wire.token_to_wire(item, content_type) for item in items]
+                }, timeout=30)
+            else:
+                status_code, result = await self.post_data('/api/data', lambda content_type: {
+                    'data': wire.token_to_wire(items[0], content_type)
+                })
+        except (ClientError, asyncio.TimeoutError) as e:
+            return [SendResult(index + i, False, None, None, str(e) or type(e).__name__) for i in range(len(items))]
+
+        if status_code != 200:
+            error_msg = result.get('error', 'Unknown error')
+            return [SendResult(index + i, False, status_code, result, error_msg) for i in range(len(items))]
+        if not batch:
+            return [SendResult(index, True, status_code, result, None)]
+        return batch_send_results(index, len(items), status_code, result.get('results'))
+
+
+async def _aiter(iterable):
+    for item in iterable:
+        yield item
+
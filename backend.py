@@ -0,0 +1,168 @@
+import os
+import sys
+import json
+import time
+import signal
+import subprocess
+
+from storage import DEFAULT_STORE_URL
+
+# Запуск N реплик сервера (логика server.py) на диапазоне портов:
+#
+#   python backend.py 16            # 16 реплик на портах 5000..5015
+#   python backend.py 4 6000        # 4 реплики на портах 6000..6003
+#
+# Каждая реплика получает REPLICA_ID (replica-1, replica-2, ...), реплики делят состояние
+# через общее хранилище SQLite. Список адресов записывается в backends.json —
+# координатор читает его при запуске вместо фиксированного списка серверов.
+
+BACKEND_REPLICAS = int(os.environ.get('BACKEND_REPLICAS', 3))
+BACKEND_BASE_PORT = int(os.environ.get('BACKEND_BASE_PORT', 5000))
+BACKEND_HOST = os.environ.get('BACKEND_HOST', 'localhost')
+# 1 — реплики с mTLS (https), 0 — HTTP для нагрузочных тестов за координатором на одном хосте
+BACKEND_TLS = os.environ.get('BACKEND_TLS', '1') == '1'
+# Воркеров gunicorn в каждой реплике (0 — встроенный сервер Flask)
+REPLICA_WORKERS = int(os.environ.get('REPLICA_WORKERS', 0))
+BACKENDS_FILE = os.environ.get('BACKENDS_FILE', 'backends.json')
+BACKEND_STORE_URL = os.environ.get('SESSION_STORE', DEFAULT_STORE_URL)
+CERT_DIR = 'certs'
+# Перезапускать реплику, завершившуюся без команды launcher'а
+BACKEND_RESTART = os.environ.get('BACKEND_RESTART', '0') == '1'
+
+
+class Replica:
+    """Один процесс server.py на своем порту"""
+
+    def __init__(self, index, port, tls=BACKEND_TLS, workers=REPLICA_WORKERS, log_dir=None,
+                 store_url=BACKEND_STORE_URL):
+        self.index = index
+        self.port = port
+        self.tls = tls
+        self.workers = workers
+        self.log_dir = log_dir
+        self.store_url = store_url
+        self.replica_id = f'replica-{index + 1}'
+        self.process = None
+        self.restarts = 0
+        self.exit_reported = False
+
+    @property
+    def url(self):
+        scheme = 'https' if self.tls else 'http'
+        return f'{scheme}://{BACKEND_HOST}:{self.port}'
+
+    def env(self):
+        env = dict(os.environ)
+        env.update({
+            'SERVER_PORT': str(self.port),
+            'REPLICA_ID': self.replica_id,
+            'SERVER_TLS': '1' if self.tls else '0',
+            'SERVER_DEBUG': '0',
+            'SESSION_STORE': self.store_url,
+            'PYTHONUNBUFFERED': '1',
+        })
+        # Собственный сертификат реплики, если он выпущен (python generate_certs.py --servers N)
+        cert_file = os.path.join(CERT_DIR, f'{self.replica_id}_cert.pem')
+        key_file = os.path.join(CERT_DIR, f'{self.replica_id}_key.pem')
+        if self.tls and os.path.exists(cert_file) and os.path.exists(key_file):
+            env.update({'SERVER_CERT': cert_file, 'SERVER_KEY': key_file})
+        return env
+
+    def start(self):
+        command = [sys.executable, 'server.py']
+        if self.workers:
+            command += ['serve', str(self.workers)]
+        output = None
+        if self.log_dir:
+            output = open(os.path.join(self.log_dir, f'{self.replica_id}.log'), 'ab')
+        self.process = subprocess.Popen(
+            command, env=self.env(), stdout=output, stderr=subprocess.STDOUT if output else None,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        )
+        if output:
+            output.close()  # Дескриптор унаследован дочерним процессом
+        self.exit_reported = False
+        return self
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def stop(self, sig=signal.SIGTERM, timeout=10):
+        if not self.alive():
+            return
+        self.process.send_signal(sig)
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+    def restart(self):
+        self.stop()
+        self.restarts += 1
+        return self.start()
+
+
+def create_replicas(count=BACKEND_REPLICAS, base_port=BACKEND_BASE_PORT, **options):
+    return [Replica(index, base_port + index, **options) for index in range(count)]
+
+
+def write_backends_file(replicas, path=BACKENDS_FILE):
+    """Список реплик для координатора (атомарная запись)"""
+    config = {
+        'backends': [replica.url for replica in replicas],
+        'replicas': {replica.url: replica.replica_id for replica in replicas},
+    }
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(config, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def stop_all(replicas):
+    for replica in replicas:
+        if replica.alive():
+            replica.process.send_signal(signal.SIGTERM)
+    for replica in replicas:
+        replica.stop()
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else BACKEND_REPLICAS
+    base_port = int(argv[2]) if len(argv) > 2 else BACKEND_BASE_PORT
+    replicas = create_replicas(count, base_port)
+
+    print(f"🚀 Запуск {count} реплик сервера на портах {base_port}..{base_port + count - 1}")
+    print(f"🗄️  Общее хранилище состояния: {BACKEND_STORE_URL}")
+    for replica in replicas:
+        replica.start()
+        print(f"   {replica.replica_id}: {replica.url} (pid {replica.process.pid})")
+    write_backends_file(replicas)
+    print(f"📄 Список серверов записан в {BACKENDS_FILE} — запустите coordinator.py")
+
+    # SIGTERM обрабатываем как Ctrl+C: останавливаем все реплики
+    signal.signal(signal.SIGTERM, _interrupt)
+    try:
+        while True:
+            time.sleep(1)
+            for replica in replicas:
+                if replica.process.poll() is not None:
+                    code = replica.process.returncode
+                    if BACKEND_RESTART:
+                        print(f"🔁 {replica.replica_id} завершилась (код {code}), перезапуск")
+                        replica.restart()
+                    elif not replica.exit_reported:
+                        print(f"⚠️  {replica.replica_id} завершилась (код {code})")
+                        replica.exit_reported = True
+    except KeyboardInterrupt:
+        print("\n🛑 Остановка реплик...")
+    finally:
+        stop_all(replicas)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,428 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import threading
+import subprocess
+from datetime import datetime
+
+import requests
+import urllib3
+import wire
+from key_manager import get_key_manager
+from tls import create_client_context, mount_resuming_adapter
+
+# Нагрузочный тест входа, MFA и передачи данных (без input(), в отличие от client.py).
+#
+#   python bench.py run --target https://localhost:5000 -c 16 -d 30
+#   python bench.py run --target http://localhost:5000 --via http://localhost:8000 --label coordinator
+#   python bench.py compare bench_results/a.json bench_results/b.json
+#
+# Виртуальные пользователи входят как user1 (пароль + TOTP), затем выполняют операции
+# из файла смеси (bench_mix.jsonl): по одной JSON-операции на строку с весом.
+#   {"op": "login", "weight": 1}                              — /api/login + /api/mfa/verify
+#   {"op": "data", "weight": 16, "size": 256}                 — /api/data
+#   {"op": "batch", "weight": 1, "items": 32, "size": 256}    — /api/data/batch
+# С --via данные идут через координатор, вход — напрямую на --target.
+# Результат (RPS, p50/p95/p99 по каждому адресу) сохраняется в JSON для сравнения прогонов.
+
+BENCH_MIX_FILE = os.environ.get('BENCH_MIX_FILE', 'bench_mix.jsonl')
+BENCH_RESULTS_DIR = os.environ.get('BENCH_RESULTS_DIR', 'bench_results')
+# Секрет TOTP пользователя сохраняется после первой настройки MFA
+BENCH_SECRET_FILE = os.environ.get('BENCH_SECRET_FILE', '.bench_totp_secret')
+BENCH_USERNAME = os.environ.get('BENCH_USERNAME', 'user1')
+BENCH_PASSWORD = os.environ.get('BENCH_PASSWORD', 'password123')
+REQUEST_TIMEOUT = 30
+
+CERT_DIR = 'certs'
+CA_CERT = os.path.join(CERT_DIR, 'ca_cert.pem')
+CLIENT_CERT = os.path.join(CERT_DIR, 'client_cert.pem')
+CLIENT_KEY = os.path.join(CERT_DIR, 'client_key.pem')
+
+PERCENTILES = (50, 95, 99)
+OPERATIONS = ('login', 'data', 'batch')
+
+
+class BenchError(Exception):
+    """Прогон невозможен (сервер недоступен, неизвестен секрет TOTP и т.п.)"""
+
+
+def load_mix(path):
+    """Операции смеси: [(op, params)] и их веса"""
+    operations, weights = [], []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            entry = json.loads(line)
+            op = entry.pop('op')
+            if op not in OPERATIONS:
+                raise BenchError(f"Неизвестная операция в {path}: {op}")
+            weights.append(float(entry.pop('weight', 1)))
+            operations.append((op, entry))
+    if not operations:
+        raise BenchError(f"Файл смеси {path} пуст")
+    return operations, weights
+
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(q / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    summary = {
+        'count': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / elapsed, 2) if elapsed > 0 else 0.0,
+        'mean_ms': round(sum(latencies) / len(latencies), 3) if latencies else None,
+        'max_ms': round(latencies[-1], 3) if latencies else None,
+    }
+    for q in PERCENTILES:
+        value = percentile(latencies, q)
+        summary[f'p{q}_ms'] = round(value, 3) if value is not None else None
+    return summary
+
+
+class Recorder:
+    """Замеры одного потока: адрес -> задержки (мс) и число ошибок.
+    Запросы, начатые во время прогрева, не учитываются"""
+
+    def __init__(self, measure_from):
+        self.measure_from = measure_from
+        self.latencies = {}
+        self.errors = {}
+
+    def timed(self, path, send):
+        started = time.perf_counter()
+        try:
+            ok = send()
+        except requests.RequestException:
+            ok = False
+        if started < self.measure_from:
+            return ok
+        if ok:
+            self.latencies.setdefault(path, []).append((time.perf_counter() - started) * 1000)
+        else:
+            self.errors[path] = self.errors.get(path, 0) + 1
+        return ok
+
+
+def create_session(verify, tls_resume=True):
+    """Сессия с клиентским сертификатом (mTLS) — и к серверу, и к координатору по https.
+    У каждой сессии свой TLS-контекст: возобновляются только ее собственные TLS-сессии"""
+    session = requests.Session()
+    session.cert = (CLIENT_CERT, CLIENT_KEY)
+    session.verify = CA_CERT if verify else False
+    mount_resuming_adapter(session, 'https://', create_client_context(CLIENT_CERT, CLIENT_KEY, CA_CERT,
+                                                                      resume=tls_resume))
+    return session
+
+
+def certificate_pem():
+    with open(CLIENT_CERT) as f:
+        return f.read()
+
+
+class VirtualUser:
+    """Один пользователь нагрузки: своя HTTP-сессия (cookie, keep-alive) и свой поток"""
+
+    def __init__(self, config, secret, recorder, seed):
+        self.config = config
+        self.secret = secret
+        self.recorder = recorder
+        self.random = random.Random(seed)
+        self.session = create_session(config.verify, config.tls_resume)
+        self.tls = self.session.get_adapter('https://')
+        self.requests_sent = 0
+        self.data_url = config.via or config.target
+        self.logged_in = False
+        self.content_type = wire.MSGPACK_CONTENT_TYPE if config.format == 'msgpack' else wire.JSON_CONTENT_TYPE
+        # По HTTP сервер не видит сертификат в TLS — передаем его в теле сразу, без лишнего 401
+        self.certificate = None if self.data_url.startswith('https://') else certificate_pem()
+        self.keys = get_key_manager('encryption_key.txt')
+
+    def reconnect_if_due(self):
+        """--reconnect-every N: закрыть соединения после каждых N запросов (новое TLS-рукопожатие)"""
+        self.requests_sent += 1
+        if self.config.reconnect_every and self.requests_sent % self.config.reconnect_every == 0:
+            self.session.close()
+
+    def post_json(self, path, payload):
+        response = self.session.post(f'{self.config.target}{path}', json=payload, timeout=REQUEST_TIMEOUT)
+        self.reconnect_if_due()
+        return response.status_code == 200
+
+    def login(self):
+        from pyotp import TOTP
+        ok = self.recorder.timed('/api/login', lambda: self.post_json(
+            '/api/login', {'username': BENCH_USERNAME, 'password': BENCH_PASSWORD}))
+        if not ok:
+            return False
+        return self.recorder.timed('/api/mfa/verify', lambda: self.post_json(
+            '/api/mfa/verify', {'username': BENCH_USERNAME, 'token': TOTP(self.secret).now()}))
+
+    def message(self, size):
+        return self.random.randbytes(size // 2).hex()
+
+    def post_data(self, path, payload):
+        if self.certificate:
+            payload['certificate'] = self.certificate
+        response = self.session.post(
+            f'{self.data_url}{path}',
+            data=wire.encode(payload, self.content_type),
+            headers={'Content-Type': self.content_type, 'Accept': self.content_type},
+            timeout=REQUEST_TIMEOUT
+        )
+        self.reconnect_if_due()
+        if response.status_code == 401:
+            self.logged_in = False  # Сессия истекла или потеряна — войдем заново
+        return response.status_code == 200
+
+    def data(self, size=256):
+        token = self.keys.encrypt(self.message(size).encode()).decode()
+        return self.recorder.timed('/api/data', lambda: self.post_data(
+            '/api/data', {'data': wire.token_to_wire(token, self.content_type)}))
+
+    def batch(self, items=32, size=256):
+        tokens = [self.keys.encrypt(self.message(size).encode()).decode() for _ in range(items)]
+        return self.recorder.timed('/api/data/batch', lambda: self.post_data(
+            '/api/data/batch', {'items': [wire.token_to_wire(t, self.content_type) for t in tokens]}))
+
+    def run(self, operations, weights, deadline, stop):
+        self.logged_in = self.login()
+        while not stop.is_set() and time.perf_counter() < deadline:
+            if not self.logged_in:
+                self.logged_in = self.login()
+                if not self.logged_in:
+                    time.sleep(0.05)  # Не забиваем журнал ошибок, пока сервер недоступен
+                continue
+            op, params = self.random.choices(operations, weights)[0]
+            getattr(self, op)(**params)
+
+
+def ensure_mfa(config):
+    """Секрет TOTP пользователя: настраиваем MFA, если она еще не включена, иначе берем сохраненный"""
+    import pyotp
+    session = create_session(config.verify)
+    try:
+        response = session.post(f'{config.target}/api/login',
+                                json={'username': BENCH_USERNAME, 'password': BENCH_PASSWORD}, timeout=REQUEST_TIMEOUT)
+    except requests.RequestException as e:
+        raise BenchError(f"Сервер {config.target} недоступен: {e}")
+    result = response.json() if response.status_code == 200 else {}
+    if result.get('mfa_setup_required'):
+        secret = result['totp_secret']
+        response = session.post(f'{config.target}/api/mfa/setup', json={
+            'username': BENCH_USERNAME, 'token': pyotp.TOTP(secret).now()
+        }, timeout=REQUEST_TIMEOUT)
+        if response.status_code != 200:
+            raise BenchError(f"Не удалось настроить MFA: {response.status_code} {response.text}")
+        with open(BENCH_SECRET_FILE, 'w') as f:
+            f.write(secret)
+        print(f"🔐 MFA для {BENCH_USERNAME} настроена, секрет сохранен в {BENCH_SECRET_FILE}")
+        return secret
+    if result.get('mfa_required'):
+        secret = config.totp_secret or os.environ.get('BENCH_TOTP_SECRET')
+        if not secret and os.path.exists(BENCH_SECRET_FILE):
+            with open(BENCH_SECRET_FILE) as f:
+                secret = f.read().strip()
+        if not secret:
+            raise BenchError(f"MFA уже включена, а секрет неизвестен: укажите --totp-secret или BENCH_TOTP_SECRET")
+        return secret
+    raise BenchError(f"Вход не удался: {response.status_code} {response.text}")
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run_benchmark(config):
+    operations, weights = load_mix(config.mix)
+    secret = ensure_mfa(config)
+
+    started_at = datetime.now().isoformat(timespec='seconds')
+    started = time.perf_counter()
+    measure_from = started + config.warmup
+    deadline = measure_from + config.duration
+    stop = threading.Event()
+    recorders = [Recorder(measure_from) for _ in range(config.concurrency)]
+    users = [VirtualUser(config, secret, recorder, config.seed + index) for index, recorder in enumerate(recorders)]
+    threads = [
+        threading.Thread(target=user.run, args=(operations, weights, deadline, stop), daemon=True)
+        for user in users
+    ]
+
+    target = config.target + (f" через {config.via}" if config.via else "")
+    print(f"🏁 {config.concurrency} пользователей, {config.duration:g} с (+{config.warmup:g} с прогрева): {target}")
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        stop.set()
+        print("\n⏹  Прогон прерван, результаты неполные")
+        for thread in threads:
+            thread.join()
+    elapsed = max(1e-9, min(time.perf_counter(), deadline) - measure_from)
+
+    paths = sorted({path for r in recorders for path in (*r.latencies, *r.errors)})
+    endpoints = {}
+    all_latencies, all_errors = [], 0
+    for path in paths:
+        latencies = [value for r in recorders for value in r.latencies.get(path, [])]
+        errors = sum(r.errors.get(path, 0) for r in recorders)
+        endpoints[path] = summarize(latencies, errors, elapsed)
+        all_latencies += latencies
+        all_errors += errors
+
+    handshakes = sum(user.tls.tls_stats()['handshakes'] for user in users)
+    resumed = sum(user.tls.tls_stats()['resumed'] for user in users)
+    tls = {
+        'resume': config.tls_resume,
+        'handshakes': handshakes,
+        'resumed': resumed,
+        'hit_rate': round(resumed / handshakes, 3) if handshakes else None,
+    }
+
+    return {
+        'meta': {
+            'label': config.label,
+            'target': config.target,
+            'via': config.via,
+            'concurrency': config.concurrency,
+            'duration_s': round(elapsed, 3),
+            'warmup_s': config.warmup,
+            'format': config.format,
+            'reconnect_every': config.reconnect_every,
+            'mix': [{'op': op, 'weight': w, **params} for (op, params), w in zip(operations, weights)],
+            'started_at': started_at,
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'cpu_count': os.cpu_count(),
+        },
+        'endpoints': endpoints,
+        'total': summarize(all_latencies, all_errors, elapsed),
+        'tls': tls,
+    }
+
+
+def print_results(results):
+    header = f"{'адрес':<18}{'запросов':>9}{'ошибок':>8}{'RPS':>10}{'p50 мс':>9}{'p95 мс':>9}{'p99 мс':>9}"
+    print(header)
+    print('-' * len(header))
+    rows = list(results['endpoints'].items()) + [('ИТОГО', results['total'])]
+    for path, s in rows:
+        cells = [f"{s[key]:>9.1f}" if s[key] is not None else f"{'-':>9}" for key in ('p50_ms', 'p95_ms', 'p99_ms')]
+        print(f"{path:<18}{s['count']:>9}{s['errors']:>8}{s['rps']:>10.1f}{''.join(cells)}")
+    tls = results.get('tls')
+    if tls and tls['handshakes']:
+        mode = "" if tls['resume'] else " (возобновление отключено)"
+        print(f"\n🔁 TLS: {tls['handshakes']} рукопожатий, возобновлено {tls['resumed']} "
+              f"({tls['hit_rate']:.0%}){mode}")
+
+
+def save_results(results, output=None):
+    if output is None:
+        os.makedirs(BENCH_RESULTS_DIR, exist_ok=True)
+        name = results['meta']['label'] or 'bench'
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        output = os.path.join(BENCH_RESULTS_DIR, f'{name}-{stamp}.json')
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    return output
+
+
+def compare(base, new, threshold):
+    """Печать разницы двух прогонов; True, если нет регрессии больше threshold процентов
+    (падение RPS или рост p95/p99)"""
+    ok = True
+    print(f"{'адрес':<18}{'метрика':>9}{'было':>11}{'стало':>11}{'изменение':>12}")
+    paths = sorted(set(base['endpoints']) | set(new['endpoints']))
+    for path in paths + ['ИТОГО']:
+        old_stats = base['total'] if path == 'ИТОГО' else base['endpoints'].get(path)
+        new_stats = new['total'] if path == 'ИТОГО' else new['endpoints'].get(path)
+        if not old_stats or not new_stats:
+            print(f"{path:<18}{'—':>9}  есть только в одном из прогонов")
+            continue
+        for key, higher_is_better in (('rps', True), ('p50_ms', False), ('p95_ms', False), ('p99_ms', False)):
+            old_value, new_value = old_stats.get(key), new_stats.get(key)
+            if not old_value or new_value is None:
+                continue
+            change = (new_value - old_value) / old_value * 100
+            regression = -change if higher_is_better else change
+            mark = ''
+            if regression > threshold and key in ('rps', 'p95_ms', 'p99_ms'):
+                mark = ' ❌'
+                ok = False
+            print(f"{path:<18}{key:>9}{old_value:>11.1f}{new_value:>11.1f}{change:>+11.1f}%{mark}")
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Нагрузочный тест входа, MFA и /api/data')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help='прогон нагрузки')
+    run.add_argument('--target', default='https://localhost:5000', help='сервер для входа и MFA (и данных без --via)')
+    run.add_argument('--via', help='координатор, через который отправляются данные')
+    run.add_argument('-c', '--concurrency', type=int, default=8)
+    run.add_argument('-d', '--duration', type=float, default=30, help='секунд измерения')
+    run.add_argument('--warmup', type=float, default=2, help='секунд прогрева (не учитываются)')
+    run.add_argument('--mix', default=BENCH_MIX_FILE)
+    run.add_argument('--format', choices=('json', 'msgpack'),
+                     default='msgpack' if wire.BINARY_AVAILABLE else 'json')
+    run.add_argument('--label', help='имя прогона (в имени файла результата)')
+    run.add_argument('--output', help=f'файл результата (по умолчанию {BENCH_RESULTS_DIR}/<label>-<время>.json)')
+    run.add_argument('--totp-secret', help='секрет TOTP, если MFA уже включена')
+    run.add_argument('--seed', type=int, default=1)
+    run.add_argument('--insecure', dest='verify', action='store_false',
+                     help='не проверять сертификат сервера (старые сертификаты без SAN для localhost)')
+    run.add_argument('--reconnect-every', type=int, default=0,
+                     help='закрывать соединения после каждых N запросов пользователя (0 — keep-alive)')
+    run.add_argument('--no-tls-resume', dest='tls_resume', action='store_false',
+                     help='всегда полное TLS-рукопожатие (для сравнения с возобновлением сессий)')
+
+    cmp = commands.add_parser('compare', help='сравнение двух прогонов')
+    cmp.add_argument('base')
+    cmp.add_argument('new')
+    cmp.add_argument('--threshold', type=float, default=10, help='допустимая регрессия, %%')
+
+    config = parser.parse_args(argv)
+
+    if config.command == 'compare':
+        with open(config.base) as f:
+            base = json.load(f)
+        with open(config.new) as f:
+            new = json.load(f)
+        return 0 if compare(base, new, config.threshold) else 1
+
+    config.target = config.target.rstrip('/')
+    config.via = config.via.rstrip('/') if config.via else None
+    if not config.verify:
+        urllib3.disable_warnings()
+    try:
+        results = run_benchmark(config)
+    except BenchError as e:
+        print(f"❌ {e}")
+        return 2
+    print_results(results)
+    print(f"\n💾 Результат: {save_results(results, config.output)}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,362 @@
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import argparse
+import threading
+import subprocess
+from types import SimpleNamespace
+from datetime import datetime
+
+import requests
+import wire
+from backend import create_replicas
+from bench import VirtualUser, ensure_mfa, percentile, BenchError, BENCH_RESULTS_DIR
+
+# Автоматическая проверка отказоустойчивости (вместо ручного шага 8 из README):
+# запускает координатор и N реплик сервера, подает постоянную нагрузку на /api/data
+# через координатор, по расписанию убивает и перезапускает реплики и измеряет:
+#   - долю ошибок и прирост задержки (p95) во время отказа относительно нормы;
+#   - время восстановления — от события до последнего ошибочного или медленного ответа;
+#   - время, за которое координатор замечает отказ (сервер down / автомат open)
+#     и возвращает реплику в работу после перезапуска.
+#
+#   python chaos.py                                   # 3 реплики, 60 с, расписание по умолчанию
+#   python chaos.py -n 5 -d 90 --rate 200 --schedule "10:kill:1,30:start:1,50:kill:2,51:kill:3,70:start:2,70:start:3"
+#   LB_STRATEGY=round_robin HEALTH_CHECK_INTERVAL=0.5 python chaos.py --label rr-fast-health
+#
+# Событие расписания: "<секунда>:<kill|stop|start>:<номер реплики>" (kill — SIGKILL, stop — SIGTERM).
+# Параметры координатора (LB_STRATEGY, HEALTH_CHECK_*, CB_*, HEDGE_*) передаются через окружение.
+
+CHAOS_DIR = os.environ.get('CHAOS_DIR', os.path.join(BENCH_RESULTS_DIR, 'chaos'))
+READY_TIMEOUT = 30
+HEALTH_POLL_INTERVAL = 0.1
+BUCKET_SECONDS = 1.0
+
+
+class TimelineRecorder:
+    """Замеры с привязкой ко времени: (момент плановой отправки, задержка мс, успех).
+    Задержка считается от плановой отправки — задержки очереди при отказе не теряются"""
+
+    def __init__(self, origin):
+        self.origin = origin
+        self.intended = None
+        self.samples = []
+
+    def timed(self, path, send):
+        started = self.intended if self.intended is not None else time.perf_counter()
+        try:
+            ok = send()
+        except requests.RequestException:
+            ok = False
+        self.samples.append((started - self.origin, (time.perf_counter() - started) * 1000, ok))
+        return ok
+
+
+class HealthMonitor:
+    """Опрос /api/health координатора: когда он отметил сервер недоступным и вернул в работу"""
+
+    def __init__(self, url, origin):
+        self.url = url
+        self.origin = origin
+        self.snapshots = []
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='health-monitor', daemon=True)
+
+    def _run(self):
+        session = requests.Session()
+        while not self.stop.is_set():
+            try:
+                servers = session.get(f'{self.url}/api/health', timeout=2).json()['servers']
+                self.snapshots.append((time.perf_counter() - self.origin, {
+                    s['server']: (s['status'], s.get('circuit', {}).get('state')) for s in servers
+                }))
+            except (requests.RequestException, ValueError, KeyError):
+                pass
+            self.stop.wait(HEALTH_POLL_INTERVAL)
+
+    def first_time(self, url, after, condition):
+        for t, servers in self.snapshots:
+            if t >= after and url in servers and condition(*servers[url]):
+                return t
+        return None
+
+
+def parse_schedule(text, replicas):
+    events = []
+    for item in filter(None, (part.strip() for part in text.split(','))):
+        at, action, number = item.split(':')
+        if action not in ('kill', 'stop', 'start'):
+            raise BenchError(f"Неизвестное действие в расписании: {action}")
+        index = int(number) - 1
+        if not 0 <= index < replicas:
+            raise BenchError(f"Нет реплики с номером {number}")
+        events.append((float(at), action, index))
+    return sorted(events)
+
+
+def default_schedule(replicas, duration):
+    """Отказ и возврат первой реплики, затем одновременный отказ двух (если реплик больше двух)"""
+    events = [(duration * 0.2, 'kill', 0), (duration * 0.4, 'start', 0)]
+    if replicas > 2:
+        events += [(duration * 0.6, 'kill', 1), (duration * 0.6, 'kill', 2),
+                   (duration * 0.8, 'start', 1), (duration * 0.8, 'start', 2)]
+    elif replicas == 2:
+        events += [(duration * 0.6, 'kill', 1), (duration * 0.8, 'start', 1)]
+    return events
+
+
+def wait_ready(url, check, timeout=READY_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            response = requests.get(f'{url}/api/health', timeout=1)
+            if response.status_code == 200 and check(response.json()):
+                return True
+        except (requests.RequestException, ValueError):
+            pass
+        time.sleep(0.1)
+    return False
+
+
+def start_coordinator(config, replicas, log_path):
+    env = dict(os.environ)
+    env.update({
+        'BACKENDS': ','.join(replica.url for replica in replicas),
+        'COORDINATOR_PORT': str(config.coordinator_port),
+        'COORDINATOR_DEBUG': '0',
+        'PYTHONUNBUFFERED': '1',
+    })
+    with open(log_path, 'ab') as output:
+        return subprocess.Popen([sys.executable, config.coordinator], env=env, stdout=output,
+                                stderr=subprocess.STDOUT, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+def drive_load(user, interval, deadline, stop, size):
+    """Открытая модель нагрузки: запросы по расписанию с шагом interval, независимо от ответов"""
+    next_send = time.perf_counter()
+    while not stop.is_set() and next_send < deadline:
+        delay = next_send - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        user.recorder.intended = next_send
+        user.data(size)
+        next_send += interval
+
+
+def window_stats(samples, slow_ms):
+    latencies = sorted(latency for _, latency, ok in samples if ok)
+    errors = sum(1 for _, _, ok in samples if not ok)
+    slow = sum(1 for _, latency, ok in samples if ok and latency > slow_ms)
+    return {
+        'requests': len(samples),
+        'errors': errors,
+        'error_rate': round(errors / len(samples), 4) if samples else 0.0,
+        'slow': slow,
+        'p50_ms': _round(percentile(latencies, 50)),
+        'p95_ms': _round(percentile(latencies, 95)),
+        'p99_ms': _round(percentile(latencies, 99)),
+    }
+
+
+def _round(value, digits=1):
+    return round(value, digits) if value is not None else None
+
+
+def analyze(samples, events, monitor, replicas, duration, slow_ms):
+    samples.sort()
+    first_event = events[0][0] if events else duration
+    # Норма — до первого события, без первой секунды (прогрев соединений)
+    baseline = window_stats([s for s in samples if 1.0 <= s[0] < first_event], float('inf'))
+    if slow_ms is None:
+        slow_ms = max(3 * (baseline['p95_ms'] or 0), 50.0)
+
+    results = []
+    for position, (at, action, index) in enumerate(events):
+        until = next((t for t, _, _ in events[position + 1:] if t > at), duration)
+        window = [s for s in samples if at <= s[0] < until]
+        stats = window_stats(window, slow_ms)
+        bad = [start + latency / 1000 for start, latency, ok in window if not ok or latency > slow_ms]
+        url = replicas[index].url
+        if action == 'start':
+            noticed = monitor.first_time(url, at, lambda status, circuit: status == 'up' and circuit != 'open')
+        else:
+            noticed = monitor.first_time(url, at, lambda status, circuit: status == 'down' or circuit == 'open')
+        results.append({
+            'at_s': round(at, 2),
+            'action': action,
+            'replica': replicas[index].replica_id,
+            'window_s': round(until - at, 2),
+            **stats,
+            'added_p95_ms': _round(stats['p95_ms'] - baseline['p95_ms'])
+            if stats['p95_ms'] is not None and baseline['p95_ms'] is not None else None,
+            'time_to_recover_s': round(max(bad) - at, 3) if bad else 0.0,
+            'coordinator_noticed_s': round(noticed - at, 3) if noticed is not None else None,
+        })
+
+    timeline = []
+    bucket_count = int(duration / BUCKET_SECONDS + 0.5)
+    for bucket in range(bucket_count):
+        start = bucket * BUCKET_SECONDS
+        stats = window_stats([s for s in samples if start <= s[0] < start + BUCKET_SECONDS], slow_ms)
+        timeline.append({'t_s': start, 'requests': stats['requests'], 'errors': stats['errors'],
+                         'p95_ms': stats['p95_ms']})
+
+    return {
+        'baseline': baseline,
+        'slow_ms': round(slow_ms, 1),
+        'events': results,
+        'total': window_stats(samples, slow_ms),
+        'timeline': timeline,
+    }
+
+
+def run_chaos(config):
+    if os.path.exists(CHAOS_DIR):
+        shutil.rmtree(CHAOS_DIR)
+    os.makedirs(CHAOS_DIR)
+    # Отдельное хранилище на прогон: MFA настраивается заново, чужие сессии не мешают
+    store_url = f"sqlite:///{os.path.join(CHAOS_DIR, 'state.db')}"
+    replicas = create_replicas(config.replicas, config.base_port, tls=False, workers=config.replica_workers,
+                               log_dir=CHAOS_DIR, store_url=store_url)
+    events = parse_schedule(config.schedule, config.replicas) if config.schedule \
+        else default_schedule(config.replicas, config.duration)
+    coordinator_url = f'http://localhost:{config.coordinator_port}'
+    coordinator = None
+
+    try:
+        print(f"🚀 Запуск {config.replicas} реплик и координатора ({config.coordinator}), журналы: {CHAOS_DIR}")
+        for replica in replicas:
+            replica.start()
+        for replica in replicas:
+            if not wait_ready(replica.url, lambda health: True):
+                raise BenchError(f"{replica.replica_id} не запустилась ({replica.url})")
+        coordinator = start_coordinator(config, replicas, os.path.join(CHAOS_DIR, 'coordinator.log'))
+        if not wait_ready(coordinator_url, lambda health: health.get('up_count') == len(replicas)):
+            raise BenchError("Координатор не увидел все реплики")
+
+        # Вход напрямую на первую реплику; cookie сессии принимают все реплики (общий ключ)
+        bench_config = SimpleNamespace(target=replicas[0].url, via=coordinator_url, verify=False,
+                                       format=config.format, totp_secret=None, tls_resume=True,
+                                       reconnect_every=0)
+        secret = ensure_mfa(bench_config)
+
+        recorders = [TimelineRecorder(0.0) for _ in range(config.concurrency)]
+        users = [VirtualUser(bench_config, secret, recorder, seed=index) for index, recorder in enumerate(recorders)]
+        for user in users:
+            if not user.login():
+                raise BenchError("Вход виртуального пользователя не удался")
+
+        origin = time.perf_counter()
+        for recorder in recorders:
+            recorder.samples.clear()
+            recorder.origin = origin
+        monitor = HealthMonitor(coordinator_url, origin)
+        monitor.thread.start()
+        deadline = origin + config.duration
+        stop = threading.Event()
+        interval = config.concurrency / config.rate
+        threads = [
+            threading.Thread(target=drive_load, args=(user, interval, deadline, stop, config.size), daemon=True)
+            for user in users
+        ]
+        for thread in threads:
+            thread.start()
+
+        print(f"🔥 Нагрузка {config.rate:g} запросов/с через координатор, {config.duration:g} с, событий: {len(events)}")
+        for at, action, index in events:
+            delay = origin + at - time.perf_counter()
+            if delay > 0:
+                stop.wait(delay)
+            replica = replicas[index]
+            if action == 'start':
+                replica.start()
+            else:
+                replica.stop(signal.SIGKILL if action == 'kill' else signal.SIGTERM)
+            print(f"   {time.perf_counter() - origin:6.1f} с  {action:<5} {replica.replica_id}")
+
+        for thread in threads:
+            thread.join()
+        monitor.stop.set()
+        monitor.thread.join()
+    finally:
+        if coordinator is not None and coordinator.poll() is None:
+            coordinator.terminate()
+            coordinator.wait()
+        for replica in replicas:
+            replica.stop()
+
+    samples = [sample for recorder in recorders for sample in recorder.samples]
+    report = analyze(samples, events, monitor, replicas, config.duration, config.slow_ms)
+    report['meta'] = {
+        'label': config.label,
+        'coordinator': config.coordinator,
+        'replicas': config.replicas,
+        'duration_s': config.duration,
+        'rate': config.rate,
+        'concurrency': config.concurrency,
+        'size': config.size,
+        'format': config.format,
+        'schedule': [f'{at:g}:{action}:{index + 1}' for at, action, index in events],
+        'coordinator_env': {key: value for key, value in os.environ.items()
+                            if key.startswith(('LB_', 'HEALTH_', 'CB_', 'HEDGE_', 'POOL_'))},
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+    }
+    return report
+
+
+def print_report(report):
+    baseline = report['baseline']
+    print(f"\nНорма: p50 {baseline['p50_ms']} мс, p95 {baseline['p95_ms']} мс; "
+          f"медленный ответ — дольше {report['slow_ms']} мс")
+    header = (f"{'с':>6} {'событие':<18}{'запросов':>9}{'ошибок':>8}{'доля':>8}"
+              f"{'p95 мс':>9}{'+p95 мс':>9}{'восст. с':>10}{'коорд. с':>10}")
+    print(header)
+    print('-' * len(header))
+    for e in report['events']:
+        cells = [e['p95_ms'], e['added_p95_ms'], e['time_to_recover_s'], e['coordinator_noticed_s']]
+        p95, added, ttr, noticed = [f"{v:>9.1f}" if isinstance(v, float) else f"{'-':>9}" for v in cells]
+        print(f"{e['at_s']:>6.1f} {e['action'] + ' ' + e['replica']:<18}{e['requests']:>9}{e['errors']:>8}"
+              f"{e['error_rate']:>8.2%}{p95}{added}{ttr:>10}{noticed:>10}")
+    total = report['total']
+    print(f"\nВсего: {total['requests']} запросов, ошибок {total['errors']} ({total['error_rate']:.2%}), "
+          f"p95 {total['p95_ms']} мс, p99 {total['p99_ms']} мс")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Сценарий отказов: убийство и перезапуск реплик под нагрузкой')
+    parser.add_argument('-n', '--replicas', type=int, default=3)
+    parser.add_argument('-d', '--duration', type=float, default=60)
+    parser.add_argument('--rate', type=float, default=100, help='запросов в секунду (суммарно)')
+    parser.add_argument('-c', '--concurrency', type=int, default=16, help='виртуальных пользователей')
+    parser.add_argument('--size', type=int, default=256, help='размер сообщения, байт')
+    parser.add_argument('--schedule', help='события "<с>:<kill|stop|start>:<реплика>,..."')
+    parser.add_argument('--coordinator', default='coordinator.py', choices=('coordinator.py', 'coordinator_async.py'))
+    parser.add_argument('--base-port', type=int, default=6100)
+    parser.add_argument('--coordinator-port', type=int, default=8100)
+    parser.add_argument('--replica-workers', type=int, default=0, help='воркеров gunicorn в реплике')
+    parser.add_argument('--slow-ms', type=float, help='порог медленного ответа (по умолчанию 3×p95 нормы)')
+    parser.add_argument('--format', choices=('json', 'msgpack'), default='msgpack' if wire.BINARY_AVAILABLE else 'json')
+    parser.add_argument('--label', default='chaos')
+    parser.add_argument('--output', help='файл результата JSON')
+    config = parser.parse_args(argv)
+
+    try:
+        report = run_chaos(config)
+    except BenchError as e:
+        print(f"❌ {e}")
+        return 2
+    print_report(report)
+    output = config.output or os.path.join(
+        BENCH_RESULTS_DIR, f"{config.label}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"\n💾 Результат: {output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,26 +1,171 @@
 import requests
-import ssl
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 import json
 import sys
 import time
 import os
-from cryptography.fernet import Fernet
-import pyotp
-import qrcode
-from PIL import Image
-import io
+import hashlib
+import wire
+from key_manager import get_key_manager
+from stream_crypto import encrypt_stream, CHUNK_SIZE, STREAM_CONTENT_TYPE
+from tls import create_client_context, mount_resuming_adapter
 import base64
+import random
+import threading
+from urllib.parse import urlsplit
+from collections import deque, namedtuple
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# pyotp и Pillow импортируются при первом использовании (настройка MFA),
+# чтобы короткие скриптовые запуски клиента стартовали быстрее
+
+# Потоков send_many по умолчанию (и размер пула соединений клиента)
+SEND_WORKERS = int(os.environ.get('CLIENT_SEND_WORKERS', 8))
+
+# Результат отправки одного сообщения из send_many: порядковый номер во входной
+# последовательности, успех, HTTP-статус, ответ сервера (для пакета — результат элемента), ошибка
+SendResult = namedtuple('SendResult', 'index ok status result error')
+
+
+def batch_send_results(index, count, status_code, results):
+    """SendResult for each of count messages of a batch; missing or malformed items become errors"""
+    results = results if isinstance(results, list) else []
+    send_results = []
+    for i in range(count):
+        item = results[i] if i < len(results) else None
+        if isinstance(item, dict):
+            send_results.append(SendResult(index + i, item.get('result') == 'ok', status_code, item, item.get('error')))
+        else:
+            send_results.append(SendResult(index + i, False, status_code, item, 'Missing result in batch response'))
+    return send_results
+
+# Отказоустойчивость: кроме server_url клиент может знать другие адреса — координатор
+# и серверы напрямую (CLIENT_ENDPOINTS через запятую). Запрос идет на лучший живой адрес;
+# неответивший адрес пропускается на время, растущее с числом отказов подряд.
+CLIENT_ENDPOINTS = [url.strip().rstrip('/') for url in os.environ.get('CLIENT_ENDPOINTS', '').split(',') if url.strip()]
+# Короткий таймаут соединения: до живого адреса клиент добирается за секунды, а не за 5–10 с на каждый
+CONNECT_TIMEOUT = float(os.environ.get('CLIENT_CONNECT_TIMEOUT', 1.0))
+# Кругов по всем адресам на один запрос и пауза между ними (экспоненциальная, со случайным разбросом)
+RETRY_ROUNDS = int(os.environ.get('CLIENT_RETRY_ROUNDS', 3))
+BACKOFF_BASE = float(os.environ.get('CLIENT_BACKOFF_BASE', 0.2))
+BACKOFF_MAX = float(os.environ.get('CLIENT_BACKOFF_MAX', 2.0))
+# Сколько секунд не предлагать адрес после отказа (удваивается с каждым отказом подряд, не больше 60)
+ENDPOINT_COOLDOWN = float(os.environ.get('CLIENT_ENDPOINT_COOLDOWN', 5.0))
+# Ответы, после которых запрос повторяется на другом адресе (только идемпотентные методы)
+RETRY_STATUSES = (502, 503, 504)
+# Предел времени на запрос со всеми повторами (секунды; не меньше таймаута одной попытки)
+REQUEST_DEADLINE = float(os.environ.get('CLIENT_REQUEST_DEADLINE', 15.0))
+# Методы, которые можно повторить, даже если сервер мог их уже выполнить
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+
+def request_not_sent(error):
+    """Ошибка до отправки запроса (соединение или TLS-рукопожатие не состоялись):
+    сервер его не получил, и повтор на другом адресе безопасен для любого метода"""
+    if isinstance(error, (requests.exceptions.ConnectTimeout, requests.exceptions.SSLError)):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError) and error.args:
+        return isinstance(getattr(error.args[0], 'reason', None), NewConnectionError)
+    return False
+
+
+class EndpointTable:
+    """Server addresses known to the client, ranked by health.
+
+    Live addresses keep their configured order (the coordinator, if listed first, stays
+    preferred); an address that failed is moved back until its cooldown ends."""
+
+    def __init__(self, urls):
+        self.lock = threading.Lock()
+        self.urls = []
+        self.state = {}
+        # (адрес, путь), которые адрес не обслуживает: координатор не принимает вход и MFA
+        self.unsupported = set()
+        for url in urls:
+            self.add(url)
+
+    def __len__(self):
+        return len(self.urls)
+
+    def add(self, url):
+        url = url.rstrip('/')
+        with self.lock:
+            if url in self.state:
+                return False
+            self.urls.append(url)
+            self.state[url] = {'failures': 0, 'down_until': 0.0, 'latency_ms': None}
+            return True
+
+    def ranked(self, path=None):
+        now = time.monotonic()
+        with self.lock:
+            candidates = [url for url in self.urls if (url, path) not in self.unsupported]
+            down_until = {url: self.state[url]['down_until'] for url in candidates}
+        return sorted(candidates, key=lambda url: (down_until[url] > now, max(down_until[url], now)))
+
+    def record_success(self, url, latency_ms):
+        with self.lock:
+            state = self.state[url]
+            state['failures'] = 0
+            state['down_until'] = 0.0
+            previous = state['latency_ms']
+            state['latency_ms'] = round(latency_ms if previous is None else 0.8 * previous + 0.2 * latency_ms, 2)
+
+    def record_failure(self, url):
+        with self.lock:
+            state = self.state[url]
+            state['failures'] += 1
+            cooldown = min(ENDPOINT_COOLDOWN * 2 ** (state['failures'] - 1), 60.0)
+            state['down_until'] = time.monotonic() + cooldown
+
+    def mark_unsupported(self, url, path):
+        with self.lock:
+            self.unsupported.add((url, path))
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self.lock:
+            return [{'url': url, 'status': 'down' if self.state[url]['down_until'] > now else 'up',
+                     'failures': self.state[url]['failures'], 'latency_ms': self.state[url]['latency_ms']}
+                    for url in self.urls]
+
 
 class SecureClient:
-    def __init__(self, server_url='https://localhost:5000'):
+    """Клиент с mTLS и двухфакторной аутентификацией.
+
+    Интерактивно (python client.py) коды MFA вводятся с клавиатуры. В скриптах передайте
+    totp — секрет TOTP (base32) или функцию totp(username) -> код, и verbose=False:
+    вход проходит без input(), а методы возвращают результаты, ничего не печатая."""
+
+    def __init__(self, server_url='https://localhost:5000', wire_format=None, totp=None, verbose=True,
+                 pool_size=SEND_WORKERS, endpoints=None):
         self.server_url = server_url
+        # server_url — первый (предпочтительный) адрес; затем остальные известные адреса
+        self.endpoints = EndpointTable([server_url] + list(CLIENT_ENDPOINTS if endpoints is None else endpoints))
+        self.totp = totp
+        self.verbose = verbose
+        self.pool_size = pool_size
+        # Секрет TOTP, выданный сервером при первой настройке MFA (в неинтерактивном режиме)
+        self.totp_secret = None
+        # Формат тела /api/data: msgpack, если доступен (с откатом на JSON), иначе JSON
+        self.wire_format = wire_format or ('msgpack' if wire.BINARY_AVAILABLE else 'json')
         self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=pool_size))
         self.cert_dir = 'certs'
         self.cert_file = os.path.join(self.cert_dir, 'client_cert.pem')
         self.key_file = os.path.join(self.cert_dir, 'client_key.pem')
         self.ca_cert = os.path.join(self.cert_dir, 'ca_cert.pem')
+        self.keys = get_key_manager('encryption_key.txt')
         self.session_token = None
         self.username = None
+        # Сертификат передается серверу в TLS-рукопожатии; в теле запроса — только
+        # если сервер его не видит (работа по HTTP)
+        self.send_certificate = False
+        self._certificate_pem = None
+        self.ssl_context = None
+        self.tls_adapter = None
         
         # Проверяем наличие файлов
         self.check_certificates()
@@ -28,6 +173,22 @@ class SecureClient:
         # Setup SSL context
         self.setup_ssl_context()
     
+    @property
+    def interactive(self):
+        """Коды MFA вводятся пользователем (источник TOTP не задан)"""
+        return self.totp is None
+    
+    def log(self, *args):
+        if self.verbose:
+            print(*args)
+    
+    def totp_code(self, username):
+        """Текущий код TOTP из секрета или функции, переданных в totp"""
+        if callable(self.totp):
+            return self.totp(username)
+        from pyotp import TOTP
+        return TOTP(self.totp).now()
+    
     def check_certificates(self):
         """Проверяем наличие необходимых сертификатов"""
         required_files = [self.cert_file, self.key_file, self.ca_cert]
@@ -48,43 +209,161 @@ class SecureClient:
     def setup_ssl_context(self):
         """Configure SSL context for mutual TLS"""
         try:
-            context = ssl.create_default_context()
-            context.load_cert_chain(self.cert_file, self.key_file)
-            context.load_verify_locations(self.ca_cert)
-            context.verify_mode = ssl.CERT_REQUIRED
-            
-            # Для тестирования, можно отключить проверку хоста
-            # context.check_hostname = False
+            # Новые соединения с тем же сервером возобновляют TLS-сессию без полной проверки сертификатов
+            self.ssl_context = create_client_context(self.cert_file, self.key_file, self.ca_cert)
+            self.tls_adapter = mount_resuming_adapter(self.session, 'https://', self.ssl_context,
+                                                      pool_maxsize=self.pool_size)
             
             # Настраиваем сессию requests
             self.session.verify = self.ca_cert
             self.session.cert = (self.cert_file, self.key_file)
-            print("✓ SSL контекст успешно настроен")
+            self.log("✓ SSL контекст успешно настроен")
         except Exception as e:
-            print(f"⚠️  Ошибка настройки SSL: {e}")
-            print("Запускаю клиент без SSL...")
+            self.log(f"⚠️  Ошибка настройки SSL: {e}")
+            self.log("Запускаю клиент без SSL...")
             # Если SSL не работает, переключаемся на HTTP
-            self.server_url = self.server_url.replace('https://', 'http://')
+            self.use_http()
+    
+    def tls_stats(self):
+        """TLS-рукопожатия клиента: всего, возобновленных сессий и их доля (None без TLS)"""
+        return self.tls_adapter.tls_stats() if self.tls_adapter else None
+    
+    def use_http(self):
+        """Перейти с https на http для основного адреса"""
+        url = self.server_url.replace('https://', 'http://')
+        self.endpoints = EndpointTable([url] + [other for other in self.endpoints.urls if other != self.server_url])
+        self.server_url = url
+    
+    def request(self, method, path, timeout=10, deadline=REQUEST_DEADLINE, **kwargs):
+        """HTTP request with failover across the endpoint table.
+
+        Endpoints are tried in health order with a short connect timeout. A request that never
+        reached a server (connection refused, connect timeout) moves on to the next endpoint;
+        read timeouts and 502/503/504 are retried elsewhere only for idempotent methods, since a
+        POST may already have been processed. After a round without an answer the client sleeps
+        (exponential backoff with full jitter) and tries again, all within `deadline` seconds.
+        The endpoint that answered becomes server_url; the session cookie is valid on every endpoint."""
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        finish_by = time.monotonic() + max(deadline, CONNECT_TIMEOUT + timeout)
+        last_error = None
+        last_response = None
+        for attempt in range(RETRY_ROUNDS):
+            if attempt:
+                pause = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+                if time.monotonic() + pause >= finish_by:
+                    break
+                time.sleep(pause)
+            for url in self.endpoints.ranked(path):
+                remaining = finish_by - time.monotonic()
+                if remaining <= 0:
+                    break
+                started = time.perf_counter()
+                try:
+                    response = self.session.request(method, f'{url}{path}',
+                                                    timeout=(min(CONNECT_TIMEOUT, remaining), min(timeout, remaining)),
+                                                    **kwargs)
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                    self.endpoints.record_failure(url)
+                    if not (idempotent or request_not_sent(e)):
+                        raise  # Сервер мог выполнить запрос — повтор дал бы дубликат
+                    last_error = e
+                    continue
+                if len(self.endpoints) > 1:
+                    if response.status_code in (404, 405):
+                        # Адрес не обслуживает этот путь (координатор и /api/login) — не спрашиваем его больше
+                        self.endpoints.mark_unsupported(url, path)
+                        last_response = response
+                        continue
+                    if response.status_code in RETRY_STATUSES:
+                        # Адрес неисправен — следующие запросы пойдут на другие, этот повторяем, только если можно
+                        self.endpoints.record_failure(url)
+                        if not idempotent:
+                            return response
+                        last_response = response
+                        continue
+                    self.share_cookies(url, response)
+                self.endpoints.record_success(url, (time.perf_counter() - started) * 1000)
+                if url != self.server_url:
+                    self.log(f"↪️  Переключение на {url}")
+                    self.server_url = url
+                return response
+        if last_response is not None:
+            return last_response
+        raise last_error or requests.exceptions.ConnectionError(f"Нет доступных адресов для {path}")
+    
+    def share_cookies(self, url, response):
+        """Cookie, выданные одним адресом, передаем и остальным хостам таблицы:
+        сессия Flask подписана общим ключом, и при переключении вход сохраняется"""
+        if not response.cookies:
+            return
+        source = urlsplit(url).hostname
+        hosts = {urlsplit(other).hostname for other in self.endpoints.urls} - {source}
+        for cookie in response.cookies:
+            for host in hosts:
+                self.session.cookies.set(cookie.name, cookie.value, domain=host, path=cookie.path)
+    
+    def probe_endpoints(self):
+        """Проверить все адреса параллельно (короткие таймауты) и упорядочить таблицу.
+        Серверы из ответа координатора добавляются в таблицу. Возвращает число живых адресов."""
+        def probe(url):
+            started = time.perf_counter()
+            try:
+                response = self.session.get(f'{url}/api/health', timeout=(CONNECT_TIMEOUT, 5))
+            except requests.exceptions.RequestException:
+                return url, None, None
+            return url, response, (time.perf_counter() - started) * 1000
+        
+        checked = set()
+        while True:
+            urls = [url for url in self.endpoints.urls if url not in checked]
+            if not urls:
+                break
+            checked.update(urls)
+            with ThreadPoolExecutor(max_workers=len(urls)) as pool:
+                results = list(pool.map(probe, urls))
+            for url, response, latency_ms in results:
+                if response is None or response.status_code != 200:
+                    self.endpoints.record_failure(url)
+                    self.log(f"✗ {url}: недоступен")
+                    continue
+                self.endpoints.record_success(url, latency_ms)
+                self.log(f"✓ {url}: доступен ({latency_ms:.0f} мс)")
+                try:
+                    servers = response.json().get('servers') or []
+                except ValueError:
+                    servers = []
+                for server in servers:
+                    if isinstance(server, dict) and server.get('server') and self.endpoints.add(server['server']):
+                        self.log(f"   + сервер от координатора: {server['server']}")
+        
+        live = [entry for entry in self.endpoints.snapshot() if entry['status'] == 'up']
+        if live:
+            self.server_url = self.endpoints.ranked()[0]
+        return len(live)
     
     def check_server_health(self):
         """Check if server is healthy"""
         try:
+            if len(self.endpoints) > 1:
+                return self.probe_endpoints() > 0
             response = self.session.get(f'{self.server_url}/api/health', timeout=5)
             if response.status_code == 200:
-                print(f"✓ Сервер доступен")
-                print(f"MFA поддерживается: {response.json().get('mfa_supported', False)}")
+                self.log(f"✓ Сервер доступен")
+                self.log(f"MFA поддерживается: {response.json().get('mfa_supported', False)}")
                 return True
             else:
-                print(f"✗ Ошибка сервера: {response.status_code}")
+                self.log(f"✗ Ошибка сервера: {response.status_code}")
                 return False
         except requests.exceptions.SSLError as e:
-            print(f"⚠️  SSL ошибка: {e}")
-            print("Попытка подключения без SSL...")
+            self.log(f"⚠️  SSL ошибка: {e}")
+            self.log("Попытка подключения без SSL...")
             # Пробуем HTTP
-            self.server_url = self.server_url.replace('https://', 'http://')
+            if not self.server_url.startswith('https://'):
+                return False
+            self.use_http()
             return self.check_server_health()
         except Exception as e:
-            print(f"✗ Не могу подключиться к серверу: {e}")
+            self.log(f"✗ Не могу подключиться к серверу: {e}")
             return False
     
     def login(self, username, password):
@@ -97,71 +376,83 @@ class SecureClient:
         }
         
         try:
-            response = self.session.post(
-                f'{self.server_url}/api/login',
+            response = self.request(
+                'POST', '/api/login',
                 json=login_data,
                 timeout=10
             )
             
-            print(f"Статус ответа: {response.status_code}")
+            self.log(f"Статус ответа: {response.status_code}")
             
             if response.status_code == 200:
                 result = response.json()
-                print(f"✓ Первый фактор аутентификации успешен")
-                print(f"Сообщение: {result.get('message')}")
+                self.log(f"✓ Первый фактор аутентификации успешен")
+                self.log(f"Сообщение: {result.get('message')}")
                 
                 if result.get('mfa_setup_required'):
-                    print("\n🔐 Требуется настройка двухфакторной аутентификации.")
-                    return self.setup_mfa(username, result['totp_secret'], result.get('qr_code'))
+                    self.log("\n🔐 Требуется настройка двухфакторной аутентификации.")
+                    if not self.setup_mfa(username, result['totp_secret'], result.get('qr_code_url')):
+                        return False
+                    if self.interactive:
+                        return True
+                    # Настройка MFA не открывает сессию — входим еще раз уже со вторым фактором
+                    return self.login(username, password)
                 elif result.get('mfa_required'):
-                    print("\n🔐 Требуется второй фактор (MFA).")
+                    self.log("\n🔐 Требуется второй фактор (MFA).")
                     return self.verify_mfa(username)
                 else:
-                    print("✓ Аутентификация завершена")
+                    self.log("✓ Аутентификация завершена")
                     return True
             else:
                 error_msg = response.json().get('error', 'Unknown error')
-                print(f"✗ Ошибка аутентификации: {error_msg}")
+                self.log(f"✗ Ошибка аутентификации: {error_msg}")
                 return False
                 
         except requests.exceptions.SSLError as e:
-            print(f"SSL Error: {e}")
+            self.log(f"SSL Error: {e}")
             return False
         except Exception as e:
-            print(f"Ошибка соединения: {e}")
+            self.log(f"Ошибка соединения: {e}")
             return False
     
-    def setup_mfa(self, username, totp_secret, qr_code_data=None):
+    def setup_mfa(self, username, totp_secret, qr_code_url=None):
         """Setup two-factor authentication"""
-        print(f"\n=== НАСТРОЙКА ДВУХФАКТОРНОЙ АУТЕНТИФИКАЦИИ ===")
-        print(f"Ваш секретный ключ: {totp_secret}")
-        print("\nИнструкции:")
-        print("1. Установите приложение-аутентификатор (Google Authenticator, Authy)")
-        print("2. Добавьте новый аккаунт")
-        print("3. Введите секретный ключ вручную или отсканируйте QR-код")
+        if not self.interactive:
+            return self.setup_mfa_scripted(username, totp_secret)
+        
+        self.log(f"\n=== НАСТРОЙКА ДВУХФАКТОРНОЙ АУТЕНТИФИКАЦИИ ===")
+        self.log(f"Ваш секретный ключ: {totp_secret}")
+        self.log("\nИнструкции:")
+        self.log("1. Установите приложение-аутентификатор (Google Authenticator, Authy)")
+        self.log("2. Добавьте новый аккаунт")
+        self.log("3. Введите секретный ключ вручную или отсканируйте QR-код")
         
-        if qr_code_data:
+        if qr_code_url:
             try:
-                # Сохраняем QR-код в файл
-                qr_img_data = base64.b64decode(qr_code_data)
+                # QR-код загружается отдельным запросом, ответ на вход остается компактным
+                response = self.session.get(f'{self.server_url}{qr_code_url}', timeout=10)
+                response.raise_for_status()
+                qr_img_data = response.content
                 with open('qr_code.png', 'wb') as f:
                     f.write(qr_img_data)
-                print(f"\nQR-код сохранен в файл: qr_code.png")
+                self.log(f"\nQR-код сохранен в файл: qr_code.png")
                 
                 # Пытаемся показать QR-код
                 try:
+                    from PIL import Image
                     img = Image.open('qr_code.png')
                     img.show()
-                    print("QR-код открыт в просмотрщике изображений")
+                    self.log("QR-код открыт в просмотрщике изображений")
                 except:
-                    print("Не удалось открыть QR-код. Откройте файл qr_code.png вручную")
+                    self.log("Не удалось открыть QR-код. Откройте файл qr_code.png вручную")
             except:
-                print("Не удалось сохранить QR-код")
+                self.log("Не удалось сохранить QR-код")
         
         # Генерируем тестовый токен
+        import pyotp
         totp = pyotp.TOTP(totp_secret)
         current_token = totp.now()
-        print(f"\nТекущий токен (для тестирования): {current_token}")
+        self.log(f"\nТекущий токен (для тестирования): {current_token}")
         
         # Запрашиваем токен у пользователя
         while True:
@@ -173,34 +464,59 @@ class SecureClient:
             }
             
             try:
-                response = self.session.post(
-                    f'{self.server_url}/api/mfa/setup',
+                response = self.request(
+                    'POST', '/api/mfa/setup',
                     json=setup_data,
                     timeout=10
                 )
                 
                 if response.status_code == 200:
-                    print("✓ Настройка MFA успешна!")
-                    print("✓ Двухфакторная аутентификация включена")
+                    self.log("✓ Настройка MFA успешна!")
+                    self.log("✓ Двухфакторная аутентификация включена")
                     return True
                 else:
                     error_msg = response.json().get('error', 'Unknown error')
-                    print(f"✗ Неверный токен: {error_msg}")
+                    self.log(f"✗ Неверный токен: {error_msg}")
                     
                     retry = input("Попробовать еще раз? (y/n): ")
                     if retry.lower() != 'y':
                         return False
                         
             except Exception as e:
-                print(f"Ошибка: {e}")
+                self.log(f"Ошибка: {e}")
                 return False
     
+    def setup_mfa_scripted(self, username, totp_secret):
+        """Настройка MFA без участия пользователя: код из выданного сервером секрета.
+        Секрет сохраняется в self.totp_secret — его нужно сохранить для следующих входов"""
+        from pyotp import TOTP
+        try:
+            response = self.request(
+                'POST', '/api/mfa/setup',
+                json={'username': username, 'token': TOTP(totp_secret).now()},
+                timeout=10
+            )
+        except requests.RequestException as e:
+            self.log(f"Ошибка: {e}")
+            return False
+        if response.status_code != 200:
+            self.log(f"✗ Настройка MFA не удалась: {response.status_code}")
+            return False
+        self.totp_secret = totp_secret
+        if not callable(self.totp):
+            self.totp = totp_secret
+        self.log("✓ Двухфакторная аутентификация включена")
+        return True
+    
     def verify_mfa(self, username):
         """Second factor: TOTP verification"""
-        print("\n=== ВТОРОЙ ФАКТОР АУТЕНТИФИКАЦИИ ===")
+        self.log("\n=== ВТОРОЙ ФАКТОР АУТЕНТИФИКАЦИИ ===")
         
         while True:
-            token = input("Введите 6-значный код из приложения-аутентификатора: ")
+            if self.interactive:
+                token = input("Введите 6-значный код из приложения-аутентификатора: ")
+            else:
+                token = self.totp_code(username)
             
             verify_data = {
                 'username': username,
@@ -208,8 +524,8 @@ class SecureClient:
             }
             
             try:
-                response = self.session.post(
-                    f'{self.server_url}/api/mfa/verify',
+                response = self.request(
+                    'POST', '/api/mfa/verify',
                     json=verify_data,
                     timeout=10
                 )
@@ -217,97 +533,256 @@ class SecureClient:
                 if response.status_code == 200:
                     result = response.json()
                     self.session_token = result.get('session_token')
-                    print("✓ Двухфакторная аутентификация успешна!")
-                    print(f"✓ Сессия активна {result.get('expires_in', 3600)} секунд")
+                    self.log("✓ Двухфакторная аутентификация успешна!")
+                    self.log(f"✓ Сессия активна {result.get('expires_in', 3600)} секунд")
                     return True
                 else:
                     error_msg = response.json().get('error', 'Unknown error')
-                    print(f"✗ Неверный токен: {error_msg}")
+                    self.log(f"✗ Неверный токен: {error_msg}")
                     
+                    if not self.interactive:
+                        return False
                     retry = input("Попробовать еще раз? (y/n): ")
                     if retry.lower() != 'y':
                         return False
                         
             except Exception as e:
-                print(f"Ошибка: {e}")
+                self.log(f"Ошибка: {e}")
                 return False
     
     def encrypt_data(self, data):
         """Encrypt data before sending"""
         try:
-            # Проверяем наличие ключа шифрования
-            if not os.path.exists('encryption_key.txt'):
-                print("⚠️  Ключ шифрования не найден. Создаю новый...")
-                key = Fernet.generate_key()
-                with open('encryption_key.txt', 'wb') as f:
-                    f.write(key)
-                print("✓ Новый ключ шифрования создан")
-            
-            # Загружаем ключ шифрования
-            with open('encryption_key.txt', 'rb') as f:
-                key = f.read()
-            
-            # Шифруем данные
-            cipher = Fernet(key)
-            encrypted = cipher.encrypt(data.encode())
+            # Ключ берется из кэша; файл перечитывается только при его изменении
+            encrypted = self.keys.encrypt(data.encode())
             return encrypted.decode('utf-8')
         except Exception as e:
-            print(f"⚠️  Ошибка шифрования: {e}")
-            print("Отправляю данные без шифрования")
+            self.log(f"⚠️  Ошибка шифрования: {e}")
+            self.log("Отправляю данные без шифрования")
             return data
     
+    def certificate_pem(self):
+        """Client certificate PEM, read from disk once (only needed without mTLS)"""
+        if self._certificate_pem is None:
+            try:
+                with open(self.cert_file, 'r') as f:
+                    self._certificate_pem = f.read()
+            except FileNotFoundError:
+                self.log("Ошибка: Клиентский сертификат не найден.")
+        return self._certificate_pem
+    
+    def post_data(self, path, build_payload, timeout=10):
+        """POST to a data endpoint in the negotiated wire format.
+        build_payload(content_type) returns the request dict; on 415 the client
+        falls back to JSON for good. Returns (status_code, decoded response)."""
+        while True:
+            content_type = wire.MSGPACK_CONTENT_TYPE if self.wire_format == 'msgpack' else wire.JSON_CONTENT_TYPE
+            payload = build_payload(content_type)
+            if self.send_certificate:
+                payload['certificate'] = self.certificate_pem()
+            response = self.request(
+                'POST', path,
+                data=wire.encode(payload, content_type),
+                headers={'Content-Type': content_type, 'Accept': content_type},
+                timeout=timeout
+            )
+            if response.status_code == 415 and self.wire_format != 'json':
+                self.log("⚠️  Сервер не поддерживает msgpack, переключаюсь на JSON")
+                self.wire_format = 'json'
+                continue
+            try:
+                result = wire.decode(response.headers.get('Content-Type'), response.content)
+            except Exception:
+                result = None
+            result = result if isinstance(result, dict) else {}
+            if (response.status_code == 401 and result.get('error') == 'Certificate required'
+                    and not self.send_certificate and self.certificate_pem() is not None):
+                # Сервер не видит сертификат в TLS-соединении (HTTP) — передаем его в теле
+                self.send_certificate = True
+                continue
+            return response.status_code, result
+    
     def send_secure_data(self, data):
-        """Send encrypted data with certificate authentication"""
+        """Send encrypted data; the certificate is authenticated by the mTLS channel"""
         if not self.session_token:
-            print("Ошибка: Не авторизован. Пожалуйста, сначала войдите в систему.")
-            return
-        
-        # Загружаем клиентский сертификат
-        try:
-            with open(self.cert_file, 'r') as f:
-                certificate = f.read()
-        except FileNotFoundError:
-            print("Ошибка: Клиентский сертификат не найден.")
+            self.log("Ошибка: Не авторизован. Пожалуйста, сначала войдите в систему.")
             return
         
         # Шифруем данные
         encrypted_data = self.encrypt_data(data)
-        print(f"✓ Данные зашифрованы")
+        self.log(f"✓ Данные зашифрованы")
         
-        # Подготавливаем запрос
-        request_data = {
-            'certificate': certificate,
-            'data': encrypted_data
-        }
+        try:
+            status_code, result = self.post_data('/api/data', lambda content_type: {
+                'data': wire.token_to_wire(encrypted_data, content_type)
+            })
+            
+            if status_code == 200:
+                self.log(f"✓ Данные успешно отправлены")
+                self.log(f"Ответ сервера: {result.get('message')}")
+                self.log(f"Пользователь: {result.get('user')}")
+                self.log(f"Время: {result.get('timestamp')}")
+                return result
+            else:
+                self.log(f"✗ Ошибка: {status_code}")
+                error_msg = result.get('error', 'Unknown error')
+                self.log(f"Сообщение: {error_msg}")
+                return None
+                
+        except requests.exceptions.SSLError as e:
+            self.log(f"SSL Error: {e}")
+        except Exception as e:
+            self.log(f"Ошибка соединения: {e}")
+    
+    def send_secure_data_batch(self, messages):
+        """Send many encrypted messages in one request; returns per-message results in order"""
+        if not self.session_token:
+            self.log("Ошибка: Не авторизован. Пожалуйста, сначала войдите в систему.")
+            return None
+        
+        items = [self.encrypt_data(message) for message in messages]
+        self.log(f"✓ Зашифровано сообщений: {len(items)}")
         
         try:
+            status_code, result = self.post_data('/api/data/batch', lambda content_type: {
+                'items': [wire.token_to_wire(item, content_type) for item in items]
+            }, timeout=30)
+            
+            if status_code == 200:
+                self.log(f"✓ Пакет обработан: {result.get('count')} сообщений, ошибок: {result.get('failed')}")
+                return result.get('results')
+            else:
+                self.log(f"✗ Ошибка: {status_code}")
+                error_msg = result.get('error', 'Unknown error')
+                self.log(f"Сообщение: {error_msg}")
+                return None
+                
+        except requests.exceptions.SSLError as e:
+            self.log(f"SSL Error: {e}")
+        except Exception as e:
+            self.log(f"Ошибка соединения: {e}")
+    
+    def send_many(self, messages, workers=None, batch_size=1, ordered=True):
+        """Send an iterable of messages concurrently; returns a generator of SendResult.
+
+        Messages are encrypted in the calling thread while up to `workers` requests are in
+        flight, and the input is read lazily (at most workers * 2 requests ahead), so it may be
+        an endless source. batch_size > 1 groups messages into /api/data/batch requests.
+        ordered=False yields results as soon as their requests complete.
+        Raises RuntimeError if the client is not logged in."""
+        if not self.session_token:
+            raise RuntimeError("Не авторизован: сначала войдите в систему (login/verify_mfa)")
+        return self._send_many(iter(messages), workers or self.pool_size, max(1, batch_size), ordered)
+    
+    def _send_many(self, messages, workers, batch_size, ordered):
+        pending = deque()
+        index = 0
+        exhausted = False
+        pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='send')
+        try:
+            while True:
+                # Пока сервер отвечает на отправленные запросы, шифруем и ставим в очередь следующие
+                while not exhausted and len(pending) < workers * 2:
+                    chunk = list(islice(messages, batch_size))
+                    if not chunk:
+                        exhausted = True
+                        break
+                    items = [self.encrypt_data(message) for message in chunk]
+                    pending.append(pool.submit(self._send_job, index, items, batch_size > 1))
+                    index += len(chunk)
+                if not pending:
+                    return
+                if ordered:
+                    done = [pending.popleft()]
+                else:
+                    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    done = [future for future in pending if future in finished]
+                    for future in done:
+                        pending.remove(future)
+                for future in done:
+                    yield from future.result()
+        finally:
+            # Генератор закрыт раньше времени — неотправленное отменяем, начатое дожидаемся
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=True)
+    
+    def _send_job(self, index, items, batch):
+        """One request of send_many: a list of SendResult for its messages"""
+        try:
+            if batch:
+                status_code, result = self.post_data('/api/data/batch', lambda content_type: {
+                    'items': [wire.token_to_wire(item, content_type) for item in items]
+                }, timeout=30)
+            else:
+                status_code, result = self.post_data('/api/data', lambda content_type: {
+                    'data': wire.token_to_wire(items[0], content_type)
+                })
+        except Exception as e:
+            return [SendResult(index + i, False, None, None, str(e)) for i in range(len(items))]
+        
+        if status_code != 200:
+            error_msg = result.get('error', 'Unknown error')
+            return [SendResult(index + i, False, status_code, result, error_msg) for i in range(len(items))]
+        if not batch:
+            return [SendResult(index, True, status_code, result, None)]
+        return batch_send_results(index, len(items), status_code, result.get('results'))
+    
+    def send_secure_stream(self, source, chunk_size=CHUNK_SIZE):
+        """Stream a large file (path or binary file object) with chunked encryption.
+        Data is read, encrypted and sent piece by piece, so memory does not depend on its size."""
+        if not self.session_token:
+            self.log("Ошибка: Не авторизован. Пожалуйста, сначала войдите в систему.")
+            return None
+        
+        headers = {'Content-Type': STREAM_CONTENT_TYPE}
+        if self.send_certificate or not self.server_url.startswith('https://'):
+            # Без mTLS серверу может понадобиться сертификат явно; повторить поток после отказа нельзя
+            certificate = self.certificate_pem()
+            if certificate is None:
+                return None
+            headers['X-Client-Certificate'] = base64.b64encode(certificate.encode()).decode()
+        
+        stream = open(source, 'rb') if isinstance(source, (str, os.PathLike)) else source
+        digest = hashlib.sha256()
+        
+        def read_chunks():
+            for chunk in iter(lambda: stream.read(chunk_size), b''):
+                digest.update(chunk)
+                yield chunk
+        
+        try:
+            # Генератор в data — requests отправит тело частями (chunked transfer)
             response = self.session.post(
-                f'{self.server_url}/api/data',
-                json=request_data,
-                timeout=10
+                f'{self.server_url}/api/data/stream',
+                data=encrypt_stream(read_chunks(), self.keys.keys()[0]),
+                headers=headers,
+                timeout=(10, 300)
             )
             
             if response.status_code == 200:
                 result = response.json()
-                print(f"✓ Данные успешно отправлены")
-                print(f"Ответ сервера: {result.get('message')}")
-                print(f"Пользователь: {result.get('user')}")
-                print(f"Время: {result.get('timestamp')}")
+                self.log(f"✓ Поток отправлен: {result.get('bytes')} байт, частей: {result.get('chunks')}")
+                if result.get('sha256') != digest.hexdigest():
+                    self.log("⚠️  Контрольная сумма на сервере не совпадает с отправленными данными")
                 return result
             else:
-                print(f"✗ Ошибка: {response.status_code}")
+                self.log(f"✗ Ошибка: {response.status_code}")
                 error_msg = response.json().get('error', 'Unknown error')
-                print(f"Сообщение: {error_msg}")
+                self.log(f"Сообщение: {error_msg}")
                 return None
                 
         except requests.exceptions.SSLError as e:
-            print(f"SSL Error: {e}")
+            self.log(f"SSL Error: {e}")
         except Exception as e:
-            print(f"Ошибка соединения: {e}")
+            self.log(f"Ошибка соединения: {e}")
+        finally:
+            if stream is not source:
+                stream.close()
     
     def test_connection(self):
         """Тестируем соединение с сервером"""
-        print("\n=== ТЕСТИРОВАНИЕ СОЕДИНЕНИЯ ===")
+        self.log("\n=== ТЕСТИРОВАНИЕ СОЕДИНЕНИЯ ===")
         
         # Пробуем разные протоколы
         test_urls = [
@@ -317,14 +792,14 @@ class SecureClient:
         
         for url in test_urls:
             try:
-                print(f"\nПопытка подключения к: {url}")
+                self.log(f"\nПопытка подключения к: {url}")
                 response = requests.get(url, timeout=5, verify=False)
-                print(f"Статус: {response.status_code}")
+                self.log(f"Статус: {response.status_code}")
                 if response.status_code == 200:
-                    print(f"Успешно! Ответ: {response.json()}")
+                    self.log(f"Успешно! Ответ: {response.json()}")
                     return url
             except Exception as e:
-                print(f"Ошибка: {e}")
+                self.log(f"Ошибка: {e}")
         
         return None
 
@@ -381,6 +856,13 @@ def main():
                     client.send_secure_data(data)
             elif choice == '2':
                 client.check_server_health()
+                stats = client.tls_stats()
+                if stats and stats['handshakes']:
+                    print(f"TLS: рукопожатий {stats['handshakes']}, из них с возобновлением сессии {stats['resumed']}")
+                if len(client.endpoints) > 1:
+                    for entry in client.endpoints.snapshot():
+                        marker = '→' if entry['url'] == client.server_url else ' '
+                        print(f" {marker} {entry['url']}: {entry['status']}, задержка {entry['latency_ms']} мс")
             elif choice == '3':
                 print("Выход...")
                 break
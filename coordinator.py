@@ -1,48 +1,915 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 import requests
+import wire
+import metrics
+from serving import serve, serve_requested, serve_workers
+from requests.adapters import HTTPAdapter
+from tls import create_client_context, ResumingHTTPAdapter
+import os
+import json
+import time
+import random
+import heapq
+import itertools
+import queue
+import socket
+import threading
+from collections import deque, namedtuple
+from http.cookiejar import DefaultCookiePolicy
+from concurrent.futures import ThreadPoolExecutor
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 
 app = Flask(__name__)
 
-# Используем HTTP для упрощения (серверы работают на HTTP в debug режиме)
-server_urls = ['http://localhost:5000', 'http://localhost:5001', 'http://localhost:5002']
+# server.py, server2.py и server3.py по умолчанию работают по HTTPS с mTLS: координатор
+# подключается к ним со своим сертификатом (CLIENT_CERT) и проверяет их по CA_CERT
+DEFAULT_SERVER_URLS = ['https://localhost:5000', 'https://localhost:5001', 'https://localhost:5002']
+# Список серверов: BACKENDS="url1,url2,..." или файл BACKENDS_FILE (его пишет backend.py)
+BACKENDS_FILE = os.environ.get('BACKENDS_FILE', 'backends.json')
+
+
+def load_server_urls():
+    """Адреса серверов из конфигурации; без нее — три сервера на портах 5000-5002"""
+    backends = os.environ.get('BACKENDS')
+    if backends:
+        return [url.strip().rstrip('/') for url in backends.split(',') if url.strip()]
+    if os.path.exists(BACKENDS_FILE):
+        with open(BACKENDS_FILE) as f:
+            urls = [url.rstrip('/') for url in json.load(f)['backends']]
+        if urls:
+            return urls
+    return list(DEFAULT_SERVER_URLS)
+
+
+server_urls = load_server_urls()
+
+COORDINATOR_PORT = int(os.environ.get('COORDINATOR_PORT', 8000))
+COORDINATOR_DEBUG = os.environ.get('COORDINATOR_DEBUG', '1') == '1'
+
+# Сертификаты для mTLS-соединений с серверами (создаются generate_certs.py)
+CERT_DIR = 'certs'
+CA_CERT = os.path.join(CERT_DIR, 'ca_cert.pem')
+# Собственный сертификат координатора (CN coordinator.local): серверы узнают по нему доверенный
+# прокси (TRUSTED_PROXIES) и берут сертификат клиента из запроса, а не из соединения
+CLIENT_CERT = os.environ.get('COORDINATOR_CERT', os.path.join(CERT_DIR, 'coordinator_cert.pem'))
+CLIENT_KEY = os.environ.get('COORDINATOR_KEY', os.path.join(CERT_DIR, 'coordinator_key.pem'))
+
+# Размер пула keep-alive соединений на сервер и время простоя до закрытия (секунды)
+POOL_SIZE = int(os.environ.get('POOL_SIZE', 32))
+POOL_IDLE_TIMEOUT = float(os.environ.get('POOL_IDLE_TIMEOUT', 60))
+
+# Интервал фоновой проверки серверов и таймаут одной проверки (секунды)
+HEALTH_CHECK_INTERVAL = float(os.environ.get('HEALTH_CHECK_INTERVAL', 2))
+HEALTH_CHECK_TIMEOUT = float(os.environ.get('HEALTH_CHECK_TIMEOUT', 2))
+
+# Кэш состояния серверов: url -> status ("up"/"down"/"unknown"), latency_ms, checked_at
+health_table = {
+    url: {"status": "unknown", "latency_ms": None, "checked_at": None}
+    for url in server_urls
+}
+health_lock = threading.Lock()
+
+# Стратегия балансировки: round_robin, least_outstanding, p2c_ewma
+LB_STRATEGY = os.environ.get('LB_STRATEGY', 'p2c_ewma')
+# Коэффициент сглаживания EWMA задержки (доля нового измерения)
+EWMA_ALPHA = float(os.environ.get('EWMA_ALPHA', 0.3))
+
+# Хеджирование: если основной сервер не ответил за p95 задержки, дубликат уходит на следующий.
+# HEDGE_BUDGET — доля дополнительной нагрузки (0.1 = не более 10% дублирующих запросов)
+HEDGE_ENABLED = os.environ.get('HEDGE_ENABLED', '0') == '1'
+HEDGE_BUDGET = float(os.environ.get('HEDGE_BUDGET', 0.1))
+HEDGE_MIN_DELAY_MS = float(os.environ.get('HEDGE_MIN_DELAY_MS', 10))
+HEDGE_DEFAULT_DELAY_MS = float(os.environ.get('HEDGE_DEFAULT_DELAY_MS', 200))
+# Число последних измерений для оценки p95 и минимум измерений для доверия к ней
+LATENCY_WINDOW = 200
+LATENCY_MIN_SAMPLES = 20
+FORWARD_TIMEOUT = 5
+BATCH_FORWARD_TIMEOUT = 30
+# Потоковая передача: размер части и таймаут ожидания данных от сервера
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_READ_TIMEOUT = 300
+
+# Заголовки клиента, которые передаются серверу (cookie несет сессию после MFA)
+PROXIED_HEADERS = ('Content-Type', 'Accept', 'Cookie', 'X-Client-Certificate')
+
+# Перенаправляемый запрос: путь, тело как есть, заголовки клиента и таймаут
+ProxyRequest = namedtuple('ProxyRequest', 'path body headers timeout')
+# Успешный ответ сервера: формат тела (JSON или msgpack) и разобранный результат
+# Ответ сервера, который передается клиенту: 200 (result — разобранное тело)
+# или 4xx (ошибка клиента — body передается как есть, на другие серверы не повторяем)
+BackendReply = namedtuple('BackendReply', 'status content_type result body')
+
+# Автомат защиты (circuit breaker): после CB_FAILURE_THRESHOLD ошибок подряд сервер
+# исключается на CB_COOLDOWN секунд, затем пропускается один пробный запрос
+CB_FAILURE_THRESHOLD = int(os.environ.get('CB_FAILURE_THRESHOLD', 3))
+CB_COOLDOWN = float(os.environ.get('CB_COOLDOWN', 10))
+
+
+class BackendStats:
+    """Живая статистика сервера: запросы в обработке и сглаженная задержка"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.outstanding = 0
+        self.ewma_latency_ms = None
+        self.requests = 0
+        self.failures = 0
+        self.recent = deque(maxlen=LATENCY_WINDOW)
+
+    def start(self):
+        with self.lock:
+            self.outstanding += 1
+            self.requests += 1
+
+    def finish(self, latency_ms, ok=True):
+        with self.lock:
+            self.outstanding -= 1
+            if not ok:
+                self.failures += 1
+            else:
+                self.recent.append(latency_ms)
+            self.observe(latency_ms)
+
+    def abandon(self, elapsed_ms=None):
+        """Попытка отменена (проиграла хеджированному дубликату). elapsed_ms — сколько она
+        уже длилась: нижняя граница задержки сервера идет в EWMA (но не в p95), иначе
+        медленный сервер, чьи попытки всегда прерываются, выглядел бы быстрым"""
+        with self.lock:
+            self.outstanding -= 1
+            if elapsed_ms is not None:
+                self.observe(elapsed_ms)
+
+    def observe(self, latency_ms):
+        """Учет измерения задержки (вызывается под self.lock)"""
+        if self.ewma_latency_ms is None:
+            self.ewma_latency_ms = latency_ms
+        else:
+            self.ewma_latency_ms += EWMA_ALPHA * (latency_ms - self.ewma_latency_ms)
+
+    def percentile(self, q):
+        with self.lock:
+            samples = sorted(self.recent)
+        if len(samples) < LATENCY_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def hedge_delay(self):
+        """Задержка перед отправкой дубликата (секунды), по p95 успешных ответов"""
+        p95 = self.percentile(0.95)
+        delay_ms = HEDGE_DEFAULT_DELAY_MS if p95 is None else max(p95, HEDGE_MIN_DELAY_MS)
+        return delay_ms / 1000
+
+    def cost(self):
+        # Неизмеренный сервер считаем быстрым, чтобы он быстрее получил трафик
+        latency = self.ewma_latency_ms or 1.0
+        return latency * (self.outstanding + 1)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "outstanding": self.outstanding,
+                "ewma_latency_ms": round(self.ewma_latency_ms, 2) if self.ewma_latency_ms is not None else None,
+                "requests": self.requests,
+                "failures": self.failures
+            }
+
+
+_backend_tls_context = None
+_backend_tls_lock = threading.Lock()
+
+
+def backend_tls_context():
+    """mTLS-контекст соединений с серверами; хранит TLS-сессии для возобновления"""
+    global _backend_tls_context
+    with _backend_tls_lock:
+        if _backend_tls_context is None:
+            _backend_tls_context = create_client_context(CLIENT_CERT, CLIENT_KEY, CA_CERT)
+        return _backend_tls_context
+
+
+def backend_tls_stats():
+    return _backend_tls_context.stats() if _backend_tls_context is not None else None
+
+
+# Прерывание попытки из другого потока. При хеджировании основная попытка идет в потоке
+# запроса; если дубликат ответил раньше, этот поток нужно освободить — закрываем сокет
+# соединения, на котором он ждет ответа. Соединение попытки запоминается через пул urllib3.
+_attempt_local = threading.local()
+
+
+def _shutdown_connection(conn):
+    sock = getattr(conn, 'sock', None)
+    if sock is not None:
+        try:
+            # Закрываем сам сокет в обход SSLSocket: ожидающий поток получит ошибку чтения
+            socket.socket.shutdown(sock, socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class AttemptHandle:
+    """Cancellation handle of one backend attempt"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.conn = None
+
+    def bind(self, conn):
+        with self.lock:
+            self.conn = conn
+            cancelled = self.cancelled
+        if cancelled:
+            _shutdown_connection(conn)
+
+    def unbind(self, conn):
+        with self.lock:
+            if self.conn is conn:
+                self.conn = None
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            conn = self.conn
+        if conn is not None:
+            _shutdown_connection(conn)
+
+
+class CancellableConnectionMixin:
+    def connect(self):
+        super().connect()
+        handle = getattr(_attempt_local, 'handle', None)
+        if handle is not None:
+            handle.bind(self)
+
+
+class CancellablePoolMixin:
+    """Пул, связывающий выданное соединение с попыткой текущего потока (AttemptHandle)"""
+
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout)
+        handle = getattr(_attempt_local, 'handle', None)
+        if handle is not None:
+            handle.bind(conn)
+        return conn
+
+    def _put_conn(self, conn):
+        # Соединение возвращается в пул — отмена попытки больше не должна его трогать
+        handle = getattr(_attempt_local, 'handle', None)
+        if handle is not None and conn is not None:
+            handle.unbind(conn)
+        super()._put_conn(conn)
+
+
+class CancellableHTTPConnection(CancellableConnectionMixin, HTTPConnection):
+    pass
+
+
+class CancellableHTTPSConnection(CancellableConnectionMixin, HTTPSConnection):
+    pass
+
+
+class CancellableHTTPConnectionPool(CancellablePoolMixin, HTTPConnectionPool):
+    ConnectionCls = CancellableHTTPConnection
+
+
+class CancellableHTTPSConnectionPool(CancellablePoolMixin, HTTPSConnectionPool):
+    ConnectionCls = CancellableHTTPSConnection
+
+
+CANCELLABLE_POOL_CLASSES = {'http': CancellableHTTPConnectionPool, 'https': CancellableHTTPSConnectionPool}
+
+
+class BackendPool:
+    """Пул keep-alive соединений к одному серверу (с mTLS для https)"""
+
+    def __init__(self, url):
+        self.url = url
+        self.lock = threading.Lock()
+        self._session = None
+        self.last_used = 0.0
+
+    def _create_session(self):
+        session = requests.Session()
+        if self.url.startswith('https://'):
+            # Новые соединения пула возобновляют TLS-сессию с сервером (общий контекст, см. tls.py)
+            adapter = ResumingHTTPAdapter(backend_tls_context(), pool_connections=1, pool_maxsize=POOL_SIZE,
+                                          max_retries=0)
+        else:
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=0)
+        adapter.poolmanager.pool_classes_by_scheme = CANCELLABLE_POOL_CLASSES
+        session.mount(self.url, adapter)
+        # Сессия общая для всех клиентов координатора — cookie серверов в ней не сохраняем
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        if self.url.startswith('https://'):
+            # TLS-сессия устанавливается один раз на соединение и затем переиспользуется
+            session.cert = (CLIENT_CERT, CLIENT_KEY)
+            session.verify = CA_CERT
+        return session
+
+    def session(self, touch=True):
+        """Сессия пула; проверки здоровья (touch=False) не продлевают жизнь простаивающего пула"""
+        with self.lock:
+            if self._session is None:
+                self._session = self._create_session()
+            if touch:
+                self.last_used = time.monotonic()
+            return self._session
+
+    def evict_if_idle(self):
+        """Закрытие соединений, простаивающих дольше POOL_IDLE_TIMEOUT"""
+        with self.lock:
+            if self._session is None or time.monotonic() - self.last_used < POOL_IDLE_TIMEOUT:
+                return
+            session, self._session = self._session, None
+        session.close()
+
+
+class HedgeBudget:
+    """Бюджет хеджирования: каждый запрос дает HEDGE_BUDGET жетона, дубликат стоит один"""
+
+    def __init__(self, ratio, burst=10.0):
+        self.lock = threading.Lock()
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = 0.0
+        self.hedges_sent = 0
+        self.hedges_won = 0
+
+    def earn(self):
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def try_spend(self):
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            self.hedges_sent += 1
+            return True
+
+    def record_win(self):
+        with self.lock:
+            self.hedges_won += 1
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "enabled": HEDGE_ENABLED,
+                "budget": self.ratio,
+                "tokens": round(self.tokens, 2),
+                "hedges_sent": self.hedges_sent,
+                "hedges_won": self.hedges_won
+            }
+
+
+class CircuitBreaker:
+    """Автомат защиты сервера: closed -> open -> half_open -> closed/open"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, threshold, cooldown):
+        self.lock = threading.Lock()
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def _refresh(self):
+        """Переход open -> half_open по истечении паузы (вызывается под self.lock)"""
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = self.HALF_OPEN
+            self.trial_in_flight = False
+
+    def available(self):
+        """Можно ли рассматривать сервер как кандидата (без резервирования пробы)"""
+        with self.lock:
+            self._refresh()
+            if self.state == self.HALF_OPEN:
+                return not self.trial_in_flight
+            return self.state == self.CLOSED
+
+    def acquire(self):
+        """Разрешение на запрос; в half_open пропускается только один пробный запрос"""
+        with self.lock:
+            self._refresh()
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            return False
+
+    def release(self):
+        """Пробный запрос отменен без результата"""
+        with self.lock:
+            self.trial_in_flight = False
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def to_dict(self):
+        with self.lock:
+            self._refresh()
+            retry_in = None
+            if self.state == self.OPEN:
+                retry_in = round(max(0.0, self.cooldown - (time.monotonic() - self.opened_at)), 2)
+            return {"state": self.state, "failures": self.failures, "retry_in": retry_in}
+
+
+hedge_budget = HedgeBudget(HEDGE_BUDGET)
+breakers = {url: CircuitBreaker(CB_FAILURE_THRESHOLD, CB_COOLDOWN) for url in server_urls}
+backend_stats = {url: BackendStats() for url in server_urls}
+
+# Метрики для /metrics (общие с coordinator_async.py). Время попытки на сервере против полного
+# времени перенаправления показывает, сколько уходит на ожидание сервера, а сколько — на повторы
+BACKEND_SECONDS = metrics.histogram('coordinator_backend_duration_seconds',
+                                    'Ожидание ответа сервера на одну попытку (result: ok, rejected, error)',
+                                    ('backend', 'result'))
+FORWARD_SECONDS = metrics.histogram('coordinator_forward_duration_seconds',
+                                    'Полное время перенаправления, включая повторы на других серверах',
+                                    ('path', 'result'))
+FAILOVERS = metrics.counter('coordinator_failovers', 'Запросы, обслуженные не первым выбранным сервером', ('path',))
+metrics.gauge('coordinator_backend_up', 'Сервер доступен по фоновой проверке', ('backend',),
+              lambda: {(url,): int(health_table[url]["status"] == "up") for url in server_urls})
+metrics.gauge('coordinator_backend_outstanding', 'Запросы к серверу в обработке', ('backend',),
+              lambda: {(url,): backend_stats[url].outstanding for url in server_urls})
+metrics.gauge('coordinator_circuit_open', 'Автомат защиты сервера не в состоянии closed', ('backend',),
+              lambda: {(url,): int(breakers[url].to_dict()["state"] != CircuitBreaker.CLOSED) for url in server_urls})
+metrics.gauge('coordinator_tls_handshakes', 'TLS-рукопожатия с серверами (resumed — возобновленная сессия)',
+              ('resumed',), lambda: {('true',): (backend_tls_stats() or {}).get('resumed', 0),
+                                     ('false',): (backend_tls_stats() or {}).get('full', 0)})
+metrics.gauge('coordinator_hedges', 'Хеджирующие запросы процесса (sent — отправлено, won — успели первыми)',
+              ('kind',), lambda: {('sent',): hedge_budget.hedges_sent, ('won',): hedge_budget.hedges_won})
+backend_pools = {url: BackendPool(url) for url in server_urls}
+_rr_counter = itertools.count()
+
+
+def order_round_robin(candidates):
+    """Один номер счетчика на запрос: список серверов, сдвинутый на этот номер"""
+    start = next(_rr_counter) % len(candidates)
+    return candidates[start:] + candidates[:start]
+
+
+def pick_least_outstanding(candidates):
+    lowest = min(backend_stats[url].outstanding for url in candidates)
+    return random.choice([url for url in candidates if backend_stats[url].outstanding == lowest])
+
+
+def pick_p2c_ewma(candidates):
+    """Power of two choices: из двух случайных серверов берем с меньшей ценой"""
+    if len(candidates) == 1:
+        return candidates[0]
+    first, second = random.sample(candidates, 2)
+    return first if backend_stats[first].cost() <= backend_stats[second].cost() else second
+
+
+def order_by_picks(pick):
+    """Порядок попыток, в котором каждый следующий сервер выбирается pick из оставшихся"""
+    def order(candidates):
+        remaining = list(candidates)
+        while remaining:
+            url = pick(remaining)
+            remaining.remove(url)
+            yield url
+    return order
+
+
+# Стратегия получает список живых серверов и возвращает порядок попыток для одного запроса
+LB_STRATEGIES = {
+    'round_robin': order_round_robin,
+    'least_outstanding': order_by_picks(pick_least_outstanding),
+    'p2c_ewma': order_by_picks(pick_p2c_ewma),
+}
+
+if LB_STRATEGY not in LB_STRATEGIES:
+    raise ValueError(f"Неизвестная стратегия балансировки: {LB_STRATEGY}")
+
+
+def balanced_order(candidates, strategy=None):
+    """Порядок попыток для одного запроса по стратегии балансировки (по умолчанию LB_STRATEGY)"""
+    candidates = list(candidates)
+    if not candidates:
+        return iter(())
+    return iter(LB_STRATEGIES[strategy or LB_STRATEGY](candidates))
+
+
+_health_executor = ThreadPoolExecutor(max_workers=max(1, len(server_urls)), thread_name_prefix='health')
+# Только дубликаты: основная попытка выполняется в потоке запроса и не ждет очереди пула
+_hedge_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('HEDGE_WORKERS', 64)), thread_name_prefix='hedge')
+_prober_started = threading.Event()
+_prober_stop = threading.Event()
+
+
+def probe_server(url):
+    """Проверка одного сервера с замером задержки"""
+    started = time.perf_counter()
+    try:
+        response = backend_pools[url].session(touch=False).get(f"{url}/api/health", timeout=HEALTH_CHECK_TIMEOUT)
+        status = "up" if response.status_code == 200 else "down"
+    except requests.RequestException:
+        status = "down"
+    latency_ms = round((time.perf_counter() - started) * 1000, 2)
+    return {
+        "status": status,
+        "latency_ms": latency_ms if status == "up" else None,
+        "checked_at": time.time()
+    }
+
+
+def refresh_health():
+    """Параллельная проверка всех серверов и обновление кэша"""
+    apply_health_results(list(_health_executor.map(probe_server, server_urls)))
+
+
+def apply_health_results(results):
+    """Запись результатов проверки (в порядке server_urls) в кэш состояния"""
+    with health_lock:
+        for url, result in zip(server_urls, results):
+            health_table[url] = result
+
+    # Задержку проверки учитываем в EWMA, чтобы простаивающие серверы тоже имели оценку
+    for url, result in zip(server_urls, results):
+        if result["latency_ms"] is not None:
+            stats = backend_stats[url]
+            with stats.lock:
+                if stats.ewma_latency_ms is None:
+                    stats.observe(result["latency_ms"])
+
+
+def mark_server_down(url):
+    """Пассивная проверка: сервер не ответил на перенаправленный запрос"""
+    with health_lock:
+        health_table[url] = {"status": "down", "latency_ms": None, "checked_at": time.time()}
+
+
+def _health_loop():
+    while True:
+        try:
+            refresh_health()
+            for pool in backend_pools.values():
+                pool.evict_if_idle()
+        except Exception as e:
+            print(f"⚠️  Ошибка фоновой проверки серверов: {e}")
+        if _prober_stop.wait(HEALTH_CHECK_INTERVAL):
+            break
+
+
+def start_health_prober():
+    """Запуск фонового потока проверки серверов (повторный вызов ничего не делает)"""
+    if _prober_started.is_set():
+        return
+    _prober_started.set()
+    threading.Thread(target=_health_loop, name='health-prober', daemon=True).start()
+
+
+def live_servers():
+    """Серверы с незапертым автоматом защиты, не отмеченные как недоступные.
+    Если проверка здоровья отбраковала все — возвращаем всех допущенных автоматом (кэш мог устареть)"""
+    allowed = [url for url in server_urls if breakers[url].available()]
+    with health_lock:
+        alive = [url for url in allowed if health_table[url]["status"] != "down"]
+    return alive or allowed
+
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
-    """Проверка состояния всех серверов"""
-    results = []
-    
-    for url in server_urls:
-        try:
-            response = requests.get(f"{url}/api/health", timeout=2)
-            status = "up" if response.status_code == 200 else "down"
-            results.append({"server": url, "status": status})
-        except:
-            results.append({"server": url, "status": "down"})
-    
+    """Проверка состояния всех серверов (ответ из кэша фоновой проверки)"""
+    with health_lock:
+        results = [
+            {"server": url, **health_table[url]}
+            for url in server_urls
+        ]
+    for result in results:
+        result["stats"] = backend_stats[result["server"]].to_dict()
+        result["circuit"] = breakers[result["server"]].to_dict()
+
     return jsonify({
         "coordinator": "running",
         "servers": results,
-        "up_count": sum(1 for r in results if r["status"] == "up")
+        "up_count": sum(1 for r in results if r["status"] == "up"),
+        "check_interval": HEALTH_CHECK_INTERVAL,
+        "lb_strategy": LB_STRATEGY,
+        "hedging": hedge_budget.to_dict(),
+        "tls": backend_tls_stats()
     })
 
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+def backend_result(status_code):
+    """Метка исхода попытки: 4xx — ошибка клиента (сервер работает), 5xx — отказ сервера"""
+    if status_code == 200:
+        return 'ok'
+    return 'rejected' if status_code < 500 else 'error'
+
+
+def record_response(breaker, status_code):
+    """Ответы 5xx считаются отказом сервера, остальные (в т.ч. 401) — признаком работоспособности"""
+    if status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+
+
+def attempt_backend(url, proxy_request, handle=None):
+    """Один запрос к серверу с учетом статистики: BackendReply для 200 и 4xx,
+    None при ошибке соединения, таймауте или 5xx (тогда пробуем другой сервер).
+    handle (AttemptHandle) позволяет прервать попытку из другого потока"""
+    breaker = breakers[url]
+    if not breaker.acquire():
+        return None
+    stats = backend_stats[url]
+    stats.start()
+    started = time.perf_counter()
+    _attempt_local.handle = handle
+    try:
+        response = backend_pools[url].session().post(
+            f"{url}{proxy_request.path}",
+            data=proxy_request.body,
+            headers=proxy_request.headers,
+            timeout=proxy_request.timeout
+        )
+    except requests.RequestException:
+        if handle is not None and handle.cancelled:
+            # Прервана, потому что другой сервер уже ответил, — это не отказ сервера
+            stats.abandon((time.perf_counter() - started) * 1000)
+            breaker.release()
+            return None
+        elapsed = time.perf_counter() - started
+        stats.finish(elapsed * 1000, ok=False)
+        BACKEND_SECONDS.observe(elapsed, backend=url, result='error')
+        breaker.record_failure()
+        mark_server_down(url)
+        return None
+    finally:
+        _attempt_local.handle = None
+    elapsed = time.perf_counter() - started
+    stats.finish(elapsed * 1000, ok=response.status_code < 500)
+    BACKEND_SECONDS.observe(elapsed, backend=url, result=backend_result(response.status_code))
+    record_response(breaker, response.status_code)
+    if response.status_code >= 500:
+        return None
+    content_type = response.headers.get('Content-Type', wire.JSON_CONTENT_TYPE)
+    if response.status_code != 200:
+        return BackendReply(response.status_code, content_type, None, response.content)
+    return BackendReply(200, content_type, wire.decode(content_type, response.content), None)
+
+
+def forward_sequential(proxy_request):
+    """Перебор серверов по порядку балансировщика до первого успешного ответа"""
+    for index, url in enumerate(balanced_order(live_servers())):
+        reply = attempt_backend(url, proxy_request)
+        if reply is not None:
+            if index:
+                FAILOVERS.inc(path=proxy_request.path)
+            return url, reply
+    return None, None
+
+
+class HedgeTimers:
+    """Один поток на все таймеры хеджирования (вместо потока-таймера на каждый запрос)"""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.heap = []
+        self.seq = itertools.count()
+        self.thread = None
+
+    def call_later(self, delay, function):
+        entry = [time.monotonic() + delay, next(self.seq), function]
+        with self.cond:
+            # Поток создается при первом использовании — в каждом воркере после fork свой
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='hedge-timers', daemon=True)
+                self.thread.start()
+            heapq.heappush(self.heap, entry)
+            self.cond.notify()
+        return entry
+
+    @staticmethod
+    def cancel(entry):
+        entry[2] = None
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.heap or self.heap[0][0] > time.monotonic():
+                    self.cond.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+                function = heapq.heappop(self.heap)[2]
+            if function is not None:
+                try:
+                    function()
+                except Exception as e:
+                    print(f"⚠️  Ошибка запуска дубликата: {e}")
+
+
+hedge_timers = HedgeTimers()
+
+
+class HedgeRace:
+    """Дубликаты одного хеджированного запроса: выполняются в пуле, результаты — в очереди"""
+
+    def __init__(self, candidates, proxy_request):
+        self.lock = threading.Lock()
+        self.candidates = list(candidates)
+        self.proxy_request = proxy_request
+        self.primary = AttemptHandle()
+        self.hedges = {}
+        self.results = queue.SimpleQueue()
+        self.closed = False
+
+    def launch_hedge(self):
+        """Таймер: основной сервер медлит — дубликат на следующий, если позволяет бюджет"""
+        with self.lock:
+            if self.closed or not self.candidates or not hedge_budget.try_spend():
+                return
+            url = self.candidates.pop(0)
+            handle = self.hedges[url] = AttemptHandle()
+        _hedge_executor.submit(self._run_hedge, url, handle)
+
+    def _run_hedge(self, url, handle):
+        reply = None
+        try:
+            reply = attempt_backend(url, self.proxy_request, handle)
+        finally:
+            self.results.put((url, reply))
+        if reply is not None:
+            # Дубликат ответил первым — освобождаем поток запроса, ждущий основной сервер
+            self.primary.cancel()
+
+    def close(self):
+        """Новых дубликатов больше не будет; возвращает число запущенных"""
+        with self.lock:
+            self.closed = True
+            return len(self.hedges)
+
+    def first_reply(self, launched):
+        for _ in range(launched):
+            url, reply = self.results.get()
+            if reply is not None:
+                return url, reply
+        return None, None
+
+    def cancel_hedges(self):
+        with self.lock:
+            handles = list(self.hedges.values())
+        for handle in handles:
+            handle.cancel()
+
+
+def forward_hedged(proxy_request):
+    """Хеджированный запрос: основная попытка — в потоке запроса; если сервер медлит дольше p95
+    (отсчет от начала самой попытки), дубликат на следующий сервер уходит в пул. Побеждает
+    ответивший первым, проигравшая попытка прерывается"""
+    order = list(balanced_order(live_servers()))
+    if not order:
+        return None, None
+    hedge_budget.earn()
+    race = HedgeRace(order[1:], proxy_request)
+    timer = hedge_timers.call_later(backend_stats[order[0]].hedge_delay(), race.launch_hedge)
+    reply = attempt_backend(order[0], proxy_request, race.primary)
+    hedge_timers.cancel(timer)
+    launched = race.close()
+    if reply is not None:
+        race.cancel_hedges()
+        return order[0], reply
+
+    # Основная попытка не удалась или прервана ответившим дубликатом
+    url, reply = race.first_reply(launched)
+    if reply is not None:
+        FAILOVERS.inc(path=proxy_request.path)
+        hedge_budget.record_win()
+        return url, reply
+
+    # Все завершившиеся попытки неудачны — перебираем оставшиеся серверы по порядку
+    for url in race.candidates:
+        reply = attempt_backend(url, proxy_request)
+        if reply is not None:
+            FAILOVERS.inc(path=proxy_request.path)
+            return url, reply
+    return None, None
+
+
+def forward(path, timeout=FORWARD_TIMEOUT):
+    """Перенаправление текущего запроса: тело (JSON или msgpack) передается как есть, без разбора"""
+    headers = {name: request.headers[name] for name in PROXIED_HEADERS if name in request.headers}
+    proxy_request = ProxyRequest(path, request.get_data(), headers, timeout)
+
+    started = time.perf_counter()
+    if HEDGE_ENABLED:
+        url, reply = forward_hedged(proxy_request)
+    else:
+        url, reply = forward_sequential(proxy_request)
+    FORWARD_SECONDS.observe(time.perf_counter() - started, path=path,
+                            result=backend_result(reply.status) if reply is not None else 'unavailable')
+
+    if reply is not None and reply.status != 200:
+        # Ошибка клиента (нет сессии, неверное тело, слишком большой пакет) — передаем как есть
+        return Response(reply.body, status=reply.status, content_type=reply.content_type,
+                        headers={'X-Processed-By': url})
+    if reply is not None:
+        reply.result["processed_by"] = url  # Добавляем информацию о сервере
+        # Ответ в том же формате, в котором его вернул сервер
+        return Response(wire.encode(reply.result, reply.content_type), status=200,
+                        content_type=reply.content_type)
+
+    return jsonify({"error": "All servers are down"}), 503
+
+
+def pick_stream_backend():
+    """Сервер для потоковой передачи. Тело потока читается один раз, поэтому
+    повторить его на другом сервере нельзя — берем первый допущенный автоматом защиты"""
+    for url in balanced_order(live_servers()):
+        if breakers[url].acquire():
+            return url
+    return None
+
+
+@app.route('/api/data/stream', methods=['POST'])
+def forward_stream():
+    """Потоковое перенаправление: тело передается серверу частями, без буферизации"""
+    url = pick_stream_backend()
+    if url is None:
+        return jsonify({"error": "All servers are down"}), 503
+
+    headers = {name: request.headers[name] for name in PROXIED_HEADERS if name in request.headers}
+    body = iter(lambda: request.stream.read(STREAM_CHUNK_SIZE), b'')
+    stats = backend_stats[url]
+    stats.start()
+    started = time.perf_counter()
+    try:
+        response = backend_pools[url].session().post(
+            f"{url}/api/data/stream",
+            data=body,
+            headers=headers,
+            timeout=(FORWARD_TIMEOUT, STREAM_READ_TIMEOUT),
+            stream=True
+        )
+    except requests.RequestException:
+        elapsed = time.perf_counter() - started
+        stats.finish(elapsed * 1000, ok=False)
+        BACKEND_SECONDS.observe(elapsed, backend=url, result='error')
+        breakers[url].record_failure()
+        mark_server_down(url)
+        return jsonify({"error": "Server failed during stream upload", "server": url}), 502
+    elapsed = time.perf_counter() - started
+    stats.finish(elapsed * 1000, ok=response.status_code < 500)
+    BACKEND_SECONDS.observe(elapsed, backend=url, result=backend_result(response.status_code))
+    record_response(breakers[url], response.status_code)
+
+    def relay():
+        try:
+            yield from response.iter_content(STREAM_CHUNK_SIZE)
+        finally:
+            response.close()
+
+    return Response(
+        relay(),
+        status=response.status_code,
+        content_type=response.headers.get('Content-Type'),
+        headers={'X-Processed-By': url}
+    )
+
+
 @app.route('/api/data', methods=['POST'])
 def forward_request():
     """Перенаправление запроса на рабочий сервер"""
-    data = request.get_json()
-    
-    for url in server_urls:
-        try:
-            response = requests.post(f"{url}/api/data", json=data, timeout=5)
-            if response.status_code == 200:
-                result = response.json()
-                result["processed_by"] = url  # Добавляем информацию о сервере
-                return jsonify(result), 200
-        except:
-            continue  # Пробуем следующий сервер
-    
-    return jsonify({"error": "All servers are down"}), 503
+    return forward('/api/data')
+
+
+@app.route('/api/data/batch', methods=['POST'])
+def forward_batch():
+    """Перенаправление пакета зашифрованных сообщений на рабочий сервер"""
+    return forward('/api/data/batch', timeout=BATCH_FORWARD_TIMEOUT)
 
 if __name__ == '__main__':
-    print("🚀 Координатор запущен на порту 8000")
+    print(f"🚀 Координатор запущен на порту {COORDINATOR_PORT}")
     print("📡 Управляет серверами:", server_urls)
-    app.run(host='0.0.0.0', port=8000, debug=True)
+    print(f"⚖️  Стратегия балансировки: {LB_STRATEGY}")
+    if HEDGE_ENABLED:
+        print(f"🎯 Хеджирование запросов включено (бюджет {HEDGE_BUDGET:.0%})")
+    print(f"🩺 Фоновая проверка серверов каждые {HEALTH_CHECK_INTERVAL} с")
+    if serve_requested():
+        # Потоки не переживают fork — фоновая проверка запускается в каждом воркере
+        serve(app, COORDINATOR_PORT, serve_workers(), post_fork=lambda worker: start_health_prober())
+    else:
+        start_health_prober()
+        app.run(host='0.0.0.0', port=COORDINATOR_PORT, debug=COORDINATOR_DEBUG)
@@ -0,0 +1,331 @@
+import asyncio
+import os
+import ssl
+import time
+
+from aiohttp import web, ClientSession, ClientTimeout, TCPConnector, ClientError, DummyCookieJar
+
+import wire
+import metrics
+from serving import serve, serve_requested, serve_workers
+from coordinator import (
+    server_urls, health_table, health_lock, backend_stats, balanced_order, live_servers, apply_health_results,
+    mark_server_down, HEALTH_CHECK_INTERVAL, HEALTH_CHECK_TIMEOUT, POOL_SIZE, POOL_IDLE_TIMEOUT,
+    CA_CERT, CLIENT_CERT, CLIENT_KEY, LB_STRATEGY, FORWARD_TIMEOUT, BATCH_FORWARD_TIMEOUT, HEDGE_ENABLED,
+    hedge_budget, PROXIED_HEADERS, ProxyRequest, BACKEND_SECONDS, FORWARD_SECONDS, FAILOVERS,
+    breakers, record_response, backend_result, COORDINATOR_PORT, pick_stream_backend, BackendReply, STREAM_CHUNK_SIZE, STREAM_READ_TIMEOUT
+)
+
+# Асинхронный вариант координатора: тот же контракт /api/health и /api/data,
+# но запросы к серверам не занимают поток на время ожидания ответа.
+
+# Ограничение числа одновременно обрабатываемых запросов и размера тела запроса
+MAX_INFLIGHT = int(os.environ.get('MAX_INFLIGHT', 4096))
+MAX_BODY_SIZE = int(os.environ.get('MAX_BODY_SIZE', 1024 * 1024))
+
+
+class InflightCounter:
+    """Number of requests being forwarded. The app stores the object once in create_app();
+    handlers change its value, not the (already started) application mapping"""
+
+    def __init__(self):
+        self.value = 0
+
+
+# Ключи состояния приложения
+HTTP = web.AppKey('http', ClientSession)
+HEALTH_TASK = web.AppKey('health_task', asyncio.Task)
+INFLIGHT = web.AppKey('inflight', asyncio.Semaphore)
+INFLIGHT_COUNT = web.AppKey('inflight_count', InflightCounter)
+
+
+def create_ssl_context():
+    """mTLS-контекст для https-серверов (если есть сертификаты)"""
+    if not any(url.startswith('https://') for url in server_urls):
+        return None
+    context = ssl.create_default_context(cafile=CA_CERT)
+    if os.path.exists(CLIENT_CERT) and os.path.exists(CLIENT_KEY):
+        context.load_cert_chain(CLIENT_CERT, CLIENT_KEY)
+    return context
+
+
+async def probe_server(http, url):
+    """Проверка одного сервера с замером задержки"""
+    started = time.perf_counter()
+    try:
+        async with http.get(f"{url}/api/health", timeout=ClientTimeout(total=HEALTH_CHECK_TIMEOUT)) as response:
+            status = "up" if response.status == 200 else "down"
+    except (ClientError, asyncio.TimeoutError):
+        status = "down"
+    latency_ms = round((time.perf_counter() - started) * 1000, 2)
+    return {
+        "status": status,
+        "latency_ms": latency_ms if status == "up" else None,
+        "checked_at": time.time()
+    }
+
+
+async def health_loop(app):
+    http = app[HTTP]
+    while True:
+        try:
+            results = await asyncio.gather(*(probe_server(http, url) for url in server_urls))
+            apply_health_results(results)
+        except Exception as e:
+            # Ошибка одной проверки не должна останавливать фоновую проверку навсегда
+            print(f"⚠️  Ошибка фоновой проверки серверов: {e}")
+        await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+
+
+async def health_check(request):
+    """Проверка состояния всех серверов (ответ из кэша фоновой проверки)"""
+    with health_lock:
+        results = [
+            {"server": url, **health_table[url]}
+            for url in server_urls
+        ]
+    for result in results:
+        result["stats"] = backend_stats[result["server"]].to_dict()
+        result["circuit"] = breakers[result["server"]].to_dict()
+
+    return web.json_response({
+        "coordinator": "running",
+        "mode": "asyncio",
+        "servers": results,
+        "up_count": sum(1 for r in results if r["status"] == "up"),
+        "check_interval": HEALTH_CHECK_INTERVAL,
+        "lb_strategy": LB_STRATEGY,
+        "hedging": hedge_budget.to_dict(),
+        "inflight": request.app[INFLIGHT_COUNT].value
+    })
+
+
+async def metrics_endpoint(request):
+    return web.Response(text=metrics.render(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+def forward(path, timeout=FORWARD_TIMEOUT):
+    """Обработчик, перенаправляющий запрос по пути path на рабочий сервер"""
+    async def handler(request):
+        inflight = request.app[INFLIGHT_COUNT]
+        async with request.app[INFLIGHT]:
+            inflight.value += 1
+            try:
+                return await _forward(request, path, timeout)
+            finally:
+                inflight.value -= 1
+    return handler
+
+
+async def attempt_backend(http, url, proxy_request):
+    """Один запрос к серверу с учетом статистики: BackendReply для 200 и 4xx,
+    None при ошибке соединения, таймауте или 5xx (тогда пробуем другой сервер)"""
+    breaker = breakers[url]
+    if not breaker.acquire():
+        return None
+    stats = backend_stats[url]
+    stats.start()
+    started = time.perf_counter()
+    try:
+        async with http.post(f"{url}{proxy_request.path}", data=proxy_request.body,
+                             headers=proxy_request.headers,
+                             timeout=ClientTimeout(total=proxy_request.timeout)) as response:
+            status = response.status
+            reply = None
+            content_type = response.headers.get('Content-Type', wire.JSON_CONTENT_TYPE)
+            if status == 200:
+                reply = BackendReply(200, content_type, wire.decode(content_type, await response.read()), None)
+            elif status < 500:
+                reply = BackendReply(status, content_type, None, await response.read())
+    except asyncio.CancelledError:
+        stats.abandon((time.perf_counter() - started) * 1000)
+        breaker.release()
+        raise
+    except (ClientError, asyncio.TimeoutError, ValueError, wire.UnsupportedFormat):
+        elapsed = time.perf_counter() - started
+        stats.finish(elapsed * 1000, ok=False)
+        BACKEND_SECONDS.observe(elapsed, backend=url, result='error')
+        breaker.record_failure()
+        mark_server_down(url)
+        return None
+    elapsed = time.perf_counter() - started
+    stats.finish(elapsed * 1000, ok=status < 500)
+    BACKEND_SECONDS.observe(elapsed, backend=url, result=backend_result(status))
+    record_response(breaker, status)
+    return reply
+
+
+async def forward_sequential(http, proxy_request):
+    for index, url in enumerate(balanced_order(live_servers())):
+        reply = await attempt_backend(http, url, proxy_request)
+        if reply is not None:
+            if index:
+                FAILOVERS.inc(path=proxy_request.path)
+            return url, reply
+    return None, None
+
+
+async def forward_hedged(http, proxy_request):
+    """Хеджированный запрос: дубликат на следующий сервер, если основной медлит дольше p95"""
+    order = list(balanced_order(live_servers()))
+    if not order:
+        return None, None
+    hedge_budget.earn()
+    pending = {asyncio.create_task(attempt_backend(http, order[0], proxy_request)): order[0]}
+    next_index = 1
+    timeout = backend_stats[order[0]].hedge_delay()
+    hedged = False
+
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                if next_index < len(order) and hedge_budget.try_spend():
+                    task = asyncio.create_task(attempt_backend(http, order[next_index], proxy_request))
+                    pending[task] = order[next_index]
+                    next_index += 1
+                    hedged = True
+                timeout = None
+                continue
+
+            for task in done:
+                url = pending.pop(task)
+                reply = task.result()
+                if reply is not None:
+                    if url != order[0]:
+                        FAILOVERS.inc(path=proxy_request.path)
+                        if hedged:
+                            hedge_budget.record_win()
+                    return url, reply
+
+            if not pending and next_index < len(order):
+                task = asyncio.create_task(attempt_backend(http, order[next_index], proxy_request))
+                pending[task] = order[next_index]
+                next_index += 1
+    finally:
+        # Проигравшие попытки отменяем, в отличие от потоков их можно прервать
+        for task in pending:
+            task.cancel()
+
+    return None, None
+
+
+async def _forward(request, path, timeout):
+    # Тело (JSON или msgpack) передаем как есть, без разбора на стороне координатора
+    headers = {name: request.headers[name] for name in PROXIED_HEADERS if name in request.headers}
+    proxy_request = ProxyRequest(path, await request.read(), headers, timeout)
+    http = request.app[HTTP]
+
+    started = time.perf_counter()
+    if HEDGE_ENABLED:
+        url, reply = await forward_hedged(http, proxy_request)
+    else:
+        url, reply = await forward_sequential(http, proxy_request)
+    FORWARD_SECONDS.observe(time.perf_counter() - started, path=path,
+                            result=backend_result(reply.status) if reply is not None else 'unavailable')
+
+    if reply is not None and reply.status != 200:
+        # Ошибка клиента (нет сессии, неверное тело, слишком большой пакет) — передаем как есть
+        return web.Response(body=reply.body, status=reply.status, headers={
+            'Content-Type': reply.content_type, 'X-Processed-By': url
+        })
+    if reply is not None:
+        reply.result["processed_by"] = url  # Добавляем информацию о сервере
+        # Ответ в том же формате, в котором его вернул сервер
+        return web.Response(body=wire.encode(reply.result, reply.content_type),
+                            content_type=wire.media_type(reply.content_type))
+
+    return web.json_response({"error": "All servers are down"}, status=503)
+
+
+async def forward_stream(request):
+    """Потоковое перенаправление: тело передается серверу частями, без буферизации"""
+    url = pick_stream_backend()
+    if url is None:
+        return web.json_response({"error": "All servers are down"}, status=503)
+
+    headers = {name: request.headers[name] for name in PROXIED_HEADERS if name in request.headers}
+    timeout = ClientTimeout(total=None, sock_connect=FORWARD_TIMEOUT, sock_read=STREAM_READ_TIMEOUT)
+    stats = backend_stats[url]
+    breaker = breakers[url]
+    stats.start()
+    started = time.perf_counter()
+    response_started = False
+    try:
+        async with request.app[HTTP].post(f"{url}/api/data/stream", data=request.content,
+                                            headers=headers, timeout=timeout) as response:
+            elapsed = time.perf_counter() - started
+            stats.finish(elapsed * 1000, ok=response.status < 500)
+            BACKEND_SECONDS.observe(elapsed, backend=url, result=backend_result(response.status))
+            record_response(breaker, response.status)
+            response_started = True
+            out = web.StreamResponse(status=response.status, headers={
+                'Content-Type': response.headers.get('Content-Type', 'application/json'),
+                'X-Processed-By': url
+            })
+            await out.prepare(request)
+            async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                await out.write(chunk)
+            await out.write_eof()
+            return out
+    except asyncio.CancelledError:
+        if not response_started:
+            stats.abandon()
+            breaker.release()
+        raise
+    except (ClientError, asyncio.TimeoutError):
+        if response_started:
+            raise  # Сервер ответил, обрыв при передаче ответа клиенту
+        elapsed = time.perf_counter() - started
+        stats.finish(elapsed * 1000, ok=False)
+        BACKEND_SECONDS.observe(elapsed, backend=url, result='error')
+        breaker.record_failure()
+        mark_server_down(url)
+        return web.json_response({"error": "Server failed during stream upload", "server": url}, status=502)
+
+
+async def on_startup(app):
+    connector = TCPConnector(
+        limit=POOL_SIZE * len(server_urls),
+        limit_per_host=POOL_SIZE,
+        keepalive_timeout=POOL_IDLE_TIMEOUT,
+        ssl=create_ssl_context() or True
+    )
+    # Сессия общая для всех клиентов координатора — cookie серверов в ней не сохраняем
+    app[HTTP] = ClientSession(connector=connector, cookie_jar=DummyCookieJar())
+    app[HEALTH_TASK] = asyncio.create_task(health_loop(app))
+
+
+async def on_cleanup(app):
+    app[HEALTH_TASK].cancel()
+    await app[HTTP].close()
+
+
+def create_app():
+    app = web.Application(client_max_size=MAX_BODY_SIZE)
+    app[INFLIGHT] = asyncio.Semaphore(MAX_INFLIGHT)
+    app[INFLIGHT_COUNT] = InflightCounter()
+    app.router.add_get('/api/health', health_check)
+    app.router.add_get('/metrics', metrics_endpoint)
+    app.router.add_post('/api/data', forward('/api/data'))
+    app.router.add_post('/api/data/stream', forward_stream)
+    app.router.add_post('/api/data/batch', forward('/api/data/batch', timeout=BATCH_FORWARD_TIMEOUT))
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+async def app_factory():
+    return create_app()
+
+
+if __name__ == '__main__':
+    print(f"🚀 Асинхронный координатор запущен на порту {COORDINATOR_PORT}")
+    print("📡 Управляет серверами:", server_urls)
+    print(f"⚖️  Стратегия балансировки: {LB_STRATEGY}")
+    print(f"🔀 Одновременных запросов не более: {MAX_INFLIGHT}")
+    if serve_requested():
+        # Каждый воркер создает свое приложение, цикл событий и пул соединений
+        serve(app_factory, COORDINATOR_PORT, serve_workers(), worker_class='aiohttp.GunicornWebWorker')
+    else:
+        web.run_app(create_app(), host='0.0.0.0', port=COORDINATOR_PORT)
@@ -1,80 +1,275 @@
-import subprocess
 import os
+import sys
+import time
+import argparse
+import ipaddress
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
 
-def generate_certificates():
-    """Generate all necessary certificates"""
-    
-    # Create directory for certificates
-    cert_dir = 'certs'
+from cryptography import x509
+from cryptography.x509.oid import NameOID, ExtendedKeyUsageOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, ec, ed25519
+
+# Инфраструктура PKI без вызова openssl: CA, сертификат сервера и клиента, а также
+# сертификаты для каждой реплики (backend.py) и дополнительных клиентов.
+#
+#   python generate_certs.py                       # недостающие/истекающие сертификаты
+#   python generate_certs.py --servers 4 --clients 8 --key-type ed25519
+#   python generate_certs.py --force               # перевыпустить все, включая CA
+#
+# Повторный запуск перевыпускает только отсутствующие, истекающие (CERT_RENEW_DAYS),
+# выпущенные другим CA или с другим типом ключа сертификаты. Новый CA перевыпускает все.
+
+CERT_DIR = os.environ.get('CERT_DIR', 'certs')
+# Тип ключей: ecdsa (P-256, по умолчанию), ed25519 или rsa — ECDSA и Ed25519 создаются
+# за миллисекунды и дают более дешевое TLS-рукопожатие, чем RSA-4096
+CERT_KEY_TYPE = os.environ.get('CERT_KEY_TYPE', 'ecdsa')
+CERT_RSA_BITS = int(os.environ.get('CERT_RSA_BITS', 4096))
+CERT_DAYS = int(os.environ.get('CERT_DAYS', 365))
+CA_DAYS = int(os.environ.get('CA_DAYS', 3650))
+CERT_RENEW_DAYS = int(os.environ.get('CERT_RENEW_DAYS', 30))
+# Имена и адреса в SAN серверных сертификатов (клиенты проверяют по ним имя хоста)
+CERT_SERVER_HOSTS = os.environ.get('CERT_SERVER_HOSTS', 'localhost,server.local,127.0.0.1,::1').split(',')
+
+KEY_TYPES = ('ecdsa', 'ed25519', 'rsa')
+SUBJECT_BASE = [
+    x509.NameAttribute(NameOID.COUNTRY_NAME, 'RU'),
+    x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, 'Moscow'),
+    x509.NameAttribute(NameOID.LOCALITY_NAME, 'Moscow'),
+    x509.NameAttribute(NameOID.ORGANIZATION_NAME, 'DistributedSystems'),
+]
+
+# Выпускаемый сертификат: имя файлов (<name>_cert.pem, <name>_key.pem), CN и назначение
+CertSpec = namedtuple('CertSpec', 'name common_name purpose')
+
+
+def certificate_specs(servers=0, clients=0):
+    """server и client — для server.py/client.py, coordinator — для coordinator.py; replica-N — для реплик backend.py"""
+    specs = [CertSpec('server', 'server.local', 'server'), CertSpec('client', 'client.local', 'client'),
+             CertSpec('coordinator', 'coordinator.local', 'client')]
+    specs += [CertSpec(f'replica-{i}', f'replica-{i}', 'server') for i in range(1, servers + 1)]
+    specs += [CertSpec(f'client-{i}', f'client-{i}.local', 'client') for i in range(1, clients + 1)]
+    return specs
+
+
+def cert_paths(name, cert_dir=CERT_DIR):
+    return os.path.join(cert_dir, f'{name}_cert.pem'), os.path.join(cert_dir, f'{name}_key.pem')
+
+
+def generate_private_key_pem(key_type, rsa_bits=CERT_RSA_BITS):
+    """Новый закрытый ключ в PEM (выполняется в процессе пула — объекты ключей не сериализуются)"""
+    if key_type == 'rsa':
+        key = rsa.generate_private_key(public_exponent=65537, key_size=rsa_bits)
+    elif key_type == 'ecdsa':
+        key = ec.generate_private_key(ec.SECP256R1())
+    elif key_type == 'ed25519':
+        key = ed25519.Ed25519PrivateKey.generate()
+    else:
+        raise ValueError(f"Неизвестный тип ключа: {key_type} (допустимо: {', '.join(KEY_TYPES)})")
+    return key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                             serialization.NoEncryption())
+
+
+def generate_keys(count, key_type, rsa_bits=CERT_RSA_BITS):
+    """count ключей; RSA — параллельно в пуле процессов, остальные быстрее запуска пула"""
+    if key_type != 'rsa' or count < 2:
+        return [generate_private_key_pem(key_type, rsa_bits) for _ in range(count)]
+    with ProcessPoolExecutor(max_workers=min(count, os.cpu_count() or 1)) as pool:
+        return list(pool.map(generate_private_key_pem, [key_type] * count, [rsa_bits] * count))
+
+
+def key_type_of(key):
+    if isinstance(key, rsa.RSAPublicKey):
+        return 'rsa'
+    if isinstance(key, ec.EllipticCurvePublicKey):
+        return 'ecdsa'
+    if isinstance(key, ed25519.Ed25519PublicKey):
+        return 'ed25519'
+    return type(key).__name__
+
+
+def signature_hash(key_type):
+    # Ed25519 подписывает без отдельной хеш-функции
+    return None if key_type == 'ed25519' else hashes.SHA256()
+
+
+def load_pair(name, cert_dir=CERT_DIR):
+    """(сертификат, закрытый ключ) или None, если файлов нет или они не читаются"""
+    cert_path, key_path = cert_paths(name, cert_dir)
+    try:
+        with open(cert_path, 'rb') as f:
+            certificate = x509.load_pem_x509_certificate(f.read())
+        with open(key_path, 'rb') as f:
+            key = serialization.load_pem_private_key(f.read(), password=None)
+    except (OSError, ValueError):
+        return None
+    return certificate, key
+
+
+def _public_bytes(key):
+    return key.public_bytes(serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo)
+
+
+def reissue_reason(pair, key_type, renew_days, ca_certificate=None):
+    """Почему сертификат нужно выпустить заново (None — оставить как есть)"""
+    if pair is None:
+        return 'нет файлов'
+    certificate, key = pair
+    if _public_bytes(certificate.public_key()) != _public_bytes(key.public_key()):
+        return 'ключ не соответствует сертификату'
+    if key_type_of(certificate.public_key()) != key_type:
+        return f'тип ключа {key_type_of(certificate.public_key())}'
+    if certificate.not_valid_after - datetime.utcnow() < timedelta(days=renew_days):
+        return f'истекает {certificate.not_valid_after:%Y-%m-%d}'
+    if ca_certificate is not None:
+        try:
+            certificate.verify_directly_issued_by(ca_certificate)
+        except Exception:
+            return 'выпущен другим CA'
+    return None
+
+
+def build_ca(key, days=CA_DAYS):
+    name = x509.Name(SUBJECT_BASE + [x509.NameAttribute(NameOID.COMMON_NAME, 'RootCA')])
+    now = datetime.utcnow()
+    return (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - timedelta(minutes=5))
+        .not_valid_after(now + timedelta(days=days))
+        .add_extension(x509.BasicConstraints(ca=True, path_length=0), critical=True)
+        .add_extension(x509.KeyUsage(digital_signature=True, key_cert_sign=True, crl_sign=True,
+                                     content_commitment=False, key_encipherment=False, data_encipherment=False,
+                                     key_agreement=False, encipher_only=False, decipher_only=False), critical=True)
+        .add_extension(x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical=False)
+        .sign(key, signature_hash(key_type_of(key.public_key())))
+    )
+
+
+def subject_alt_names(spec):
+    names = []
+    for host in [spec.common_name] + CERT_SERVER_HOSTS:
+        host = host.strip()
+        if not host:
+            continue
+        try:
+            entry = x509.IPAddress(ipaddress.ip_address(host))
+        except ValueError:
+            entry = x509.DNSName(host)
+        if entry not in names:
+            names.append(entry)
+    return names
+
+
+def build_certificate(spec, key, ca_certificate, ca_key, days=CERT_DAYS):
+    now = datetime.utcnow()
+    usage = ExtendedKeyUsageOID.SERVER_AUTH if spec.purpose == 'server' else ExtendedKeyUsageOID.CLIENT_AUTH
+    builder = (
+        x509.CertificateBuilder()
+        .subject_name(x509.Name(SUBJECT_BASE + [x509.NameAttribute(NameOID.COMMON_NAME, spec.common_name)]))
+        .issuer_name(ca_certificate.subject)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - timedelta(minutes=5))
+        .not_valid_after(min(now + timedelta(days=days), ca_certificate.not_valid_after))
+        .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=True)
+        .add_extension(x509.ExtendedKeyUsage([usage]), critical=False)
+        .add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(ca_key.public_key()), critical=False)
+    )
+    if spec.purpose == 'server':
+        builder = builder.add_extension(x509.SubjectAlternativeName(subject_alt_names(spec)), critical=False)
+    return builder.sign(ca_key, signature_hash(key_type_of(ca_key.public_key())))
+
+
+def write_pair(name, certificate, key_pem, cert_dir=CERT_DIR):
+    cert_path, key_path = cert_paths(name, cert_dir)
+    # Ключ доступен только владельцу; запись через временный файл, чтобы не оставить половину PEM
+    tmp_key = f'{key_path}.tmp'
+    fd = os.open(tmp_key, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(key_pem)
+    os.replace(tmp_key, key_path)
+    tmp_cert = f'{cert_path}.tmp'
+    with open(tmp_cert, 'wb') as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    os.replace(tmp_cert, cert_path)
+
+
+def generate_certificates(servers=0, clients=0, key_type=CERT_KEY_TYPE, rsa_bits=CERT_RSA_BITS,
+                          force=False, renew_days=CERT_RENEW_DAYS, cert_dir=CERT_DIR):
+    """Generate missing or expiring certificates; returns {name: 'issued'|'kept'}"""
+    if key_type not in KEY_TYPES:
+        raise ValueError(f"Неизвестный тип ключа: {key_type} (допустимо: {', '.join(KEY_TYPES)})")
     if not os.path.exists(cert_dir):
         os.makedirs(cert_dir)
         print(f"📁 Создана директория: {cert_dir}")
-    
-    print("🔐 Генерация корневого сертификата CA...")
-    # Generate CA certificate
-    subprocess.run([
-        'openssl', 'req', '-x509', '-newkey', 'rsa:4096',
-        '-keyout', f'{cert_dir}/ca_key.pem',
-        '-out', f'{cert_dir}/ca_cert.pem',
-        '-days', '365', '-nodes',
-        '-subj', '/C=RU/ST=Moscow/L=Moscow/O=DistributedSystems/CN=RootCA'
-    ], check=True)
-    
-    print("\n�� Генерация серверного сертификата...")
-    # Generate server certificate
-    subprocess.run([
-        'openssl', 'req', '-newkey', 'rsa:4096',
-        '-keyout', f'{cert_dir}/server_key.pem',
-        '-out', f'{cert_dir}/server_req.pem',
-        '-nodes',
-        '-subj', '/C=RU/ST=Moscow/L=Moscow/O=DistributedSystems/CN=server.local'
-    ], check=True)
-    
-    subprocess.run([
-        'openssl', 'x509', '-req',
-        '-in', f'{cert_dir}/server_req.pem',
-        '-CA', f'{cert_dir}/ca_cert.pem',
-        '-CAkey', f'{cert_dir}/ca_key.pem',
-        '-CAcreateserial',
-        '-out', f'{cert_dir}/server_cert.pem',
-        '-days', '365'
-    ], check=True)
-    
-    print("\n🔐 Генерация клиентского сертификата...")
-    # Generate client certificate
-    subprocess.run([
-        'openssl', 'req', '-newkey', 'rsa:4096',
-        '-keyout', f'{cert_dir}/client_key.pem',
-        '-out', f'{cert_dir}/client_req.pem',
-        '-nodes',
-        '-subj', '/C=RU/ST=Moscow/L=Moscow/O=DistributedSystems/CN=client.local'
-    ], check=True)
-    
-    subprocess.run([
-        'openssl', 'x509', '-req',
-        '-in', f'{cert_dir}/client_req.pem',
-        '-CA', f'{cert_dir}/ca_cert.pem',
-        '-CAkey', f'{cert_dir}/ca_key.pem',
-        '-out', f'{cert_dir}/client_cert.pem',
-        '-days', '365'
-    ], check=True)
-    
-    # Clean up temporary files
-    temp_files = [f'{cert_dir}/server_req.pem', f'{cert_dir}/client_req.pem']
-    for temp_file in temp_files:
-        if os.path.exists(temp_file):
-            os.remove(temp_file)
-    
-    print("\n✅ Все сертификаты успешно сгенерированы!")
-    print("📁 Файлы созданы в директории 'certs/':")
-    print(f"   ├── ca_cert.pem")
-    print(f"   ├── ca_key.pem")
-    print(f"   ├── server_cert.pem")
-    print(f"   ├── server_key.pem")
-    print(f"   ├── client_cert.pem")
-    print(f"   └── client_key.pem")
+
+    ca_pair = None if force else load_pair('ca', cert_dir)
+    ca_reason = 'принудительно' if force else reissue_reason(ca_pair, key_type, renew_days)
+    specs = certificate_specs(servers, clients)
+    reasons = {}
+    for spec in specs:
+        if ca_reason:
+            reasons[spec.name] = 'новый CA'
+        else:
+            reasons[spec.name] = reissue_reason(load_pair(spec.name, cert_dir), key_type, renew_days, ca_pair[0])
+    to_issue = [spec for spec in specs if reasons[spec.name]]
+
+    # Все нужные ключи (включая ключ CA) создаются сразу, параллельно
+    key_pems = generate_keys(len(to_issue) + (1 if ca_reason else 0), key_type, rsa_bits)
+
+    if ca_reason:
+        ca_key_pem = key_pems.pop()
+        ca_key = serialization.load_pem_private_key(ca_key_pem, password=None)
+        ca_certificate = build_ca(ca_key)
+        write_pair('ca', ca_certificate, ca_key_pem, cert_dir)
+        print(f"🔐 Корневой сертификат CA выпущен ({ca_reason})")
+    else:
+        ca_certificate, ca_key = ca_pair
+
+    for spec, key_pem in zip(to_issue, key_pems):
+        key = serialization.load_pem_private_key(key_pem, password=None)
+        write_pair(spec.name, build_certificate(spec, key, ca_certificate, ca_key), key_pem, cert_dir)
+        print(f"🔐 {spec.name}: выпущен ({reasons[spec.name]})")
+
+    return {spec.name: 'issued' if reasons[spec.name] else 'kept' for spec in specs}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Генерация сертификатов PKI распределенной системы')
+    parser.add_argument('--servers', type=int, default=0, help='сертификаты для реплик replica-1..N (backend.py)')
+    parser.add_argument('--clients', type=int, default=0, help='дополнительные клиентские сертификаты client-1..M')
+    parser.add_argument('--key-type', choices=KEY_TYPES, default=CERT_KEY_TYPE)
+    parser.add_argument('--rsa-bits', type=int, default=CERT_RSA_BITS)
+    parser.add_argument('--renew-days', type=int, default=CERT_RENEW_DAYS,
+                        help='перевыпускать сертификаты, истекающие раньше, чем через столько дней')
+    parser.add_argument('--force', action='store_true', help='перевыпустить все сертификаты, включая CA')
+    parser.add_argument('--cert-dir', default=CERT_DIR)
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    try:
+        result = generate_certificates(args.servers, args.clients, args.key_type, args.rsa_bits,
+                                       args.force, args.renew_days, args.cert_dir)
+    except (ValueError, OSError) as e:
+        print(f"❌ {e}")
+        return 1
+    issued = [name for name, state in result.items() if state == 'issued']
+    kept = [name for name, state in result.items() if state == 'kept']
+
+    print(f"\n✅ Сертификаты готовы за {time.perf_counter() - started:.2f} с "
+          f"(тип ключей: {args.key_type}; выпущено: {len(issued)}, без изменений: {len(kept)})")
+    print(f"📁 Файлы в директории '{args.cert_dir}/': ca_cert.pem, ca_key.pem и <имя>_cert.pem/<имя>_key.pem для:")
+    for name in result:
+        print(f"   ├── {name}" + (" (без изменений)" if result[name] == 'kept' else ""))
+    return 0
+
 
 if __name__ == '__main__':
     print("=== Генерация SSL/TLS сертификатов для распределенной системы ===\n")
-    generate_certificates()
-
+    sys.exit(main())
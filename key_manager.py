@@ -0,0 +1,166 @@
+import os
+import sys
+import secrets
+import time
+import threading
+
+# Файл ключей: по одному ключу Fernet на строку, первый — основной (им шифруем),
+# остальные — предыдущие ключи, которыми еще можно расшифровать данные.
+ENCRYPTION_KEY_FILE = 'encryption_key.txt'
+
+# Как часто (секунды) проверять, не изменился ли файл ключей
+KEY_CHECK_INTERVAL = float(os.environ.get('KEY_CHECK_INTERVAL', 1.0))
+
+# Ключи подписи cookie-сессий Flask: переменная SECRET_KEY или отдельный файл с правами 0600
+# (не в хранилище рядом с пользователями и секретами TOTP). Формат как у файла ключей
+# шифрования: первый ключ подписывает, предыдущие принимаются, пока не истекут их сессии.
+SESSION_KEY_FILE = os.environ.get('SESSION_KEY_FILE', 'session_key.txt')
+
+
+class KeyManager:
+    """Process-wide cache of Fernet keys that reloads the key file when it changes"""
+
+    def __init__(self, path=ENCRYPTION_KEY_FILE, check_interval=KEY_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self._cipher = None
+        self._keys = []
+        self._signature = None
+        self._next_check = 0.0
+        self.reloads = 0
+
+    def _file_signature(self):
+        st = os.stat(self.path)
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _load(self):
+        """Read keys from disk (called under self.lock)"""
+        from cryptography.fernet import Fernet, MultiFernet
+        if not os.path.exists(self.path):
+            write_keys(self.path, [generate_key()])
+            print(f"🔑 Создан файл с ключом шифрования: {self.path}")
+        with open(self.path, 'rb') as f:
+            keys = [line.strip() for line in f.read().splitlines() if line.strip()]
+        if not keys:
+            raise ValueError(f"Файл {self.path} не содержит ключей")
+        self._signature = self._file_signature()
+        self._cipher = MultiFernet([Fernet(key) for key in keys])
+        self._keys = keys
+        self.reloads += 1
+
+    def cipher(self):
+        """Cached MultiFernet; the key file is stat'ed at most once per check_interval"""
+        now = time.monotonic()
+        if self._cipher is not None and now < self._next_check:
+            return self._cipher
+        with self.lock:
+            if self._cipher is None:
+                self._load()
+            elif now >= self._next_check:
+                try:
+                    changed = self._file_signature() != self._signature
+                except FileNotFoundError:
+                    changed = False  # Файл удален — продолжаем работать со старыми ключами
+                if changed:
+                    self._load()
+            self._next_check = now + self.check_interval
+            return self._cipher
+
+    def keys(self):
+        """Raw keys from the file, primary first (refreshed together with the cipher)"""
+        self.cipher()
+        return self._keys
+
+    def encrypt(self, data):
+        return self.cipher().encrypt(data)
+
+    def decrypt(self, token):
+        return self.cipher().decrypt(token)
+
+
+def generate_key():
+    from cryptography.fernet import Fernet
+    return Fernet.generate_key()
+
+
+def write_keys(path, keys, mode=None):
+    """Atomic write of the key file so readers never see a partial file.
+    mode (e.g. 0o600) sets the permissions of the new file"""
+    tmp_path = f"{path}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666 if mode is None else mode)
+    with os.fdopen(fd, 'wb') as f:
+        if mode is not None:
+            os.fchmod(f.fileno(), mode)
+        f.write(b'\n'.join(keys) + b'\n')
+    os.replace(tmp_path, path)
+
+
+def read_keys(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, 'rb') as f:
+        return [line.strip() for line in f.read().splitlines() if line.strip()]
+
+
+def rotate_keys(path=ENCRYPTION_KEY_FILE, keep=2):
+    """Add a new primary key, keeping up to `keep` keys in total for decryption"""
+    keys = [generate_key()] + read_keys(path)
+    write_keys(path, keys[:max(1, keep)])
+    return keys[0]
+
+
+def rotate_session_keys(path=SESSION_KEY_FILE, keep=2):
+    """Add a new primary session signing key (file mode 0600), keeping up to `keep` keys"""
+    keys = [secrets.token_hex(32).encode()] + read_keys(path)
+    write_keys(path, keys[:max(1, keep)], mode=0o600)
+    return keys[0]
+
+
+def load_session_keys(path=SESSION_KEY_FILE):
+    """Session signing keys, primary first: SECRET_KEY from the environment or the key file.
+    Raises RuntimeError if there is no key or the file is accessible to other users."""
+    secret = os.environ.get('SECRET_KEY')
+    if secret:
+        return [secret.encode()]
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        raise RuntimeError(f"Нет ключа подписи сессий: задайте SECRET_KEY или создайте {path} "
+                           f"командой python key_manager.py session-rotate") from None
+    if mode & 0o077:
+        raise RuntimeError(f"Файл {path} доступен другим пользователям (права {oct(mode & 0o777)}): "
+                           f"выполните chmod 600 {path}")
+    keys = read_keys(path)
+    if not keys:
+        raise RuntimeError(f"Файл {path} не содержит ключей")
+    return keys
+
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def get_key_manager(path=ENCRYPTION_KEY_FILE):
+    """Shared KeyManager for the given key file"""
+    manager = _managers.get(path)
+    if manager is None:
+        with _managers_lock:
+            manager = _managers.setdefault(path, KeyManager(path))
+    return manager
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 2 and sys.argv[1] == 'rotate':
+        keep = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+        rotate_keys(keep=keep)
+        print(f"🔄 Новый основной ключ добавлен в {ENCRYPTION_KEY_FILE} (хранится ключей: {keep})")
+        print("Запущенные процессы подхватят его без перезапуска")
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'session-rotate':
+        keep = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+        rotate_session_keys(keep=keep)
+        print(f"🔑 Новый ключ подписи сессий добавлен в {SESSION_KEY_FILE} (права 0600, хранится ключей: {keep})")
+        print("Серверы начнут подписывать им сессии после перезапуска; выданные старым ключом cookie еще действуют")
+    else:
+        print("Использование: python key_manager.py rotate [число_хранимых_ключей]")
+        print("               python key_manager.py session-rotate [число_хранимых_ключей]")
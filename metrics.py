@@ -0,0 +1,258 @@
+import os
+import json
+import time
+import threading
+from bisect import bisect_left
+
+# Метрики в формате Prometheus (text exposition 0.0.4) без внешних зависимостей:
+# счетчики, гистограммы времени и датчики (gauge), значения которых считаются при выдаче.
+# Обновление метрики — один захват блокировки и пара арифметических операций,
+# поэтому их можно оставлять включенными в боевом режиме (METRICS_ENABLED=0 — выключить).
+#
+# В режиме serve (несколько процессов-воркеров) каждый воркер раз в METRICS_FLUSH_INTERVAL
+# секунд сохраняет снимок своих счетчиков и гистограмм в METRICS_DIR, а /metrics любого
+# воркера складывает их — значения не зависят от того, какой воркер ответил.
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Границы корзин гистограмм (секунды): от 100 мкс до 10 с
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter with optional labels"""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = tuple([str(labels[name]) for name in self.labelnames])
+        with self.lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self._values)
+
+    @staticmethod
+    def merge(total, values):
+        for key, value in values.items():
+            total[key] = total.get(key, 0) + value
+
+    def render(self, values):
+        for key, value in sorted(values.items()):
+            yield f'{self.name}_total{_format_labels(self.labelnames, key)} {_format_value(value)}'
+
+
+class Timer:
+    """Context manager that observes the elapsed time into a histogram"""
+
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+class Histogram:
+    """Cumulative histogram of durations in seconds"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        # key -> [счетчики по корзинам (последняя — +Inf), сумма, количество]
+        self._values = {}
+
+    def observe(self, value, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = tuple([str(labels[name]) for name in self.labelnames])
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def snapshot(self):
+        with self.lock:
+            return {key: [list(counts), total, count] for key, (counts, total, count) in self._values.items()}
+
+    @staticmethod
+    def merge(total, values):
+        for key, (counts, value_sum, count) in values.items():
+            entry = total.get(key)
+            if entry is None:
+                total[key] = [list(counts), value_sum, count]
+            else:
+                entry[0] = [a + b for a, b in zip(entry[0], counts)]
+                entry[1] += value_sum
+                entry[2] += count
+
+    def render(self, values):
+        for key, (counts, value_sum, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _format_labels(self.labelnames, key)
+            yield f'{self.name}_sum{labels} {_format_value(value_sum)}'
+            yield f'{self.name}_count{labels} {count}'
+
+
+class Gauge:
+    """Current value computed at scrape time by a callback: fn() -> {label values tuple: value}.
+    Reported by the process serving the scrape only"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.function = function
+
+    def snapshot(self):
+        if self.function is None:
+            return {}
+        return {tuple(str(v) for v in key): value for key, value in self.function().items()}
+
+    def render(self, values):
+        for key, value in sorted(values.items()):
+            yield f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self._exporter_pid = None
+
+    def register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+            self.metrics[metric.name] = metric
+        return metric
+
+    def snapshot(self):
+        """Счетчики и гистограммы этого процесса (для METRICS_DIR)"""
+        return {
+            name: [[list(key), value] for key, value in metric.snapshot().items()]
+            for name, metric in self.metrics.items() if metric.kind != 'gauge'
+        }
+
+    def _other_processes(self):
+        directory = os.environ.get('METRICS_DIR')
+        if not directory or not os.path.isdir(directory):
+            return
+        own = f'{os.getpid()}.json'
+        for file_name in os.listdir(directory):
+            if file_name.endswith('.json') and file_name != own:
+                try:
+                    with open(os.path.join(directory, file_name)) as f:
+                        yield json.load(f)
+                except (OSError, ValueError):
+                    continue  # Файл пишется прямо сейчас или поврежден — пропускаем
+
+    def render(self):
+        """Text exposition of all metrics, summed over the worker processes"""
+        others = list(self._other_processes())
+        lines = []
+        for name, metric in self.metrics.items():
+            values = metric.snapshot()
+            if metric.kind != 'gauge':
+                for snapshot in others:
+                    metric.merge(values, {tuple(key): value for key, value in snapshot.get(name, [])})
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            lines.extend(metric.render(values))
+        return '\n'.join(lines) + '\n'
+
+    def write_snapshot(self, directory):
+        path = os.path.join(directory, f'{os.getpid()}.json')
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def start_exporter(self, interval=METRICS_FLUSH_INTERVAL):
+        """Периодическая запись снимка в METRICS_DIR (вызывается в каждом воркере после fork)"""
+        directory = os.environ.get('METRICS_DIR')
+        if not directory or self._exporter_pid == os.getpid():
+            return
+        self._exporter_pid = os.getpid()
+        os.makedirs(directory, exist_ok=True)
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.write_snapshot(directory)
+                except OSError:
+                    pass
+
+        threading.Thread(target=loop, name='metrics-exporter', daemon=True).start()
+
+
+registry = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return registry.register(Counter(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return registry.register(Histogram(name, documentation, labelnames, buckets))
+
+
+def gauge(name, documentation, labelnames=(), function=None):
+    return registry.register(Gauge(name, documentation, labelnames, function))
+
+
+def render():
+    return registry.render()
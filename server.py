@@ -1,31 +1,87 @@
-from flask import Flask, request, jsonify, session
-import ssl
+from flask import Flask, request, jsonify, session, g
+from flask.sessions import SecureCookieSessionInterface
+from itsdangerous import URLSafeTimedSerializer
+from werkzeug.exceptions import BadRequest
 import os
+import sys
 import json
 import time
-from datetime import datetime, timedelta
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric import padding
-from cryptography.x509 import load_pem_x509_certificate
-from cryptography.hazmat.backends import default_backend
-from cryptography.fernet import Fernet
-import pyotp
-import qrcode
+import hashlib
+import functools
+import threading
+import multiprocessing
+import weakref
+import ssl
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from key_manager import get_key_manager, load_session_keys
+from stream_crypto import decrypt_stream, StreamError
+from storage import create_store, DEFAULT_STORE_URL
+from serving import serve, serve_requested, serve_workers, create_mtls_context
+import wire
+import metrics
+import secrets
 from io import BytesIO
 import base64
 
+# Тяжелые библиотеки (cryptography.x509, pyotp, qrcode/Pillow) импортируются при первом
+# использовании — это ускоряет запуск и перезапуск сервера при отказах.
+# Отчет о времени импорта: python startup_report.py
+
 app = Flask(__name__)
-app.secret_key = os.urandom(24)
 
-# Пути к сертификатам
+
+class RotatingSessionInterface(SecureCookieSessionInterface):
+    """Cookie sessions signed with app.secret_key; signatures of SECRET_KEY_FALLBACKS are still accepted"""
+
+    def get_signing_serializer(self, app):
+        if not app.secret_key:
+            return None
+        # itsdangerous подписывает последним ключом списка и проверяет всеми
+        keys = [*reversed(app.config.get('SECRET_KEY_FALLBACKS') or []), app.secret_key]
+        return URLSafeTimedSerializer(keys, salt=self.salt, serializer=self.serializer,
+                                      signer_kwargs={'key_derivation': self.key_derivation,
+                                                     'digest_method': self.digest_method})
+
+
+app.session_interface = RotatingSessionInterface()
+
+# Параметры экземпляра (реплики) сервера; backend.py запускает несколько реплик на диапазоне портов
+SERVER_PORT = int(os.environ.get('SERVER_PORT', 5000))
+REPLICA_ID = os.environ.get('REPLICA_ID', 'server1')
+# SERVER_TLS=0 — HTTP без mTLS (реплики за координатором на одном хосте)
+SERVER_TLS = os.environ.get('SERVER_TLS', '1') == '1'
+SERVER_DEBUG = os.environ.get('SERVER_DEBUG', '1') == '1'
+
+# Пути к сертификатам; реплика может использовать собственную пару (backend.py, generate_certs.py --servers N)
 CERT_DIR = 'certs'
-SERVER_CERT = os.path.join(CERT_DIR, 'server_cert.pem')
-SERVER_KEY = os.path.join(CERT_DIR, 'server_key.pem')
+SERVER_CERT = os.environ.get('SERVER_CERT', os.path.join(CERT_DIR, 'server_cert.pem'))
+SERVER_KEY = os.environ.get('SERVER_KEY', os.path.join(CERT_DIR, 'server_key.pem'))
 CA_CERT = os.path.join(CERT_DIR, 'ca_cert.pem')
 CLIENT_CERT = os.path.join(CERT_DIR, 'client_cert.pem')
 CLIENT_KEY = os.path.join(CERT_DIR, 'client_key.pem')
+# Доверенные прокси (координатор) — CN их сертификатов mTLS. Соединение от прокси не
+# удостоверяет клиента, поэтому сертификат клиента берется из запроса (X-Client-Certificate
+# или тело), проверяется по CA и сверяется с привязанным к сессии
+TRUSTED_PROXIES = {cn.strip() for cn in os.environ.get('TRUSTED_PROXIES', 'coordinator.local').split(',') if cn.strip()}
 ENCRYPTION_KEY_FILE = 'encryption_key.txt'
 
+# Метрики для /metrics (формат Prometheus): время этапов обработки запроса и счетчики входов
+REQUEST_SECONDS = metrics.histogram('server_request_duration_seconds', 'Время обработки запроса',
+                                    ('endpoint', 'method', 'status'))
+STAGE_SECONDS = metrics.histogram('server_stage_duration_seconds', 'Время этапов обработки: '
+                                  'cert_verify, payload_parse, key_load, decrypt, batch_decrypt, totp_verify',
+                                  ('stage',))
+LOGINS = metrics.counter('server_logins', 'Попытки входа по паролю', ('result',))
+MFA_VERIFICATIONS = metrics.counter('server_mfa_verifications', 'Проверки TOTP-кодов', ('endpoint', 'result'))
+LOCKOUTS = metrics.counter('server_lockouts', 'Блокировки учетных записей после неудачных попыток')
+TLS_CONNECTIONS = metrics.counter('server_tls_connections', 'TLS-соединения клиентов по типу рукопожатия '
+                                  '(resumed="true" — возобновленная сессия, без проверки сертификатов)', ('resumed',))
+CERT_CACHE_LOOKUPS = metrics.counter('server_cert_cache_lookups', 'Обращения к кэшу проверки сертификатов',
+                                     ('result',))
+key_manager = get_key_manager(ENCRYPTION_KEY_FILE)
+
 # Проверка существования файлов сертификатов
 def check_certificates():
     required_files = [SERVER_CERT, SERVER_KEY, CA_CERT, CLIENT_CERT, CLIENT_KEY]
@@ -42,48 +98,267 @@ def setup_directories():
         print(f"📁 Создана директория: {CERT_DIR}")
     
     if not os.path.exists(ENCRYPTION_KEY_FILE):
-        key = Fernet.generate_key()
-        with open(ENCRYPTION_KEY_FILE, 'wb') as f:
-            f.write(key)
-        print(f"🔑 Создан файл с ключом шифрования: {ENCRYPTION_KEY_FILE}")
-
-# In-memory storage for demo purposes (in production, use a database)
-users_db = {
-    'user1': {
+        # Менеджер ключей создает файл с новым ключом при первой загрузке
+        key_manager.cipher()
+
+def random_base32():
+    """Секрет TOTP (как pyotp.random_base32, но без импорта pyotp при запуске)"""
+    return base64.b32encode(secrets.token_bytes(20)).decode()
+
+def make_totp(secret):
+    import pyotp
+    return pyotp.TOTP(secret)
+
+# Хранилище пользователей, секретов TOTP и счетчиков блокировок.
+# По умолчанию — общий SQLite (storage.DEFAULT_STORE_URL); SESSION_STORE=memory — в памяти процесса.
+# Подключается при запуске (main, init_worker), а не при импорте модуля
+store = None
+
+# Время жизни временного секрета TOTP при настройке MFA и параметры блокировки
+MFA_SETUP_TTL = 600
+MAX_FAILED_ATTEMPTS = 3
+LOCKOUT_SECONDS = 15 * 60
+
+def init_session_keys():
+    """Ключи подписи cookie-сессий (SECRET_KEY или key_manager.SESSION_KEY_FILE), общие для всех
+    процессов и реплик, иначе cookie одного процесса не примет другой"""
+    keys = load_session_keys()
+    app.secret_key = keys[0]
+    app.config['SECRET_KEY_FALLBACKS'] = keys[1:]
+
+def init_store(new_store):
+    """Подключение хранилища и начальные пользователи"""
+    global store
+    store = new_store
+    # Прежние версии хранили ключ подписи сессий в хранилище открытым текстом — удаляем его
+    store.delete('flask_secret_key')
+    # add() не перезаписывает пользователя, уже созданного другим процессом
+    store.add('user:user1', {
         'password': 'password123',
-        'totp_secret': pyotp.random_base32(),
-        'mfa_enabled': False,
-        'failed_attempts': 0,
-        'locked_until': None
-    }
-}
+        'totp_secret': random_base32(),
+        'mfa_enabled': False
+    })
+
+def get_user(username):
+    return store.get(f'user:{username}')
+
+def save_user(username, user):
+    store.set(f'user:{username}', user)
 
-# Store TOTP secrets temporarily for setup
-totp_secrets = {}
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def observe_request(response):
+    started = g.get('request_started')
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint,
+                                method=request.method, status=response.status_code)
+    return response
+
+# Соединения, уже учтенные в TLS_CONNECTIONS (по нескольку запросов на keep-alive соединение)
+_seen_tls_sockets = weakref.WeakSet()
+_seen_tls_lock = threading.Lock()
+
+@app.before_request
+def count_tls_connection():
+    sock = request.environ.get('gunicorn.socket') or request.environ.get('werkzeug.socket')
+    if not isinstance(sock, ssl.SSLSocket):
+        return
+    with _seen_tls_lock:
+        if sock in _seen_tls_sockets:
+            return
+        _seen_tls_sockets.add(sock)
+    TLS_CONNECTIONS.inc(resumed='true' if sock.session_reused else 'false')
 
 @app.before_request
 def verify_client_cert():
     # Skip certificate verification for MFA endpoints during setup
-    if request.path in ['/api/mfa/setup', '/api/mfa/verify', '/api/login', '/api/health']:
+    if request.path in ['/api/mfa/setup', '/api/mfa/verify', '/api/login', '/api/health', '/metrics']:
+        return
+    if request.path.startswith('/api/mfa/qr/'):
         return
     
     if 'authenticated' not in session or not session['authenticated']:
         return jsonify({'error': 'Authentication required'}), 401
     
-    cert_data = request.get_json().get('certificate')
+    # Основной путь: сертификат из TLS-соединения (mTLS), тело его больше не содержит
+    peer_cert = get_peer_certificate()
+    if peer_cert:
+        if not verify_certificate(peer_cert):
+            return jsonify({'error': 'Invalid certificate'}), 401
+        if not is_trusted_proxy(peer_cert):
+            return check_session_certificate(peer_cert)
+    
+    # Через координатор или без TLS — сертификат клиента передается в запросе
+    # (клиент повторяет запрос с ним, получив "Certificate required")
+    cert_data = get_client_certificate()
     if not cert_data:
         return jsonify({'error': 'Certificate required'}), 401
     
     if not verify_certificate(cert_data):
         return jsonify({'error': 'Invalid certificate'}), 401
+    return check_session_certificate(cert_data)
 
-def verify_certificate(cert_pem):
+def check_session_certificate(cert_pem):
+    """Сессия, привязанная при входе к сертификату, принимается только с ним"""
+    bound = session.get('cert_fingerprint')
+    if bound and bound != certificate_fingerprint(cert_pem):
+        return jsonify({'error': 'Certificate does not match session'}), 401
+
+@functools.lru_cache(maxsize=256)
+def is_trusted_proxy(cert_pem):
+    """Сертификат соединения принадлежит доверенному прокси (CN из TRUSTED_PROXIES)"""
+    if not TRUSTED_PROXIES:
+        return False
+    from cryptography.x509 import load_pem_x509_certificate
+    from cryptography.x509.oid import NameOID
     try:
-        certificate = load_pem_x509_certificate(cert_pem.encode(), default_backend())
-        # In production, verify against CA
-        return True
-    except:
+        certificate = load_pem_x509_certificate(cert_pem.encode())
+    except ValueError:
         return False
+    return any(attribute.value in TRUSTED_PROXIES
+               for attribute in certificate.subject.get_attributes_for_oid(NameOID.COMMON_NAME))
+
+def get_peer_certificate():
+    """PEM сертификата клиента из TLS-соединения (None при работе по HTTP)"""
+    return request.environ.get('SSL_CLIENT_CERT')
+
+def certificate_fingerprint(cert_pem):
+    return hashlib.sha256(cert_pem.encode()).hexdigest()
+
+def get_client_certificate():
+    """PEM клиентского сертификата, переданного явно: из тела запроса или, для потоковых
+    запросов, из заголовка X-Client-Certificate (base64). Нужен только без mTLS"""
+    header = request.headers.get('X-Client-Certificate')
+    if header:
+        try:
+            return base64.b64decode(header).decode()
+        except Exception:
+            return None
+    if request.path == '/api/data/stream':
+        return None  # Тело потока читает обработчик, его нельзя разбирать здесь
+    data = get_payload()
+    return data.get('certificate') if isinstance(data, dict) else None
+
+def get_payload():
+    """Тело запроса /api/data* (JSON или msgpack); разбирается один раз за запрос.
+    Непустое тело в другом формате — wire.UnsupportedFormat (ответ 415)"""
+    if 'payload' not in g:
+        content_type = request.content_type
+        if wire.media_type(content_type) not in (wire.JSON_CONTENT_TYPE, wire.MSGPACK_CONTENT_TYPE):
+            if request.get_data():
+                raise wire.UnsupportedFormat(wire.media_type(content_type) or 'no Content-Type')
+            g.payload = None
+        else:
+            try:
+                with STAGE_SECONDS.time(stage='payload_parse'):
+                    g.payload = wire.decode(content_type, request.get_data())
+            except wire.UnsupportedFormat:
+                raise
+            except Exception:
+                raise BadRequest('Malformed request body')
+    return g.payload
+
+def respond(obj, status=200):
+    """Ответ в формате, согласованном с клиентом по Accept/Content-Type (JSON или msgpack)"""
+    content_type = wire.negotiate(request.headers.get('Accept'), request.content_type)
+    return app.response_class(wire.encode(obj, content_type), status=status, mimetype=content_type)
+
+@app.errorhandler(wire.UnsupportedFormat)
+def unsupported_format(e):
+    return jsonify({'error': f'Unsupported request format: {e}'}), 415
+
+# Кэш результатов проверки сертификатов: sha256(PEM) -> (результат, время истечения записи)
+CERT_CACHE_SIZE = int(os.environ.get('CERT_CACHE_SIZE', 1024))
+CERT_CACHE_TTL = float(os.environ.get('CERT_CACHE_TTL', 300))
+CERT_NEGATIVE_TTL = 30
+# Как часто проверять, не заменен ли файл CA (секунды), — как KEY_CHECK_INTERVAL у ключей
+CA_CHECK_INTERVAL = float(os.environ.get('CA_CHECK_INTERVAL', 1.0))
+_cert_cache = OrderedDict()
+_cert_cache_lock = threading.Lock()
+_ca_lock = threading.Lock()
+_ca_certificate = None
+_ca_signature = None
+_ca_next_check = 0.0
+
+def _ca_file_signature():
+    st = os.stat(CA_CERT)
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def load_ca_certificate():
+    """Сертификат CA; файл перечитывается, если его заменили (stat не чаще CA_CHECK_INTERVAL)"""
+    global _ca_certificate, _ca_signature, _ca_next_check
+    now = time.monotonic()
+    if _ca_certificate is not None and now < _ca_next_check:
+        return _ca_certificate
+    with _ca_lock:
+        if _ca_certificate is None or now >= _ca_next_check:
+            try:
+                signature = _ca_file_signature()
+            except FileNotFoundError:
+                if _ca_certificate is None:
+                    raise
+                signature = _ca_signature  # Файл удален — продолжаем работать со старым CA
+            if _ca_certificate is None or signature != _ca_signature:
+                from cryptography.x509 import load_pem_x509_certificate
+                from cryptography.hazmat.backends import default_backend
+                with open(CA_CERT, 'rb') as f:
+                    certificate = load_pem_x509_certificate(f.read(), default_backend())
+                if _ca_certificate is not None:
+                    # Результаты проверки по старому CA больше не действительны
+                    with _cert_cache_lock:
+                        _cert_cache.clear()
+                    print(f"🔄 Сертификат CA перечитан: {CA_CERT}")
+                _ca_certificate, _ca_signature = certificate, signature
+            _ca_next_check = now + CA_CHECK_INTERVAL
+        return _ca_certificate
+
+def validate_certificate(cert_pem):
+    """Full check: parse, validity period and signature of our CA.
+    Returns (valid, expires_at) where expires_at bounds how long the result may be cached."""
+    from cryptography.x509 import load_pem_x509_certificate
+    from cryptography.hazmat.backends import default_backend
+    try:
+        certificate = load_pem_x509_certificate(cert_pem.encode(), default_backend())
+        ca_certificate = load_ca_certificate()
+        now = datetime.utcnow()
+        if not (certificate.not_valid_before <= now <= certificate.not_valid_after):
+            return False, time.time() + CERT_NEGATIVE_TTL
+        # Проверка имени издателя и подписи CA
+        certificate.verify_directly_issued_by(ca_certificate)
+    except Exception:
+        return False, time.time() + CERT_NEGATIVE_TTL
+    not_after = certificate.not_valid_after.replace(tzinfo=timezone.utc).timestamp()
+    return True, min(time.time() + CERT_CACHE_TTL, not_after)
+
+def verify_certificate(cert_pem):
+    # Повторные запросы с тем же сертификатом не разбирают PEM и не проверяют подпись
+    try:
+        load_ca_certificate()  # Если файл CA заменили, кэш сбрасывается до поиска в нем
+    except Exception:
+        pass  # Ошибку чтения CA вернет validate_certificate
+    cache_key = hashlib.sha256(cert_pem.encode()).digest()
+    now = time.time()
+    with _cert_cache_lock:
+        cached = _cert_cache.get(cache_key)
+        if cached is not None and cached[1] > now:
+            _cert_cache.move_to_end(cache_key)
+            CERT_CACHE_LOOKUPS.inc(result='hit')
+            return cached[0]
+
+    CERT_CACHE_LOOKUPS.inc(result='miss')
+    with STAGE_SECONDS.time(stage='cert_verify'):
+        valid, expires_at = validate_certificate(cert_pem)
+
+    with _cert_cache_lock:
+        _cert_cache[cache_key] = (valid, expires_at)
+        _cert_cache.move_to_end(cache_key)
+        while len(_cert_cache) > CERT_CACHE_SIZE:
+            _cert_cache.popitem(last=False)
+    return valid
 
 @app.route('/api/login', methods=['POST'])
 def login():
@@ -94,31 +369,35 @@ def login():
     if not username or not password:
         return jsonify({'error': 'Username and password required'}), 400
     
-    if username not in users_db:
+    user = get_user(username)
+    if user is None:
+        LOGINS.inc(result='invalid')
         return jsonify({'error': 'Invalid credentials'}), 401
     
-    user = users_db[username]
-    
     # Check if account is locked
-    if user['locked_until'] and datetime.now() < user['locked_until']:
+    if store.get(f'locked:{username}'):
+        LOGINS.inc(result='locked')
         return jsonify({'error': 'Account locked. Try again later.'}), 403
     
     # Verify password
     if user['password'] != password:
-        user['failed_attempts'] += 1
+        # Атомарный счетчик неудачных попыток, общий для всех процессов сервера
+        failed_attempts = store.incr(f'failed:{username}', ttl=LOCKOUT_SECONDS)
         
         # Lock account after 3 failed attempts
-        if user['failed_attempts'] >= 3:
-            user['locked_until'] = datetime.now() + timedelta(minutes=15)
-            users_db[username] = user
+        if failed_attempts >= MAX_FAILED_ATTEMPTS:
+            store.set(f'locked:{username}', True, ttl=LOCKOUT_SECONDS)
+            store.delete(f'failed:{username}')
+            LOGINS.inc(result='invalid')
+            LOCKOUTS.inc()
             return jsonify({'error': 'Too many failed attempts. Account locked for 15 minutes.'}), 403
         
-        users_db[username] = user
+        LOGINS.inc(result='invalid')
         return jsonify({'error': 'Invalid credentials'}), 401
     
     # Reset failed attempts on successful password
-    user['failed_attempts'] = 0
-    users_db[username] = user
+    store.delete(f'failed:{username}')
+    LOGINS.inc(result='ok')
     
     # Check if MFA is enabled
     if user['mfa_enabled']:
@@ -129,30 +408,106 @@ def login():
         })
     else:
         # If MFA not enabled, ask user to set it up
-        totp_secret = pyotp.random_base32()
-        totp_secrets[username] = totp_secret
+        totp_secret = random_base32()
+        store.set(f'totp_setup:{username}', totp_secret, ttl=MFA_SETUP_TTL)
         
         # Generate QR code for setup
-        totp = pyotp.TOTP(totp_secret)
+        totp = make_totp(totp_secret)
         provisioning_uri = totp.provisioning_uri(
             name=username,
             issuer_name="Secure Distributed System"
         )
         
-        # Generate QR code
-        img = qrcode.make(provisioning_uri)
-        buffered = BytesIO()
-        img.save(buffered, format="PNG")
-        qr_code = base64.b64encode(buffered.getvalue()).decode()
+        # QR-код рисуется в фоне и отдается отдельным запросом /api/mfa/qr/<id>
+        qr_id = publish_qr_code(provisioning_uri)
         
         return jsonify({
             'message': 'Password accepted. MFA setup required.',
             'mfa_setup_required': True,
             'totp_secret': totp_secret,
-            'qr_code': qr_code,
+            'qr_id': qr_id,
+            'qr_code_url': f'/api/mfa/qr/{qr_id}',
             'username': username
         })
 
+# Кэш PNG с QR-кодами настройки MFA: qr_id -> PNG. qr_id — хеш provisioning URI,
+# сам URI лежит в общем хранилище, поэтому картинку может отдать любой процесс сервера
+QR_CACHE_SIZE = 256
+_qr_cache = OrderedDict()
+_qr_pending = {}
+_qr_lock = threading.Lock()
+_qr_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='qr')
+
+def render_qr_code(provisioning_uri):
+    """PNG с QR-кодом (дорогая операция: десятки миллисекунд CPU)"""
+    import qrcode
+    img = qrcode.make(provisioning_uri)
+    buffered = BytesIO()
+    img.save(buffered, format="PNG")
+    return buffered.getvalue()
+
+def publish_qr_code(provisioning_uri):
+    """Регистрация URI и фоновая отрисовка QR-кода; возвращает qr_id"""
+    qr_id = hashlib.sha256(provisioning_uri.encode()).hexdigest()[:32]
+    store.set(f'qr:{qr_id}', provisioning_uri, ttl=MFA_SETUP_TTL)
+    with _qr_lock:
+        if qr_id in _qr_cache or qr_id in _qr_pending:
+            return qr_id
+        future = _qr_executor.submit(render_qr_code, provisioning_uri)
+        _qr_pending[qr_id] = future
+    future.add_done_callback(lambda f: finish_qr_render(qr_id, f))
+    return qr_id
+
+def finish_qr_render(qr_id, future):
+    """Фоновая отрисовка завершена: запись из _qr_pending убирается и при ошибке,
+    чтобы следующий запрос попробовал нарисовать картинку заново"""
+    with _qr_lock:
+        _qr_pending.pop(qr_id, None)
+    if future.exception() is None:
+        cache_qr_png(qr_id, future.result())
+
+def cache_qr_png(qr_id, png):
+    with _qr_lock:
+        _qr_cache[qr_id] = png
+        while len(_qr_cache) > QR_CACHE_SIZE:
+            _qr_cache.popitem(last=False)
+
+def get_qr_png(qr_id, provisioning_uri):
+    """PNG из кэша, из фоновой отрисовки или нарисованный сейчас; None, если нарисовать не удалось"""
+    with _qr_lock:
+        png = _qr_cache.get(qr_id)
+        if png is not None:
+            _qr_cache.move_to_end(qr_id)
+            return png
+        future = _qr_pending.get(qr_id)
+    # Картинка еще рисуется в фоне — ждем ее; иначе (другой процесс или ошибка) рисуем сами
+    try:
+        png = future.result() if future is not None else render_qr_code(provisioning_uri)
+    except Exception as e:
+        print(f"⚠️  Не удалось нарисовать QR-код: {e}")
+        return None
+    cache_qr_png(qr_id, png)
+    return png
+
+@app.route('/api/mfa/qr/<qr_id>', methods=['GET'])
+def mfa_qr_code(qr_id):
+    provisioning_uri = store.get(f'qr:{qr_id}')
+    if provisioning_uri is None:
+        return jsonify({'error': 'QR code expired. Please login again.'}), 404
+    
+    # Содержимое однозначно определяется qr_id, поэтому он же служит ETag
+    etag = f'"{qr_id}"'
+    if etag in request.headers.get('If-None-Match', ''):
+        return '', 304, {'ETag': etag}
+    
+    png = get_qr_png(qr_id, provisioning_uri)
+    if png is None:
+        return jsonify({'error': 'QR code is temporarily unavailable. Use the secret key.'}), 503
+    response = app.response_class(png, mimetype='image/png')
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = f'private, max-age={MFA_SETUP_TTL}'
+    return response
+
 @app.route('/api/mfa/setup', methods=['POST'])
 def mfa_setup():
     data = request.get_json()
@@ -162,19 +517,24 @@ def mfa_setup():
     if not username or not token:
         return jsonify({'error': 'Username and token required'}), 400
     
-    if username not in totp_secrets:
+    totp_secret = store.get(f'totp_setup:{username}')
+    user = get_user(username)
+    if totp_secret is None or user is None:
         return jsonify({'error': 'Session expired. Please login again.'}), 401
     
-    totp_secret = totp_secrets[username]
-    totp = pyotp.TOTP(totp_secret)
+    totp = make_totp(totp_secret)
+    with STAGE_SECONDS.time(stage='totp_verify'):
+        token_valid = totp.verify(token, valid_window=1)
+    MFA_VERIFICATIONS.inc(endpoint='setup', result='ok' if token_valid else 'invalid')
     
-    if totp.verify(token, valid_window=1):
+    if token_valid:
         # Enable MFA for user
-        users_db[username]['totp_secret'] = totp_secret
-        users_db[username]['mfa_enabled'] = True
+        user['totp_secret'] = totp_secret
+        user['mfa_enabled'] = True
+        save_user(username, user)
         
         # Clean up temporary secret
-        del totp_secrets[username]
+        store.delete(f'totp_setup:{username}')
         
         return jsonify({
             'message': 'MFA setup successful',
@@ -192,20 +552,26 @@ def mfa_verify():
     if not username or not token:
         return jsonify({'error': 'Username and token required'}), 400
     
-    if username not in users_db:
+    user = get_user(username)
+    if user is None:
         return jsonify({'error': 'Invalid user'}), 401
     
-    user = users_db[username]
-    
     if not user['mfa_enabled']:
         return jsonify({'error': 'MFA not enabled for user'}), 400
     
-    totp = pyotp.TOTP(user['totp_secret'])
+    totp = make_totp(user['totp_secret'])
+    with STAGE_SECONDS.time(stage='totp_verify'):
+        token_valid = totp.verify(token, valid_window=1)
+    MFA_VERIFICATIONS.inc(endpoint='verify', result='ok' if token_valid else 'invalid')
     
-    if totp.verify(token, valid_window=1):
+    if token_valid:
         # Authentication successful
         session['authenticated'] = True
         session['username'] = username
+        # Привязываем к сессии сертификат, которым клиент прошел mTLS (не сертификат прокси)
+        peer_cert = get_peer_certificate()
+        if peer_cert and not is_trusted_proxy(peer_cert) and verify_certificate(peer_cert):
+            session['cert_fingerprint'] = certificate_fingerprint(peer_cert)
         # Сохраняем время истечения сессии как строку ISO формата
         expires_time = (datetime.now() + timedelta(hours=1)).replace(tzinfo=None)
         session['expires'] = expires_time.isoformat()
@@ -218,9 +584,8 @@ def mfa_verify():
     else:
         return jsonify({'error': 'Invalid MFA token'}), 401
 
-@app.route('/api/data', methods=['POST'])
-def get_data():
-    # Check session
+def check_session():
+    """Проверка аутентификации и срока действия сессии; ответ с ошибкой или None"""
     if 'authenticated' not in session or not session['authenticated']:
         return jsonify({'error': 'Authentication required'}), 401
     
@@ -236,66 +601,210 @@ def get_data():
         if datetime.now().replace(tzinfo=None) > expires_time.replace(tzinfo=None):
             return jsonify({'error': 'Session expired'}), 401
     
-    data = request.get_json()
+    return None
+
+@app.route('/api/data', methods=['POST'])
+def get_data():
+    # Check session
+    error = check_session()
+    if error:
+        return error
     
-    # Verify certificate
-    cert = data.get('certificate')
-    if not cert or not verify_certificate(cert):
-        return jsonify({'error': 'Invalid certificate'}), 401
+    # Сертификат уже проверен в verify_client_cert
+    data = get_payload() or {}
     
     # Process encrypted data
     encrypted_data = data.get('data')
     if encrypted_data:
         try:
             decrypted_data = decrypt_data(encrypted_data)
-            return jsonify({
+            return respond({
                 'result': 'ok',
                 'message': f'Data received and decrypted: {decrypted_data}',
                 'user': session['username'],
+                'replica': REPLICA_ID,
                 'timestamp': datetime.now().isoformat()
             })
         except Exception as e:
-            return jsonify({'error': f'Decryption failed: {str(e)}'}), 400
+            return respond({'error': f'Decryption failed: {str(e)}'}, 400)
     
-    return jsonify({'result': 'ok', 'message': 'No data to decrypt'})
+    return respond({'result': 'ok', 'message': 'No data to decrypt'})
 
 def decrypt_data(encrypted_data):
     try:
-        # Load encryption key
-        with open(ENCRYPTION_KEY_FILE, 'rb') as f:
-            key = f.read()
-        cipher = Fernet(key)
-        decrypted = cipher.decrypt(encrypted_data.encode())
-        return decrypted.decode()
-    except FileNotFoundError:
-        # Generate new key if not exists
-        key = Fernet.generate_key()
-        with open(ENCRYPTION_KEY_FILE, 'wb') as f:
-            f.write(key)
-        cipher = Fernet(key)
-        decrypted = cipher.decrypt(encrypted_data.encode())
+        # Ключи загружаются один раз и перечитываются только при изменении файла.
+        # Токен приходит строкой (JSON) или сырыми байтами (msgpack)
+        with STAGE_SECONDS.time(stage='key_load'):
+            cipher = key_manager.cipher()
+        with STAGE_SECONDS.time(stage='decrypt'):
+            decrypted = cipher.decrypt(wire.token_from_wire(encrypted_data))
         return decrypted.decode()
     except:
         # For demo, return as-is if no encryption key
         return encrypted_data
 
+# Пакетная обработка: максимум сообщений в запросе и размер пакета,
+# начиная с которого расшифровка распределяется по пулу процессов
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 10000))
+BATCH_POOL_THRESHOLD = int(os.environ.get('BATCH_POOL_THRESHOLD', 512))
+BATCH_POOL_WORKERS = int(os.environ.get('BATCH_POOL_WORKERS', os.cpu_count() or 2))
+_batch_pool = None
+_batch_pool_lock = threading.Lock()
+
+def decrypt_batch_chunk(tokens):
+    """Расшифровка части пакета; выполняется в текущем процессе или в процессе пула"""
+    cipher = get_key_manager(ENCRYPTION_KEY_FILE).cipher()
+    results = []
+    for token in tokens:
+        try:
+            results.append({'result': 'ok', 'data': cipher.decrypt(wire.token_from_wire(token)).decode()})
+        except Exception:
+            results.append({'result': 'error', 'error': 'Decryption failed'})
+    return results
+
+def init_batch_worker():
+    """Процесс пула загружает ключи шифрования сам, ничего не наследуя от воркера"""
+    get_key_manager(ENCRYPTION_KEY_FILE).cipher()
+
+def batch_pool_context():
+    # Пул создается лениво в многопоточном воркере: fork скопировал бы блокировки, захваченные
+    # другими потоками (key_manager, SQLite, logging), и соединение с хранилищем. forkserver
+    # запускает процессы из чистого процесса-сервера (spawn — где forkserver недоступен)
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return multiprocessing.get_context(method)
+
+def get_batch_pool():
+    global _batch_pool
+    with _batch_pool_lock:
+        if _batch_pool is None:
+            _batch_pool = ProcessPoolExecutor(max_workers=BATCH_POOL_WORKERS, mp_context=batch_pool_context(),
+                                              initializer=init_batch_worker)
+        return _batch_pool
+
+def decrypt_batch(tokens):
+    """Результаты расшифровки в порядке исходных сообщений"""
+    if len(tokens) < BATCH_POOL_THRESHOLD or BATCH_POOL_WORKERS < 2:
+        return decrypt_batch_chunk(tokens)
+    chunk_size = -(-len(tokens) // BATCH_POOL_WORKERS)
+    chunks = [tokens[i:i + chunk_size] for i in range(0, len(tokens), chunk_size)]
+    results = []
+    for part in get_batch_pool().map(decrypt_batch_chunk, chunks):
+        results.extend(part)
+    return results
+
+@app.route('/api/data/batch', methods=['POST'])
+def get_data_batch():
+    """Пакет зашифрованных сообщений: сессия и сертификат проверяются один раз на весь пакет"""
+    error = check_session()
+    if error:
+        return error
+    
+    # Сертификат уже проверен в verify_client_cert
+    items = (get_payload() or {}).get('items')
+    if not isinstance(items, list):
+        return respond({'error': 'Field "items" must be a list of encrypted messages'}, 400)
+    if len(items) > BATCH_MAX_ITEMS:
+        return respond({'error': f'Too many items in batch (max {BATCH_MAX_ITEMS})'}, 413)
+    
+    with STAGE_SECONDS.time(stage='batch_decrypt'):
+        results = decrypt_batch(items)
+    return respond({
+        'result': 'ok',
+        'count': len(results),
+        'failed': sum(1 for r in results if r['result'] != 'ok'),
+        'results': results,
+        'user': session['username'],
+        'replica': REPLICA_ID,
+        'timestamp': datetime.now().isoformat()
+    })
+
+@app.route('/api/data/stream', methods=['POST'])
+def get_data_stream():
+    """Потоковая загрузка: тело расшифровывается по частям по мере чтения,
+    поэтому память не зависит от размера данных"""
+    error = check_session()
+    if error:
+        return error
+    
+    digest = hashlib.sha256()
+    total_bytes = 0
+    chunks = 0
+    try:
+        for chunk in decrypt_stream(request.stream.read, key_manager.keys()):
+            digest.update(chunk)
+            total_bytes += len(chunk)
+            chunks += 1
+    except StreamError as e:
+        return jsonify({'error': f'Decryption failed: {str(e)}'}), 400
+    
+    return jsonify({
+        'result': 'ok',
+        'message': f'Stream received and decrypted: {total_bytes} bytes',
+        'bytes': total_bytes,
+        'chunks': chunks,
+        'sha256': digest.hexdigest(),
+        'user': session['username'],
+        'replica': REPLICA_ID,
+        'timestamp': datetime.now().isoformat()
+    })
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     return jsonify({
         'status': 'healthy',
         'timestamp': datetime.now().isoformat(),
+        'replica': REPLICA_ID,
         'mfa_supported': True,
         'certificates_ready': check_certificates()
     })
 
-if __name__ == '__main__':
-    print("=== Запуск защищенного сервера с двухфакторной аутентификацией ===\n")
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return app.response_class(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+# Режим serve: несколько процессов-воркеров не видят память друг друга,
+# поэтому состояние (пользователи, MFA, блокировки) переносится в общее хранилище
+SERVE_STORE_URL = os.environ.get('SERVE_STORE_URL', 'sqlite:///server_state.db')
+
+def serve_store_url(workers):
+    url = os.environ.get('SESSION_STORE', DEFAULT_STORE_URL)
+    if workers > 1 and url == 'memory':
+        return SERVE_STORE_URL
+    return url
+
+def init_worker(store_url, workers):
+    """Инициализация процесса-воркера после fork: свое соединение с хранилищем"""
+    global BATCH_POOL_WORKERS
+    init_store(create_store(store_url))
+    # Ядра уже поделены между воркерами — пул пакетной расшифровки не должен их переподписывать
+    if 'BATCH_POOL_WORKERS' not in os.environ:
+        BATCH_POOL_WORKERS = max(1, (os.cpu_count() or 2) // workers)
+
+def main():
+    print(f"=== Запуск защищенного сервера с двухфакторной аутентификацией ({REPLICA_ID}) ===\n")
     
     # Создаем необходимые директории и файлы
     setup_directories()
+    try:
+        init_session_keys()
+    except RuntimeError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
     
+    if serve_requested():
+        # Боевой режим: pre-fork сервер gunicorn с несколькими воркерами
+        workers = serve_workers()
+        store_url = serve_store_url(workers)
+        print(f"🗄️  Хранилище состояния: {store_url}")
+        tls = (SERVER_CERT, SERVER_KEY, CA_CERT) if check_certificates() else None
+        serve(app, SERVER_PORT, workers, tls=tls, post_fork=lambda worker: init_worker(store_url, workers))
+        return
+    init_store(create_store())
+    if not SERVER_TLS:
+        print(f"\n🚀 Запуск сервера на http://0.0.0.0:{SERVER_PORT} (SERVER_TLS=0, без SSL)")
+        app.run(host='0.0.0.0', port=SERVER_PORT, debug=SERVER_DEBUG)
     # Проверяем наличие сертификатов
-    if not check_certificates():
+    elif not check_certificates():
         print("\n⚠️  ВНИМАНИЕ: Не все сертификаты найдены!")
         print("Пожалуйста, выполните следующие команды для генерации сертификатов:")
         print("\n1. Создайте корневой сертификат:")
@@ -308,26 +817,26 @@ if __name__ == '__main__':
         print(f"   openssl x509 -req -in {CERT_DIR}/client_req.pem -CA {CERT_DIR}/ca_cert.pem -CAkey {CERT_DIR}/ca_key.pem -out {CERT_DIR}/client_cert.pem -days 365")
         print("\nИли запустите: python generate_certs.py")
         print("\nЗапускаю сервер в режиме отладки (без SSL)...")
-        app.run(host='0.0.0.0', port=5000, debug=True)
+        app.run(host='0.0.0.0', port=SERVER_PORT, debug=SERVER_DEBUG)
     else:
         print("✓ Все сертификаты найдены")
         print("✓ Ключ шифрования готов")
         
         # SSL context setup
         try:
-            context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-            context.load_cert_chain(SERVER_CERT, SERVER_KEY)
-            context.verify_mode = ssl.CERT_REQUIRED
-            context.load_verify_locations(CA_CERT)
+            context = create_mtls_context(SERVER_CERT, SERVER_KEY, CA_CERT)
             
-            print(f"\n🚀 Запуск сервера на https://0.0.0.0:5000")
+            print(f"\n🚀 Запуск сервера на https://0.0.0.0:{SERVER_PORT}")
             print("Для тестирования используйте:")
             print("1. python client.py")
             print("2. Имя пользователя: user1")
             print("3. Пароль: password123")
             
-            app.run(host='0.0.0.0', port=5000, ssl_context=context, debug=True)
+            app.run(host='0.0.0.0', port=SERVER_PORT, ssl_context=context, debug=SERVER_DEBUG)
         except Exception as e:
             print(f"\n⚠️  Ошибка при настройке SSL: {e}")
             print("Запускаю сервер в HTTP режиме для отладки...")
-            app.run(host='0.0.0.0', port=5000, debug=True)
+            app.run(host='0.0.0.0', port=SERVER_PORT, debug=SERVER_DEBUG)
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,13 @@
-from flask import Flask, jsonify
 import os
 
-app = Flask(__name__)
+# Резервный сервер 2: та же логика, что у server.py (вход, MFA, расшифровка), на порту 5001.
+# Для запуска произвольного числа реплик используйте backend.py
+os.environ.setdefault('SERVER_PORT', '5001')
+os.environ.setdefault('REPLICA_ID', 'server2')
+# Пользователи, MFA и ключ подписи сессий — в общем хранилище (storage.DEFAULT_STORE_URL)
+os.environ.setdefault('SERVER_DEBUG', '0')  # без перезагрузчика, чтобы не конфликтовал с основным
 
-# Простой сервер для тестирования отказоустойчивости
-@app.route('/api/health', methods=['GET'])
-def health():
-    return jsonify({
-        "status": "healthy", 
-        "server": "server2",
-        "port": 5001
-    })
-
-@app.route('/api/data', methods=['POST'])
-def data():
-    return jsonify({
-        "message": "Data processed by server2",
-        "port": 5001,
-        "original_data": "test"
-    })
+from server import main
 
 if __name__ == '__main__':
-    print("Server 2 starting on port 5001...")
-    app.run(host='0.0.0.0', port=5001, debug=False)  # debug=False чтобы не конфликтовал с основным
+    main()
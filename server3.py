@@ -1,24 +1,13 @@
-from flask import Flask, jsonify
 import os
 
-app = Flask(__name__)
+# Резервный сервер 3: та же логика, что у server.py (вход, MFA, расшифровка), на порту 5002.
+# Для запуска произвольного числа реплик используйте backend.py
+os.environ.setdefault('SERVER_PORT', '5002')
+os.environ.setdefault('REPLICA_ID', 'server3')
+# Пользователи, MFA и ключ подписи сессий — в общем хранилище (storage.DEFAULT_STORE_URL)
+os.environ.setdefault('SERVER_DEBUG', '0')  # без перезагрузчика, чтобы не конфликтовал с основным
 
-@app.route('/api/health', methods=['GET'])
-def health():
-    return jsonify({
-        "status": "healthy", 
-        "server": "server3",
-        "port": 5002
-    })
-
-@app.route('/api/data', methods=['POST'])
-def data():
-    return jsonify({
-        "message": "Data processed by server3",
-        "port": 5002,
-        "original_data": "test"
-    })
+from server import main
 
 if __name__ == '__main__':
-    print("Server 3 starting on port 5002...")
-    app.run(host='0.0.0.0', port=5002, debug=False)
+    main()
@@ -0,0 +1,149 @@
+import os
+import ssl
+import sys
+import atexit
+import shutil
+import tempfile
+import metrics
+
+# Боевой режим запуска приложений: pre-fork сервер gunicorn с несколькими процессами-воркерами
+# вместо однопроцессного сервера разработки Flask (app.run(debug=True)).
+#
+#   python server.py serve [N]        # N воркеров (по умолчанию SERVE_WORKERS или число ядер)
+#   kill -HUP <pid мастера>           # плавный перезапуск: новые воркеры поднимаются,
+#                                     # старые дообрабатывают текущие запросы и завершаются
+#
+# Мастер-процесс только принимает соединения и следит за воркерами, запросы обрабатываются
+# в воркерах — пропускная способность растет с числом ядер (нет общего GIL).
+# gunicorn — необязательная зависимость, нужна только для режима serve (Linux/macOS).
+
+SERVE_WORKERS = int(os.environ.get('SERVE_WORKERS', os.cpu_count() or 1))
+# Потоков в каждом воркере (gthread): держат keep-alive соединения координатора
+SERVE_THREADS = int(os.environ.get('SERVE_THREADS', 4))
+SERVE_TIMEOUT = int(os.environ.get('SERVE_TIMEOUT', 60))
+SERVE_GRACEFUL_TIMEOUT = int(os.environ.get('SERVE_GRACEFUL_TIMEOUT', 30))
+# Билетов сессии TLS 1.3, выдаваемых клиенту после рукопожатия (0 — без возобновления сессий)
+TLS_NUM_TICKETS = int(os.environ.get('TLS_NUM_TICKETS', 2))
+
+
+def serve_requested(argv=None):
+    """True, если скрипт запущен как `python <app>.py serve [N]`"""
+    argv = sys.argv if argv is None else argv
+    return len(argv) >= 2 and argv[1] == 'serve'
+
+
+def serve_workers(argv=None):
+    argv = sys.argv if argv is None else argv
+    return int(argv[2]) if len(argv) > 2 else SERVE_WORKERS
+
+
+class PeerCertificateMiddleware:
+    """Кладет PEM сертификата клиента в environ['SSL_CLIENT_CERT'], как это делает
+    сервер разработки Werkzeug, — приложения читают сертификат одинаково в обоих режимах"""
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        sock = environ.get('gunicorn.socket')
+        if 'SSL_CLIENT_CERT' not in environ and isinstance(sock, ssl.SSLSocket):
+            der = sock.getpeercert(binary_form=True)
+            if der:
+                environ['SSL_CLIENT_CERT'] = ssl.DER_cert_to_PEM_cert(der)
+        return self.app(environ, start_response)
+
+
+def create_mtls_context(server_cert, server_key, ca_cert):
+    """Серверный TLS-контекст с обязательной проверкой сертификата клиента (mTLS)"""
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(server_cert, server_key)
+    context.verify_mode = ssl.CERT_REQUIRED
+    context.load_verify_locations(ca_cert)
+    # Клиент с билетом возобновляет сессию без повторной проверки сертификатов (см. tls.py)
+    context.num_tickets = TLS_NUM_TICKETS
+    return context
+
+
+def mtls_options(server_cert, server_key, ca_cert):
+    """Параметры gunicorn для mTLS с той же настройкой, что у ssl_context в app.run()"""
+    # Контекст создается в мастере до fork: воркеры наследуют общий ключ шифрования билетов
+    # сессий, и клиент возобновляет сессию, на какой бы воркер ни попало новое соединение.
+    # SIGHUP создает новый контекст (и ключ билетов) — новые воркеры заново читают сертификаты
+    current = {'context': create_mtls_context(server_cert, server_key, ca_cert)}
+
+    def ssl_context(config, default_ssl_context_factory):
+        return current['context']
+
+    def on_reload(server):
+        current['context'] = create_mtls_context(server_cert, server_key, ca_cert)
+
+    return {
+        'certfile': server_cert,
+        'keyfile': server_key,
+        'ca_certs': ca_cert,
+        'cert_reqs': ssl.CERT_REQUIRED,
+        'ssl_context': ssl_context,
+        'on_reload': on_reload,
+    }
+
+
+def prepare_metrics_dir():
+    """METRICS_DIR для снимков метрик воркеров: свой временный каталог на каждый запуск мастера
+    (удаляется при его завершении), если не задан явно"""
+    if os.environ.get('METRICS_DIR'):
+        return os.environ['METRICS_DIR']
+    directory = tempfile.mkdtemp(prefix='metrics-')
+    os.environ['METRICS_DIR'] = directory
+    master_pid = os.getpid()
+    atexit.register(lambda: os.getpid() == master_pid and shutil.rmtree(directory, ignore_errors=True))
+    return directory
+
+
+def serve(app, port, workers=None, host='0.0.0.0', tls=None, post_fork=None, worker_class='gthread'):
+    """Run app on gunicorn with `workers` processes.
+    tls=(server_cert, server_key, ca_cert) enables mTLS; post_fork(worker) is called in each
+    worker — the place to open per-process resources (connections, background threads)."""
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        print("❌ Для режима serve нужен gunicorn: pip install gunicorn (только Linux/macOS)")
+        sys.exit(1)
+
+    workers = workers or SERVE_WORKERS
+    if worker_class == 'gthread':
+        app = PeerCertificateMiddleware(app)
+
+    settings = {
+        'bind': f'{host}:{port}',
+        'workers': workers,
+        'worker_class': worker_class,
+        'threads': SERVE_THREADS,
+        'timeout': SERVE_TIMEOUT,
+        'graceful_timeout': SERVE_GRACEFUL_TIMEOUT,
+        'keepalive': 75,
+        'accesslog': '-',
+    }
+    if tls:
+        settings.update(mtls_options(*tls))
+    # Метрики воркеров складываются через общий каталог снимков (см. metrics.py)
+    prepare_metrics_dir()
+
+    def on_post_fork(server, worker):
+        metrics.registry.start_exporter()
+        if post_fork:
+            post_fork(worker)
+
+    settings['post_fork'] = on_post_fork
+
+    class Application(BaseApplication):
+        def load_config(self):
+            for key, value in settings.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    scheme = 'https' if tls else 'http'
+    print(f"🧩 gunicorn: {workers} воркер(ов) × {SERVE_THREADS} потоков, {scheme}://{host}:{port} "
+          f"(плавный перезапуск: kill -HUP {os.getpid()})")
+    Application().run()
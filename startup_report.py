@@ -0,0 +1,75 @@
+import os
+import re
+import sys
+import subprocess
+
+# Отчет о времени импорта модулей (python -X importtime) и проверка бюджета запуска.
+# Быстрый старт важен для перезапуска серверов при отказах и коротких запусков клиента.
+#
+#   python startup_report.py                  # server, client, coordinator
+#   python startup_report.py server client    # только выбранные модули
+#
+# Бюджет (мс) задается STARTUP_BUDGET_MS; при превышении скрипт завершается с кодом 1.
+
+STARTUP_BUDGET_MS = float(os.environ.get('STARTUP_BUDGET_MS', 400))
+TOP_IMPORTS = int(os.environ.get('STARTUP_TOP_IMPORTS', 8))
+DEFAULT_MODULES = ['server', 'client', 'coordinator']
+
+# Зависимости, которые не должны загружаться при запуске (только при первом использовании)
+DEFERRED_IMPORTS = ['qrcode', 'PIL', 'pyotp', 'cryptography']
+
+IMPORTTIME_LINE = re.compile(r'import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+
+def measure(module):
+    """Import module in a fresh interpreter; returns [(name, self_us, cumulative_us, depth)]"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    entries = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            entries.append((name, int(self_us), int(cumulative_us), len(indent) // 2))
+    return entries
+
+
+def report(module):
+    entries = measure(module)
+    # importtime печатает дочерние импорты перед родителем: поддерево модуля —
+    # непрерывный блок строк с отступом прямо перед строкой самого модуля
+    end = max(i for i, e in enumerate(entries) if e[0] == module and e[3] == 0)
+    start = end
+    while start > 0 and entries[start - 1][3] > 0:
+        start -= 1
+    entries = entries[start:end + 1]
+    total_ms = entries[-1][2] / 1000
+    status = '✅' if total_ms <= STARTUP_BUDGET_MS else '❌'
+    print(f"{status} {module}: {total_ms:.1f} мс (бюджет {STARTUP_BUDGET_MS:.0f} мс)")
+
+    # Самые тяжелые импорты верхнего уровня (прямые зависимости модуля)
+    top_level = [e for e in entries if e[3] == 1]
+    for name, _, cumulative_us, _ in sorted(top_level, key=lambda e: -e[2])[:TOP_IMPORTS]:
+        print(f"     {cumulative_us / 1000:8.1f} мс  {name}")
+
+    loaded = {e[0].split('.')[0] for e in entries}
+    deferred = [name for name in DEFERRED_IMPORTS if name in loaded]
+    if deferred:
+        print(f"   ⚠️  Загружены при запуске: {', '.join(deferred)}")
+    return total_ms <= STARTUP_BUDGET_MS
+
+
+if __name__ == '__main__':
+    modules = sys.argv[1:] or DEFAULT_MODULES
+    ok = True
+    for module in modules:
+        try:
+            ok = report(module) and ok
+        except RuntimeError as e:
+            print(f"❌ {module}: ошибка импорта — {e}")
+            ok = False
+    sys.exit(0 if ok else 1)
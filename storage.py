@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import sqlite3
+import itertools
+import threading
+
+# Хранилище состояния сервера (пользователи, секреты TOTP, счетчики блокировок).
+# MemoryStore — в памяти одного процесса (как раньше), SQLiteStore — общий файл
+# базы в режиме WAL, которым могут пользоваться несколько процессов сервера.
+# Адрес задается переменной SESSION_STORE: "memory" или "sqlite:///path/to/state.db".
+# По умолчанию — общий файл: server.py, server2.py, server3.py и реплики backend.py
+# видят одних пользователей, вход переживает переключение (ключ подписи сессий — не здесь,
+# а в SECRET_KEY или key_manager.SESSION_KEY_FILE).
+
+DEFAULT_STORE_URL = 'sqlite:///server_state.db'
+
+# SQLiteStore удаляет истекшие записи (временные секреты TOTP, QR-коды, счетчики блокировок)
+# при открытии и после каждых STORE_PURGE_EVERY записей с TTL в этом процессе
+STORE_PURGE_EVERY = int(os.environ.get('STORE_PURGE_EVERY', 1000))
+
+
+class MemoryStore:
+    """In-process key-value store with TTL; values are kept as-is"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._data = {}
+
+    def _get_entry(self, key, now):
+        entry = self._data.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= now:
+            del self._data[key]
+            return None
+        return entry
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self._get_entry(key, time.time())
+            return default if entry is None else entry[0]
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self._data[key] = (value, time.time() + ttl if ttl else None)
+
+    def add(self, key, value, ttl=None):
+        """Set only if the key is missing; returns True if the value was stored"""
+        with self.lock:
+            now = time.time()
+            if self._get_entry(key, now) is not None:
+                return False
+            self._data[key] = (value, now + ttl if ttl else None)
+            return True
+
+    def delete(self, key):
+        with self.lock:
+            self._data.pop(key, None)
+
+    def incr(self, key, ttl=None):
+        """Atomic increment; ttl applies when the counter is created"""
+        with self.lock:
+            now = time.time()
+            entry = self._get_entry(key, now)
+            if entry is None:
+                entry = (0, now + ttl if ttl else None)
+            value = entry[0] + 1
+            self._data[key] = (value, entry[1])
+            return value
+
+
+def restrict_permissions(path):
+    """Файл базы (пользователи, секреты TOTP) и его -wal/-shm доступны только владельцу.
+    Новый файл создается с правами 0600 — SQLite создает -wal/-shm с теми же правами"""
+    if not os.path.exists(path):
+        os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+    for name in (path, f'{path}-wal', f'{path}-shm'):
+        try:
+            os.chmod(name, 0o600)
+        except FileNotFoundError:
+            pass
+
+
+class SQLiteStore:
+    """Key-value store shared between processes through an SQLite database in WAL mode"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        restrict_permissions(path)
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS kv ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS kv_expires_at ON kv (expires_at)')
+        conn.commit()
+        self._ttl_writes = itertools.count(1)
+        self.purge_expired()
+
+    def _conn(self):
+        # Соединение SQLite нельзя делить между потоками — у каждого потока свое
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _select(self, conn, key, now):
+        row = conn.execute(
+            'SELECT value, expires_at FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)',
+            (key, now)
+        ).fetchone()
+        return row
+
+    def get(self, key, default=None):
+        row = self._select(self._conn(), key, time.time())
+        return default if row is None else json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl else None
+        self._conn().execute(
+            'INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)',
+            (key, json.dumps(value), expires_at)
+        )
+        self._count_ttl_write(ttl)
+
+    def add(self, key, value, ttl=None):
+        """Set only if the key is missing; returns True if the value was stored"""
+        conn = self._conn()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if self._select(conn, key, now) is not None:
+                conn.execute('COMMIT')
+                return False
+            conn.execute(
+                'INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, json.dumps(value), now + ttl if ttl else None)
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        self._count_ttl_write(ttl)
+        return True
+
+    def delete(self, key):
+        self._conn().execute('DELETE FROM kv WHERE key = ?', (key,))
+
+    def incr(self, key, ttl=None):
+        """Atomic increment across processes; ttl applies when the counter is created"""
+        conn = self._conn()
+        now = time.time()
+        # BEGIN IMMEDIATE берет блокировку записи сразу, поэтому чтение и запись атомарны
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = self._select(conn, key, now)
+            if row is None:
+                value, expires_at = 1, (now + ttl if ttl else None)
+            else:
+                value, expires_at = json.loads(row[0]) + 1, row[1]
+            conn.execute(
+                'INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, json.dumps(value), expires_at)
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        self._count_ttl_write(ttl)
+        return value
+
+    def _count_ttl_write(self, ttl):
+        if ttl and next(self._ttl_writes) % STORE_PURGE_EVERY == 0:
+            self.purge_expired()
+
+    def purge_expired(self):
+        """Удалить истекшие записи (чтение их и так не видит, но файл базы растет)"""
+        self._conn().execute('DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at <= ?', (time.time(),))
+
+
+def create_store(url=None):
+    """Store by URL: "memory" or "sqlite:///path/to/state.db" """
+    url = url or os.environ.get('SESSION_STORE', DEFAULT_STORE_URL)
+    if url == 'memory':
+        return MemoryStore()
+    if url.startswith('sqlite:'):
+        path = url[len('sqlite:'):]
+        if path.startswith('///'):
+            path = path[3:]
+        return SQLiteStore(path or 'server_state.db')
+    raise ValueError(f"Неизвестное хранилище: {url}")
@@ -0,0 +1,136 @@
+import os
+import struct
+import base64
+import hashlib
+
+# Потоковое шифрование больших данных по частям (схема STREAM на AES-GCM).
+#
+# Формат: заголовок MAGIC | key_id (8 байт) | nonce_prefix (7 байт),
+# затем кадры: длина шифротекста (4 байта, big-endian) | шифротекст части.
+# Nonce части = nonce_prefix | номер части (4 байта) | признак последней части (1 байт),
+# заголовок идет как AAD. Переставить, повторить или отрезать части нельзя —
+# расшифровка такого потока завершится ошибкой.
+#
+# Ключ AES выводится через HKDF из ключа Fernet (encryption_key.txt), key_id
+# позволяет серверу выбрать нужный ключ после ротации.
+
+MAGIC = b'L5S1'
+KEY_ID_SIZE = 8
+NONCE_PREFIX_SIZE = 7
+HEADER_SIZE = len(MAGIC) + KEY_ID_SIZE + NONCE_PREFIX_SIZE
+TAG_SIZE = 16
+
+CHUNK_SIZE = 64 * 1024
+# Верхняя граница размера части — ограничивает память при разборе чужого потока
+MAX_CHUNK_SIZE = 1024 * 1024
+
+STREAM_CONTENT_TYPE = 'application/x-lab5-stream'
+
+_aead_cache = {}
+
+
+class StreamError(Exception):
+    """Поток поврежден, обрезан или зашифрован неизвестным ключом"""
+
+
+def key_id(fernet_key):
+    return hashlib.sha256(fernet_key).digest()[:KEY_ID_SIZE]
+
+
+def _aead(fernet_key):
+    aead = _aead_cache.get(fernet_key)
+    if aead is None:
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b'lab5-stream-v1')
+        aead = AESGCM(hkdf.derive(base64.urlsafe_b64decode(fernet_key)))
+        _aead_cache[fernet_key] = aead
+    return aead
+
+
+def _nonce(prefix, index, final):
+    return prefix + struct.pack('>IB', index, 1 if final else 0)
+
+
+def encrypt_stream(chunks, fernet_key):
+    """Encrypt an iterable of byte chunks; yields the header and encrypted frames.
+    Chunks larger than MAX_CHUNK_SIZE are split, so memory stays bounded by one chunk."""
+    aead = _aead(fernet_key)
+    prefix = os.urandom(NONCE_PREFIX_SIZE)
+    header = MAGIC + key_id(fernet_key) + prefix
+    yield header
+
+    index = 0
+    pending = None
+    for chunk in _split(chunks):
+        # Часть отправляем, только когда знаем, что она не последняя
+        if pending is not None:
+            yield _frame(aead.encrypt(_nonce(prefix, index, False), pending, header))
+            index += 1
+        pending = chunk
+    yield _frame(aead.encrypt(_nonce(prefix, index, True), pending or b'', header))
+
+
+def _split(chunks):
+    for chunk in chunks:
+        for start in range(0, len(chunk), MAX_CHUNK_SIZE):
+            yield chunk[start:start + MAX_CHUNK_SIZE]
+
+
+def _frame(ciphertext):
+    return struct.pack('>I', len(ciphertext)) + ciphertext
+
+
+def _read_exact(read, size):
+    data = read(size)
+    while len(data) < size:
+        more = read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+def decrypt_stream(read, fernet_keys):
+    """Incrementally decrypt a stream from a read(n) callable; yields plaintext chunks.
+    Raises StreamError on tampering, truncation or an unknown key."""
+    header = _read_exact(read, HEADER_SIZE)
+    if len(header) != HEADER_SIZE or not header.startswith(MAGIC):
+        raise StreamError('Invalid stream header')
+
+    stream_key_id = header[len(MAGIC):len(MAGIC) + KEY_ID_SIZE]
+    fernet_key = next((key for key in fernet_keys if key_id(key) == stream_key_id), None)
+    if fernet_key is None:
+        raise StreamError('Stream encrypted with an unknown key')
+    aead = _aead(fernet_key)
+    prefix = header[len(MAGIC) + KEY_ID_SIZE:]
+
+    index = 0
+    while True:
+        length_bytes = _read_exact(read, 4)
+        if len(length_bytes) != 4:
+            raise StreamError('Stream truncated')
+        (length,) = struct.unpack('>I', length_bytes)
+        if length < TAG_SIZE or length > MAX_CHUNK_SIZE + TAG_SIZE:
+            raise StreamError('Invalid chunk length')
+        ciphertext = _read_exact(read, length)
+        if len(ciphertext) != length:
+            raise StreamError('Stream truncated')
+
+        # Сначала пробуем как обычную часть, затем как последнюю
+        for final in (False, True):
+            try:
+                plaintext = aead.decrypt(_nonce(prefix, index, final), ciphertext, header)
+                break
+            except Exception:
+                continue
+        else:
+            raise StreamError(f'Chunk {index} failed authentication')
+
+        yield plaintext
+        index += 1
+        if final:
+            if read(1):
+                raise StreamError('Data after final chunk')
+            return
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# Модули проекта — отдельные скрипты в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# coordinator.py читает список серверов при импорте; тестам нужны три фиктивных адреса
+os.environ.setdefault('BACKENDS', 'http://a,http://b,http://c')
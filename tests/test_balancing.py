@@ -0,0 +1,67 @@
+from collections import Counter
+
+import pytest
+
+import coordinator
+from coordinator import BackendStats, balanced_order
+
+URLS = ['http://a', 'http://b', 'http://c']
+
+
+@pytest.fixture
+def stats(monkeypatch):
+    fresh = {url: BackendStats() for url in URLS}
+    monkeypatch.setattr(coordinator, 'backend_stats', fresh)
+    return fresh
+
+
+@pytest.mark.parametrize('strategy', sorted(coordinator.LB_STRATEGIES))
+def test_order_contains_every_candidate_once(strategy, stats):
+    order = list(balanced_order(URLS, strategy))
+    assert sorted(order) == URLS
+
+
+@pytest.mark.parametrize('strategy', sorted(coordinator.LB_STRATEGIES))
+def test_empty_candidates(strategy):
+    assert list(balanced_order([], strategy)) == []
+
+
+def test_round_robin_rotates_primary_when_whole_order_is_built():
+    firsts = Counter(list(balanced_order(URLS, 'round_robin'))[0] for _ in range(300))
+    assert firsts == {url: 100 for url in URLS}
+
+
+def test_round_robin_keeps_rotation_order():
+    order = list(balanced_order(URLS, 'round_robin'))
+    start = URLS.index(order[0])
+    assert order == URLS[start:] + URLS[:start]
+
+
+def test_round_robin_takes_one_counter_value_per_request():
+    first = list(balanced_order(URLS, 'round_robin'))[0]
+    second = list(balanced_order(URLS, 'round_robin'))[0]
+    assert URLS.index(second) == (URLS.index(first) + 1) % len(URLS)
+
+
+def test_least_outstanding_prefers_idle_server(stats):
+    stats['http://a'].outstanding = 5
+    stats['http://b'].outstanding = 0
+    stats['http://c'].outstanding = 2
+    assert list(balanced_order(URLS, 'least_outstanding')) == ['http://b', 'http://c', 'http://a']
+
+
+def test_p2c_ewma_prefers_cheaper_server(stats):
+    for latency in (5.0, 5.0):
+        stats['http://a'].observe(latency)
+    stats['http://b'].observe(500.0)
+    firsts = Counter(next(balanced_order(['http://a', 'http://b'], 'p2c_ewma')) for _ in range(50))
+    assert firsts == {'http://a': 50}
+
+
+def test_abandoned_attempt_counts_toward_ewma_but_not_p95(stats):
+    backend = stats['http://a']
+    backend.start()
+    backend.abandon(elapsed_ms=800.0)
+    assert backend.outstanding == 0
+    assert backend.ewma_latency_ms == 800.0
+    assert list(backend.recent) == []
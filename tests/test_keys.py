@@ -0,0 +1,88 @@
+import os
+import stat
+
+import pytest
+from cryptography.fernet import InvalidToken
+
+import key_manager
+from key_manager import (KeyManager, load_session_keys, read_keys, rotate_keys, rotate_session_keys,
+                         write_keys, generate_key)
+
+
+@pytest.fixture
+def key_file(tmp_path):
+    path = str(tmp_path / 'encryption_key.txt')
+    write_keys(path, [generate_key()])
+    return path
+
+
+def test_missing_key_file_is_created(tmp_path):
+    path = str(tmp_path / 'encryption_key.txt')
+    manager = KeyManager(path, check_interval=0)
+    assert manager.decrypt(manager.encrypt(b'data')) == b'data'
+    assert len(read_keys(path)) == 1
+
+
+def test_rotation_keeps_old_tokens_readable(key_file):
+    manager = KeyManager(key_file, check_interval=0)
+    old_token = manager.encrypt(b'before rotation')
+    new_primary = rotate_keys(key_file)
+    assert manager.keys()[0] == new_primary
+    assert manager.decrypt(old_token) == b'before rotation'
+    assert manager.reloads == 2
+
+
+def test_new_tokens_use_new_primary_key(key_file):
+    from cryptography.fernet import Fernet
+    manager = KeyManager(key_file, check_interval=0)
+    new_primary = rotate_keys(key_file)
+    Fernet(new_primary).decrypt(manager.encrypt(b'after rotation'))
+
+
+def test_rotation_drops_keys_beyond_keep(key_file):
+    manager = KeyManager(key_file, check_interval=0)
+    oldest_token = manager.encrypt(b'oldest')
+    rotate_keys(key_file, keep=2)
+    rotate_keys(key_file, keep=2)
+    assert len(manager.keys()) == 2
+    with pytest.raises(InvalidToken):
+        manager.decrypt(oldest_token)
+
+
+def test_key_file_is_not_reread_within_interval(key_file):
+    manager = KeyManager(key_file, check_interval=3600)
+    manager.cipher()
+    rotate_keys(key_file)
+    manager.cipher()
+    assert manager.reloads == 1
+
+
+def test_session_keys_from_environment(monkeypatch, tmp_path):
+    monkeypatch.setenv('SECRET_KEY', 'from-env')
+    assert load_session_keys(str(tmp_path / 'missing.txt')) == [b'from-env']
+
+
+def test_missing_session_key_file_is_an_error(monkeypatch, tmp_path):
+    monkeypatch.delenv('SECRET_KEY', raising=False)
+    with pytest.raises(RuntimeError):
+        load_session_keys(str(tmp_path / 'missing.txt'))
+
+
+def test_session_key_file_readable_by_others_is_refused(monkeypatch, tmp_path):
+    monkeypatch.delenv('SECRET_KEY', raising=False)
+    path = str(tmp_path / 'session_key.txt')
+    rotate_session_keys(path)
+    os.chmod(path, 0o644)
+    with pytest.raises(RuntimeError):
+        load_session_keys(path)
+
+
+def test_session_key_rotation(monkeypatch, tmp_path):
+    monkeypatch.delenv('SECRET_KEY', raising=False)
+    path = str(tmp_path / 'session_key.txt')
+    first = rotate_session_keys(path)
+    second = rotate_session_keys(path)
+    third = rotate_session_keys(path, keep=2)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    assert load_session_keys(path) == [third, second]
+    assert first not in load_session_keys(path)
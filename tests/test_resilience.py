@@ -0,0 +1,105 @@
+import pytest
+
+import coordinator
+from coordinator import CircuitBreaker, HedgeBudget
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(coordinator.time, 'monotonic', fake)
+    return fake
+
+
+def test_breaker_opens_after_threshold_failures(clock):
+    breaker = CircuitBreaker(threshold=3, cooldown=10)
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.acquire()
+    breaker.record_failure()
+    assert breaker.to_dict()['state'] == CircuitBreaker.OPEN
+    assert not breaker.acquire()
+    assert not breaker.available()
+
+
+def test_success_resets_failure_count(clock):
+    breaker = CircuitBreaker(threshold=2, cooldown=10)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.to_dict()['state'] == CircuitBreaker.CLOSED
+
+
+def test_half_open_allows_single_trial(clock):
+    breaker = CircuitBreaker(threshold=1, cooldown=10)
+    breaker.record_failure()
+    clock.now += 10
+    assert breaker.to_dict()['state'] == CircuitBreaker.HALF_OPEN
+    assert breaker.acquire()
+    assert not breaker.acquire()
+    assert not breaker.available()
+
+
+def test_half_open_trial_success_closes(clock):
+    breaker = CircuitBreaker(threshold=1, cooldown=10)
+    breaker.record_failure()
+    clock.now += 10
+    assert breaker.acquire()
+    breaker.record_success()
+    assert breaker.to_dict() == {'state': CircuitBreaker.CLOSED, 'failures': 0, 'retry_in': None}
+
+
+def test_half_open_trial_failure_reopens(clock):
+    breaker = CircuitBreaker(threshold=5, cooldown=10)
+    for _ in range(5):
+        breaker.record_failure()
+    clock.now += 10
+    assert breaker.acquire()
+    breaker.record_failure()
+    state = breaker.to_dict()
+    assert state['state'] == CircuitBreaker.OPEN
+    assert state['retry_in'] == 10
+
+
+def test_released_trial_can_be_retried(clock):
+    breaker = CircuitBreaker(threshold=1, cooldown=10)
+    breaker.record_failure()
+    clock.now += 10
+    assert breaker.acquire()
+    breaker.release()
+    assert breaker.acquire()
+
+
+def test_hedge_budget_accumulates_ratio_per_request():
+    budget = HedgeBudget(0.25)
+    for _ in range(3):
+        budget.earn()
+    assert not budget.try_spend()
+    budget.earn()
+    assert budget.try_spend()
+    assert not budget.try_spend()
+    assert budget.hedges_sent == 1
+
+
+def test_hedge_budget_is_capped_by_burst():
+    budget = HedgeBudget(1.0, burst=2.0)
+    for _ in range(10):
+        budget.earn()
+    assert [budget.try_spend() for _ in range(3)] == [True, True, False]
+
+
+def test_hedge_budget_counts_wins():
+    budget = HedgeBudget(1.0)
+    budget.earn()
+    assert budget.try_spend()
+    budget.record_win()
+    state = budget.to_dict()
+    assert (state['hedges_sent'], state['hedges_won'], state['tokens']) == (1, 1, 0)
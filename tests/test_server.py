@@ -0,0 +1,59 @@
+import pytest
+
+import server
+from storage import MemoryStore
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(server.app, 'secret_key', b'primary')
+    monkeypatch.setitem(server.app.config, 'SECRET_KEY_FALLBACKS', [])
+    server.init_store(MemoryStore())
+    return server.app.test_client()
+
+
+def login(client, **extra):
+    with client.session_transaction() as session:
+        session.update(authenticated=True, username='user1', expires='2999-01-01T00:00:00', **extra)
+
+
+def test_data_requires_session(client):
+    response = client.post('/api/data', json={'data': 'x'})
+    assert response.status_code == 401
+    assert response.json == {'error': 'Authentication required'}
+
+
+def test_bound_session_without_certificate_is_rejected(client):
+    login(client, cert_fingerprint='ab' * 32)
+    response = client.post('/api/data', json={'data': 'x'})
+    assert response.status_code == 401
+    assert response.json == {'error': 'Certificate required'}
+
+
+def test_unknown_body_format_is_415(client):
+    login(client)
+    response = client.post('/api/data', data=b'data=x', content_type='text/plain')
+    assert response.status_code == 415
+
+
+def test_session_signed_with_previous_key_is_accepted(client, monkeypatch):
+    login(client)
+    cookie = client.get_cookie('session').value
+    monkeypatch.setattr(server.app, 'secret_key', b'rotated')
+    monkeypatch.setitem(server.app.config, 'SECRET_KEY_FALLBACKS', [b'primary'])
+    rotated = server.app.test_client()
+    rotated.set_cookie('session', cookie)
+    with rotated.session_transaction() as session:
+        assert session.get('authenticated')
+    monkeypatch.setitem(server.app.config, 'SECRET_KEY_FALLBACKS', [])
+    expired = server.app.test_client()
+    expired.set_cookie('session', cookie)
+    with expired.session_transaction() as session:
+        assert 'authenticated' not in session
+
+
+def test_old_signing_key_is_removed_from_store(client):
+    store = MemoryStore()
+    store.set('flask_secret_key', 'deadbeef')
+    server.init_store(store)
+    assert store.get('flask_secret_key') is None
@@ -0,0 +1,118 @@
+import os
+import stat
+
+import pytest
+
+import storage
+from storage import MemoryStore, SQLiteStore, create_store
+
+
+class FakeTime:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeTime()
+    monkeypatch.setattr(storage.time, 'time', fake)
+    return fake
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path, clock):
+    if request.param == 'memory':
+        return MemoryStore()
+    return SQLiteStore(str(tmp_path / 'state.db'))
+
+
+def test_get_set_delete(store):
+    assert store.get('missing') is None
+    assert store.get('missing', 'default') == 'default'
+    store.set('user:u', {'mfa_enabled': True})
+    assert store.get('user:u') == {'mfa_enabled': True}
+    store.delete('user:u')
+    assert store.get('user:u') is None
+
+
+def test_add_does_not_overwrite(store):
+    assert store.add('key', 1)
+    assert not store.add('key', 2)
+    assert store.get('key') == 1
+
+
+def test_value_expires_after_ttl(store, clock):
+    store.set('qr', 'png', ttl=10)
+    clock.now += 9
+    assert store.get('qr') == 'png'
+    clock.now += 1
+    assert store.get('qr') is None
+
+
+def test_add_replaces_expired_value(store, clock):
+    store.add('setup', 'old', ttl=5)
+    clock.now += 5
+    assert store.add('setup', 'new', ttl=5)
+    assert store.get('setup') == 'new'
+
+
+def test_incr_keeps_ttl_from_creation(store, clock):
+    assert store.incr('failed:u', ttl=60) == 1
+    clock.now += 30
+    assert store.incr('failed:u', ttl=60) == 2
+    clock.now += 30
+    assert store.get('failed:u') is None
+    assert store.incr('failed:u', ttl=60) == 1
+
+
+def test_incr_without_ttl(store):
+    for expected in (1, 2, 3):
+        assert store.incr('counter') == expected
+
+
+def test_sqlite_store_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / 'state.db')
+    SQLiteStore(path).set('user:u', {'password': 'p'})
+    assert SQLiteStore(path).get('user:u') == {'password': 'p'}
+
+
+def test_sqlite_purge_removes_expired_rows(tmp_path, clock):
+    store = SQLiteStore(str(tmp_path / 'state.db'))
+    store.set('short', 1, ttl=1)
+    store.set('long', 2, ttl=100)
+    store.set('forever', 3)
+    clock.now += 10
+    store.purge_expired()
+    keys = {row[0] for row in store._conn().execute('SELECT key FROM kv')}
+    assert keys == {'long', 'forever'}
+
+
+def test_sqlite_purges_every_n_ttl_writes(tmp_path, clock, monkeypatch):
+    monkeypatch.setattr(storage, 'STORE_PURGE_EVERY', 3)
+    store = SQLiteStore(str(tmp_path / 'state.db'))
+    store.set('old', 1, ttl=1)
+    clock.now += 10
+    store.set('a', 1, ttl=100)
+    assert store._conn().execute("SELECT count(*) FROM kv WHERE key = 'old'").fetchone()[0] == 1
+    store.set('b', 1, ttl=100)
+    assert store._conn().execute("SELECT count(*) FROM kv WHERE key = 'old'").fetchone()[0] == 0
+
+
+def test_sqlite_database_is_private(tmp_path):
+    path = tmp_path / 'state.db'
+    store = SQLiteStore(str(path))
+    store.set('user:u', {'totp_secret': 'S'})
+    for name in (path, tmp_path / 'state.db-wal', tmp_path / 'state.db-shm'):
+        if name.exists():
+            assert stat.S_IMODE(os.stat(name).st_mode) == 0o600
+
+
+def test_create_store_by_url(tmp_path):
+    assert isinstance(create_store('memory'), MemoryStore)
+    sqlite_store = create_store(f"sqlite:///{tmp_path / 'state.db'}")
+    assert isinstance(sqlite_store, SQLiteStore)
+    with pytest.raises(ValueError):
+        create_store('redis://localhost')
@@ -0,0 +1,93 @@
+import io
+import struct
+
+import pytest
+
+import stream_crypto
+from key_manager import generate_key
+from stream_crypto import HEADER_SIZE, StreamError, decrypt_stream, encrypt_stream
+
+
+def encrypt(chunks, key):
+    return b''.join(encrypt_stream(chunks, key))
+
+
+def decrypt(data, keys):
+    return b''.join(decrypt_stream(io.BytesIO(data).read, keys))
+
+
+def frames(data):
+    """Header and list of frames of an encrypted stream"""
+    header, offset, result = data[:HEADER_SIZE], HEADER_SIZE, []
+    while offset < len(data):
+        (length,) = struct.unpack('>I', data[offset:offset + 4])
+        result.append(data[offset:offset + 4 + length])
+        offset += 4 + length
+    return header, result
+
+
+@pytest.fixture
+def key():
+    return generate_key()
+
+
+@pytest.mark.parametrize('chunks', [[], [b''], [b'one chunk'], [b'a' * 1000, b'b' * 10, b'c' * 5000]])
+def test_round_trip(chunks, key):
+    assert decrypt(encrypt(chunks, key), [key]) == b''.join(chunks)
+
+
+def test_large_chunks_are_split(key, monkeypatch):
+    monkeypatch.setattr(stream_crypto, 'MAX_CHUNK_SIZE', 1024)
+    data = bytes(range(256)) * 20
+    encrypted = encrypt([data], key)
+    assert len(frames(encrypted)[1]) == 5
+    assert decrypt(encrypted, [key]) == data
+
+
+def test_stream_from_previous_key_after_rotation(key):
+    new_key = generate_key()
+    assert decrypt(encrypt([b'old stream'], key), [new_key, key]) == b'old stream'
+
+
+def test_unknown_key(key):
+    with pytest.raises(StreamError):
+        decrypt(encrypt([b'data'], key), [generate_key()])
+
+
+def test_tampered_chunk_fails_authentication(key):
+    encrypted = bytearray(encrypt([b'a' * 100, b'b' * 100], key))
+    encrypted[HEADER_SIZE + 10] ^= 0x01
+    with pytest.raises(StreamError):
+        decrypt(bytes(encrypted), [key])
+
+
+def test_tampered_header_fails_authentication(key):
+    encrypted = bytearray(encrypt([b'data'], key))
+    encrypted[HEADER_SIZE - 1] ^= 0x01
+    with pytest.raises(StreamError):
+        decrypt(bytes(encrypted), [key])
+
+
+def test_truncated_stream_is_detected(key):
+    header, parts = frames(encrypt([b'a' * 100, b'b' * 100, b'c' * 100], key))
+    # Без последней части: каждая оставшаяся часть сама по себе подлинная
+    with pytest.raises(StreamError):
+        decrypt(header + b''.join(parts[:-1]), [key])
+    with pytest.raises(StreamError):
+        decrypt(header + b''.join(parts)[:-5], [key])
+
+
+def test_reordered_chunks_are_detected(key):
+    header, parts = frames(encrypt([b'a' * 100, b'b' * 100, b'c' * 100], key))
+    with pytest.raises(StreamError):
+        decrypt(header + parts[1] + parts[0] + parts[2], [key])
+
+
+def test_data_after_final_chunk_is_rejected(key):
+    with pytest.raises(StreamError):
+        decrypt(encrypt([b'data'], key) + b'extra', [key])
+
+
+def test_invalid_header(key):
+    with pytest.raises(StreamError):
+        decrypt(b'XXXX' + encrypt([b'data'], key)[4:], [key])
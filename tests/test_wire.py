@@ -0,0 +1,55 @@
+import pytest
+
+import wire
+from wire import JSON_CONTENT_TYPE, MSGPACK_CONTENT_TYPE
+
+needs_msgpack = pytest.mark.skipif(not wire.BINARY_AVAILABLE, reason='msgpack не установлен')
+
+PAYLOAD = {'data': 'token', 'items': [1, 2, 3]}
+
+
+def test_json_round_trip():
+    assert wire.decode(JSON_CONTENT_TYPE, wire.encode(PAYLOAD)) == PAYLOAD
+    assert wire.decode('application/json; charset=utf-8', wire.encode(PAYLOAD)) == PAYLOAD
+
+
+def test_empty_json_body():
+    assert wire.decode(JSON_CONTENT_TYPE, b'') is None
+
+
+@needs_msgpack
+def test_msgpack_round_trip():
+    body = wire.encode(PAYLOAD, MSGPACK_CONTENT_TYPE)
+    assert wire.decode(MSGPACK_CONTENT_TYPE, body) == PAYLOAD
+
+
+def test_msgpack_without_library_is_unsupported(monkeypatch):
+    monkeypatch.setattr(wire, 'msgpack', None)
+    with pytest.raises(wire.UnsupportedFormat):
+        wire.decode(MSGPACK_CONTENT_TYPE, b'\x80')
+    with pytest.raises(wire.UnsupportedFormat):
+        wire.encode(PAYLOAD, MSGPACK_CONTENT_TYPE)
+
+
+@needs_msgpack
+@pytest.mark.parametrize('accept, content_type, expected', [
+    (None, None, JSON_CONTENT_TYPE),
+    (MSGPACK_CONTENT_TYPE, None, MSGPACK_CONTENT_TYPE),
+    (f'{JSON_CONTENT_TYPE}, {MSGPACK_CONTENT_TYPE}', None, MSGPACK_CONTENT_TYPE),
+    (JSON_CONTENT_TYPE, MSGPACK_CONTENT_TYPE, MSGPACK_CONTENT_TYPE),
+    (JSON_CONTENT_TYPE, JSON_CONTENT_TYPE, JSON_CONTENT_TYPE),
+])
+def test_negotiate(accept, content_type, expected):
+    assert wire.negotiate(accept, content_type) == expected
+
+
+def test_negotiate_falls_back_to_json_without_msgpack(monkeypatch):
+    monkeypatch.setattr(wire, 'BINARY_AVAILABLE', False)
+    assert wire.negotiate(MSGPACK_CONTENT_TYPE, MSGPACK_CONTENT_TYPE) == JSON_CONTENT_TYPE
+
+
+@pytest.mark.parametrize('content_type', [JSON_CONTENT_TYPE, MSGPACK_CONTENT_TYPE])
+def test_fernet_token_round_trip(content_type):
+    from cryptography.fernet import Fernet
+    token = Fernet(Fernet.generate_key()).encrypt(b'secret').decode()
+    assert wire.token_from_wire(wire.token_to_wire(token, content_type)) == token.encode()
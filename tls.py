@@ -0,0 +1,183 @@
+import ssl
+import threading
+
+from requests.adapters import HTTPAdapter
+
+# Возобновление TLS-сессий на стороне клиента (SecureClient, координатор).
+# Полное mTLS-рукопожатие — это проверка цепочек сертификатов и подписи с обеих сторон;
+# при возобновлении клиент предъявляет билет (session ticket) предыдущей сессии с тем же
+# сервером, и рукопожатие обходится без них. Сервер выдает билеты (TLS_NUM_TICKETS в serving.py).
+#
+# urllib3 не переносит TLS-сессию между соединениями пула, поэтому контекст сам помнит
+# последнюю сессию (с билетом) для каждого сервера (host, port) и подставляет ее в новые соединения.
+
+
+class TicketSavingSSLSocket(ssl.SSLSocket):
+    """В TLS 1.3 билет сессии приходит после рукопожатия, вместе с первыми данными сервера:
+    сокет передает сессию контексту при первом чтении, после которого билет есть"""
+
+    ticket_saved = False
+
+    def recv_into(self, buffer, nbytes=None, flags=0):
+        received = super().recv_into(buffer, nbytes, flags)
+        if not self.ticket_saved and not self.server_side:
+            session = self.session
+            if session is not None and session.has_ticket:
+                self.ticket_saved = True
+                self.context.remember(self)
+        return received
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """Client SSLContext that offers the last session for the same server on every new connection"""
+
+    sslsocket_class = TicketSavingSSLSocket
+
+    def __init__(self, protocol=ssl.PROTOCOL_TLS_CLIENT, resume=True):
+        super().__init__()
+        # resume=False — всегда полное рукопожатие (для сравнения), статистика ведется так же
+        self.resume = resume
+        # Сертификат клиента (cert_file, key_file) — для копии контекста без проверки сервера
+        self.cert_chain = None
+        self.session_lock = threading.Lock()
+        self.sessions = {}
+        self.handshakes = 0
+        self.resumed = 0
+
+    def wrap_socket(self, sock, server_side=False, do_handshake_on_connect=True, suppress_ragged_eofs=True,
+                    server_hostname=None, session=None):
+        key = self._session_key(sock, server_hostname)
+        if session is None and not server_side and self.resume:
+            with self.session_lock:
+                session = self.sessions.get(key)
+        tls_sock = super().wrap_socket(sock, server_side=server_side, do_handshake_on_connect=do_handshake_on_connect,
+                                       suppress_ragged_eofs=suppress_ragged_eofs, server_hostname=server_hostname,
+                                       session=session)
+        if do_handshake_on_connect and not server_side:
+            with self.session_lock:
+                self.handshakes += 1
+                if tls_sock.session_reused:
+                    self.resumed += 1
+            self.remember(tls_sock, server_hostname)
+        return tls_sock
+
+    @staticmethod
+    def _session_key(sock, server_hostname):
+        try:
+            port = sock.getpeername()[1]
+        except OSError:
+            port = None
+        return server_hostname, port
+
+    def remember(self, tls_sock, server_hostname=None):
+        """Сохранить сессию соединения для следующих соединений с тем же сервером"""
+        session = tls_sock.session
+        if session is None:
+            return
+        key = self._session_key(tls_sock, server_hostname or tls_sock.server_hostname)
+        with self.session_lock:
+            current = self.sessions.get(key)
+            # Сессию без билета не ставим поверх сессии с билетом
+            if current is None or session.has_ticket or not current.has_ticket:
+                self.sessions[key] = session
+
+    def unverified_copy(self):
+        """Отдельный контекст для verify=False: тот же сертификат клиента, сервер не проверяется"""
+        context = ResumingSSLContext(self.protocol, resume=self.resume)
+        context.minimum_version = self.minimum_version
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        if self.cert_chain:
+            context.load_cert_chain(*self.cert_chain)
+            context.cert_chain = self.cert_chain
+        return context
+
+    def counters(self):
+        with self.session_lock:
+            return self.handshakes, self.resumed
+
+    def stats(self):
+        return handshake_stats(*self.counters())
+
+
+def handshake_stats(handshakes, resumed):
+    return {
+        'handshakes': handshakes,
+        'resumed': resumed,
+        'full': handshakes - resumed,
+        'hit_rate': round(resumed / handshakes, 3) if handshakes else None,
+    }
+
+
+def create_client_context(cert_file, key_file, ca_cert, resume=True):
+    """mTLS-контекст клиента с возобновлением сессий: сертификат клиента и CA для проверки сервера"""
+    context = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT, resume=resume)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_verify_locations(ca_cert)
+    context.load_cert_chain(cert_file, key_file)
+    context.cert_chain = (cert_file, key_file)
+    return context
+
+
+class ResumingHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter for requests that connects through a ResumingSSLContext.
+
+    Certificates live in the context, so session.cert/session.verify paths are not re-read
+    for every new connection; verify=False requests go through a separate unverified context
+    and pool, leaving the shared context untouched."""
+
+    def __init__(self, ssl_context, **kwargs):
+        self.ssl_context = ssl_context
+        self.adapter_kwargs = kwargs
+        self.unverified_lock = threading.Lock()
+        self.unverified_adapter = None
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        pool_kwargs['ssl_context'] = self.ssl_context
+        super().init_poolmanager(connections, maxsize, block=block, **pool_kwargs)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        proxy_kwargs['ssl_context'] = self.ssl_context
+        return super().proxy_manager_for(proxy, **proxy_kwargs)
+
+    def unverified(self):
+        """Адаптер для verify=False: свой контекст без проверки сервера и свой пул соединений"""
+        with self.unverified_lock:
+            if self.unverified_adapter is None:
+                self.unverified_adapter = ResumingHTTPAdapter(self.ssl_context.unverified_copy(),
+                                                              **self.adapter_kwargs)
+            return self.unverified_adapter
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        if not verify and self.ssl_context.verify_mode != ssl.CERT_NONE:
+            # Общий контекст не меняем: он проверяет сервер для всех остальных соединений
+            return self.unverified().send(request, stream=stream, timeout=timeout, verify=verify, cert=cert,
+                                          proxies=proxies)
+        return super().send(request, stream=stream, timeout=timeout, verify=verify, cert=cert, proxies=proxies)
+
+    def cert_verify(self, conn, url, verify, cert):
+        if not url.lower().startswith('https'):
+            return
+        conn.cert_reqs = 'CERT_REQUIRED' if verify else 'CERT_NONE'
+        conn.ca_certs = conn.ca_cert_dir = None
+        conn.cert_file = conn.key_file = None
+
+    def close(self):
+        super().close()
+        if self.unverified_adapter is not None:
+            self.unverified_adapter.close()
+
+    def tls_stats(self):
+        handshakes, resumed = self.ssl_context.counters()
+        if self.unverified_adapter is not None:
+            extra_handshakes, extra_resumed = self.unverified_adapter.ssl_context.counters()
+            handshakes, resumed = handshakes + extra_handshakes, resumed + extra_resumed
+        return handshake_stats(handshakes, resumed)
+
+
+def mount_resuming_adapter(session, prefix, ssl_context, **adapter_kwargs):
+    """Подключить к requests.Session адаптер с возобновлением TLS-сессий для адресов prefix"""
+    adapter = ResumingHTTPAdapter(ssl_context, **adapter_kwargs)
+    session.mount(prefix, adapter)
+    return adapter
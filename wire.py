@@ -0,0 +1,75 @@
+import json
+import base64
+
+# Формат тела запросов/ответов /api/data: JSON (по умолчанию) или компактный msgpack.
+# В msgpack зашифрованные сообщения передаются сырыми байтами токена Fernet,
+# без base64 (минус ~33% к размеру), а разбор дешевле, чем у JSON.
+# msgpack — необязательная зависимость: без нее остается только JSON.
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_CONTENT_TYPE = 'application/json'
+MSGPACK_CONTENT_TYPE = 'application/x-msgpack'
+
+BINARY_AVAILABLE = msgpack is not None
+
+
+class UnsupportedFormat(Exception):
+    """Тело в формате, который этот процесс не умеет разбирать"""
+
+
+def media_type(content_type):
+    return (content_type or '').split(';', 1)[0].strip().lower()
+
+
+def is_msgpack(content_type):
+    return media_type(content_type) == MSGPACK_CONTENT_TYPE
+
+
+def decode(content_type, raw):
+    """Body bytes -> Python object according to Content-Type"""
+    if is_msgpack(content_type):
+        if msgpack is None:
+            raise UnsupportedFormat(MSGPACK_CONTENT_TYPE)
+        return msgpack.unpackb(raw, raw=False)
+    if not raw:
+        return None
+    return json.loads(raw)
+
+
+def encode(obj, content_type=JSON_CONTENT_TYPE):
+    """Python object -> body bytes according to Content-Type"""
+    if is_msgpack(content_type):
+        if msgpack is None:
+            raise UnsupportedFormat(MSGPACK_CONTENT_TYPE)
+        return msgpack.packb(obj, use_bin_type=True)
+    return json.dumps(obj).encode()
+
+
+def negotiate(accept, request_content_type=None):
+    """Формат ответа: msgpack, если клиент его принимает (или прислал запрос в нем) и он доступен"""
+    if not BINARY_AVAILABLE:
+        return JSON_CONTENT_TYPE
+    if MSGPACK_CONTENT_TYPE in (accept or '') or is_msgpack(request_content_type):
+        return MSGPACK_CONTENT_TYPE
+    return JSON_CONTENT_TYPE
+
+
+def token_to_wire(token, content_type):
+    """Токен Fernet (str) -> представление в теле: сырые байты для msgpack, строка для JSON"""
+    if is_msgpack(content_type):
+        try:
+            return base64.urlsafe_b64decode(token)
+        except ValueError:
+            return token  # Не токен (данные не зашифрованы) — передаем строкой
+    return token
+
+
+def token_from_wire(value):
+    """Представление токена из тела -> токен Fernet (bytes)"""
+    if isinstance(value, (bytes, bytearray)):
+        return base64.urlsafe_b64encode(bytes(value))
+    return value.encode()